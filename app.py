@@ -4,113 +4,1143 @@ Author: Laurence Psychic
 Email: vesper.porta@protonmail.com
 
 Initiate the VesperCrypt System, provide a UI to take a file and encrypt the
-file using the provided AES-RSA encryption key in block sizes equal to
-512 bytes of information per encoding. An SQL database is used to maintain the
-validity of the data stored on disk and retain concurency in data.
+file using the provided AES-RSA encryption key in chunks, the size of fixed
+chunks being chosen per file by choose_chunk_size. An SQL database is used to
+maintain the validity of the data stored on disk and retain concurency in
+data.
 """
 
 import click
-from math import ceil
-from Crypto.Cipher import AES
+import os
+import string
+import sys
+from collections import namedtuple
+from datetime import datetime
+from functools import partial
 from hashlib import md5
+from sqlalchemy import func
+from sqlalchemy.orm import scoped_session
 
-from diskio import read_location, write_location, detail_location, get_path
-from storage import CryptoStore, CryptoFile, session
+from diskio import (
+    read_windows, read_content_chunks, write_location, walk_location,
+    get_path, allocate_location, remove_disk_contents, SegmentWriter,
+    CHUNKING_FIXED, CHUNKING_CONTENT, CHUNKING_TYPES, WIPE_PATTERN,
+    WIPE_TYPES,
+)
+from storage import (
+    CryptoStore, CryptoFile, CryptoSegment, StoreRun,
+    CHUNK_BATCH_SIZE, ID_BATCH_SIZE, Session, bulk_insert, commit,
+    file_complete, session,
+)
+from cryptochunk import (
+    FORMAT_HEX, FORMAT_SEALED, FORMAT_VERSION, CODEC_NONE, CODEC_TYPES,
+    FileKey, MasterKey, encrypt_windows, get_encryptable_password,
+)
+from instrument import instrument
 from password import Password
+from pipeline import Pipeline, Stage, PIPELINE_QUEUE_SIZE
+from restore import (
+    find_file, password_matches, query_chunks, read_range, restore_files,
+    unseal_chunks,
+)
+from verify import verify_files
+from workers import WorkerPool, POOL_PROCESS, POOL_TYPES, DEFAULT_JOBS, batched
 
 
 AES_IV456_AUTHENTICATION = '84d1a35654ab9af8'
+DEFAULT_INPUT_DIRECTORY = './input/'
 DEFAULT_OUTPUT_DIRECTORY = './output'
-FILE_BYTE_LENGTH = 1024
+DEFAULT_RESTORE_DIRECTORY = './restore'
+FILE_BYTE_LENGTH = 1024  # Hex characters per chunk of the format 1 stores.
+CHUNK_BYTE_LENGTH = FILE_BYTE_LENGTH // 2
+CHUNK_MIN_LENGTH = CHUNK_BYTE_LENGTH
+CHUNK_MAX_LENGTH = 1024 * 1024
+CHUNK_TARGET_COUNT = 1024
+WORKER_BATCH_LENGTH = 64
+WORKER_BATCH_BYTES = 4 * 1024 * 1024
+DEFAULT_READERS = 2
+DEFAULT_WRITERS = 1
+CHUNK_REFERENCE_COLUMNS = [
+    'public_key', 'private_key', 'filename', 'filesize',
+    'segment_id', 'segment_offset', 'segment_length', 'codec', 'checksum',
+]
 IGNORE_LIST = [
     '.DS_Store',
 ]
 
-
-def get_encryptable_password():
-    password_store = str(Password())
-    while len(password_store.encode()) % 16:
-        password_store = get_encryptable_password()
-    return password_store
+StoreBatch = namedtuple(
+    'StoreBatch', ['job', 'sequence', 'position', 'items'])
+GarbageTotals = namedtuple('GarbageTotals', ['files', 'bytes'])
 
 
 def get_available_filename():
-    filename = str(Password(alphabet=['Filename Safe']))
-    path = get_path('{}/{}'.format(DEFAULT_OUTPUT_DIRECTORY, filename))
-    while path.exists() or len(path.name.encode()) % 16:
-        path = get_available_filename()
-    return path
+    return allocate_location(DEFAULT_OUTPUT_DIRECTORY)
 
 
-def encrypt_location(location, cypher, password_key, password_iv):
-    skip_file = [s for s in IGNORE_LIST if s in location.name]
-    if skip_file:
-        return None
-    location = get_path(location)
-    byte_length = FILE_BYTE_LENGTH
+def get_relative_filename(path):
+    """
+    Name of an allocated path relative to the output directory, as recorded
+    in the database.
+    """
+    return path.relative_to(DEFAULT_OUTPUT_DIRECTORY).as_posix()
+
+
+def allocate_segment(bind=None):
+    """
+    Register a new segment file for a SegmentWriter to append chunks to,
+    within the current transaction of bind, the module session by default.
+
+    :return: tuple of the CryptoSegment id and Path of the segment file
+    """
+    bind = bind or session
+    path = get_available_filename()
+    segment = CryptoSegment(filename=get_relative_filename(path))
+    bind.add(segment)
+    bind.flush()
+    return segment.id, path
+
+
+def allocate_committed_segment():
+    """
+    Register a new segment in a short transaction of its own, for a writer
+    shared by the threads of a StorePipeline which must never hold the
+    database while the commit stage is writing.
+    """
+    segment_session = Session()
+    try:
+        rtn = allocate_segment(segment_session)
+        commit(segment_session)
+        return rtn
+    finally:
+        segment_session.close()
+
+
+def copy_windows(windows, checksum):
+    """
+    Copy each window out of the reused read buffer, feeding it to checksum.
+    """
+    for window in windows:
+        checksum.update(window)
+        yield bytes(window)
+
+
+def file_checksum(location, cypher):
+    """
+    Keyed checksum of the contents of a file, as recorded by StorePipeline.
+    """
+    checksum = cypher.checksum()
+    for window in read_windows(location, CHUNK_MAX_LENGTH):
+        checksum.update(window)
+    return checksum.hexdigest()
+
+
+def checksum_prefix(location, checksum, length):
+    """
+    Feed the first length bytes of a location to checksum, for a file resumed
+    part way through.
+    """
+    if not length:
+        return
+    for window in read_windows(location, CHUNK_MAX_LENGTH):
+        checksum.update(window[:length])
+        length -= len(window)
+        if length <= 0:
+            break
+
+
+def get_manifest():
+    """
+    The live CryptoFile of every stored file keyed by filename, loaded by a
+    session of its own and detached from it so the rows can be read from any
+    thread without holding the database. Files not yet complete are left out.
+
+    :return: dict
+    """
+    manifest_session = Session()
+    try:
+        files = manifest_session.query(CryptoFile).filter(
+            CryptoFile.retired_at.is_(None),
+            file_complete(),
+        ).order_by(CryptoFile.id)
+        return {file.filename: file for file in files}
+    finally:
+        manifest_session.close()
+
+
+def get_partials(run_id):
+    """
+    The incomplete CryptoFile of every file an interrupted run was storing
+    keyed by filename, detached as get_manifest.
+
+    :param run_id: int id of the StoreRun
+    :return: dict
+    """
+    partial_session = Session()
+    try:
+        files = partial_session.query(CryptoFile).filter(
+            CryptoFile.run_id == run_id,
+            CryptoFile.checksum.is_(None),
+            CryptoFile.retired_at.is_(None),
+        ).order_by(CryptoFile.id)
+        return {file.filename: file for file in files}
+    finally:
+        partial_session.close()
+
+
+def resume_point(file, bind=None):
+    """
+    Find where an incomplete file resumes, after the chunks committed in
+    sequence from its first. Batches of chunks commit in any order, so any
+    committed after a gap are deleted to be written again.
+
+    :param file: CryptoFile
+    :return: tuple of int sequence and int position to resume from
+    """
+    bind = bind or session
+    sequence = 0
+    position = 0
+    rows = bind.query(CryptoStore.sequence, CryptoStore.filesize).filter(
+        CryptoStore.cryptofile_id == file.id,
+    ).order_by(CryptoStore.sequence).all()
+    for row in rows:
+        if row.sequence != sequence:
+            break
+        sequence += 1
+        position += row.filesize
+    bind.query(CryptoStore).filter(
+        CryptoStore.cryptofile_id == file.id,
+        CryptoStore.sequence >= sequence,
+    ).delete(synchronize_session=False)
+    return sequence, position
+
+
+def discard_files(file_ids, bind=None):
+    """
+    Delete the CryptoFile rows of file_ids and their chunk rows. Chunk files
+    of their own are left for collect_garbage, chunks within a segment are
+    only reclaimed when they were the last written to it.
+    """
+    bind = bind or session
+    for ids in batched(file_ids, ID_BATCH_SIZE):
+        bind.query(CryptoStore).filter(
+            CryptoStore.cryptofile_id.in_(ids),
+        ).delete(synchronize_session=False)
+        bind.query(CryptoFile).filter(
+            CryptoFile.id.in_(ids),
+        ).delete(synchronize_session=False)
+
+
+def loose_chunk_filenames(cypher, bind=None):
+    """
+    Unseal the filename of every chunk stored in a file of its own.
+
+    :param cypher: MasterKey
+    :return: set of str relative to the output directory, or None when a
+             file holding such chunks was sealed by another master key so its
+             chunk files cannot be told apart from garbage
+    """
+    bind = bind or session
+    names = set()
+    file_ids = [
+        row[0] for row in bind.query(CryptoStore.cryptofile_id).filter(
+            CryptoStore.filename.isnot(None),
+        ).distinct()]
+    for ids in batched(file_ids, ID_BATCH_SIZE):
+        for file in bind.query(CryptoFile).filter(CryptoFile.id.in_(ids)):
+            if not password_matches(file, cypher):
+                return None
+            if (file.format_version or FORMAT_HEX) < FORMAT_SEALED:
+                chunks = unseal_chunks(file, query_chunks(bind, file), cypher)
+                names.update(c.filename for c in chunks if c.filename)
+                continue
+            sealed = bind.query(CryptoStore.filename).filter(
+                CryptoStore.cryptofile_id == file.id,
+                CryptoStore.filename.isnot(None),
+            ).distinct()
+            names.update(cypher.unseal(f).decode() for f, in sealed)
+    return names
+
+
+def collect_garbage(cypher, directory=DEFAULT_OUTPUT_DIRECTORY, bind=None):
+    """
+    Remove what interrupted stores left in the output directory: segments no
+    chunk row refers to, bytes appended to a segment after the last chunk
+    committed to it and chunk files of their own no row refers to. Only
+    names allocated by allocate_location are considered, chunk files are
+    left alone when some could belong to another master key. Must not run
+    while anything is being stored.
+
+    :param cypher: MasterKey
+    :return: GarbageTotals of files removed and bytes freed
+    """
+    bind = bind or session
+    directory = get_path(directory)
+    ends = dict(bind.query(
+        CryptoStore.segment_id,
+        func.max(CryptoStore.segment_offset + CryptoStore.segment_length),
+    ).filter(
+        CryptoStore.segment_id.isnot(None),
+    ).group_by(CryptoStore.segment_id))
+    referenced = set()
+    orphans = []
+    freed = 0
+    for segment in bind.query(CryptoSegment):
+        end = ends.get(segment.id)
+        if end is None:
+            orphans.append(segment.filename)
+            bind.delete(segment)
+            continue
+        referenced.add(segment.filename)
+        location = directory / segment.filename
+        if location.exists() and location.stat().st_size > end:
+            freed += location.stat().st_size - end
+            os.truncate(location, end)
+    loose = loose_chunk_filenames(cypher, bind)
+    commit(bind)
+    removed = [directory / filename for filename in orphans]
+    if loose is not None:
+        referenced.update(loose)
+        removed.extend(
+            location for location in directory.rglob('*')
+            if len(location.name) == 32 and
+            set(location.name) <= set(string.hexdigits) and
+            location.is_file() and
+            location.relative_to(directory).as_posix() not in referenced
+        )
+    files = 0
+    for location in set(removed):
+        if location.exists():
+            freed += location.stat().st_size
+            location.unlink()
+            files += 1
+    return GarbageTotals(files, freed)
+
+
+def compare_stored(file, entry):
+    """
+    Compare a stored file against the WalkEntry of its location on disk, size
+    and modified time are trusted when they match.
+
+    :return: True when unchanged, False when changed and None when only the
+             checksum of the contents can tell
+    """
+    if file is None or file.is_dir or file.checksum is None:
+        return False
+    if file.filesize != entry.size:
+        return False
+    if file.mtime == entry.mtime:
+        return True
+    return None
+
+
+class ChunkIndex:
+    """
+    Fingerprints of the chunks already stored, used by content defined
+    chunking to reference a stored chunk rather than write it again. Chunks
+    recorded but not yet inserted are held in pending, anything inserted is
+    found through the fingerprint index of CryptoStore.
+    """
+    pending = None
+    bind = None
+
+    def get(self, fingerprint):
+        """
+        :param fingerprint: str keyed checksum of the plain text of a chunk
+        :return: dict of the columns locating the stored chunk or None
+        """
+        if fingerprint in self.pending:
+            return self.pending[fingerprint]
+        columns = [getattr(CryptoStore, c) for c in CHUNK_REFERENCE_COLUMNS]
+        found = (self.bind or session).query(*columns).filter(
+            CryptoStore.fingerprint == fingerprint,
+            CryptoStore.public_key.isnot(None),
+            CryptoStore.segment_length.isnot(None) |
+            CryptoStore.filename.isnot(None),
+        ).first()
+        if found is None:
+            return None
+        return dict(zip(CHUNK_REFERENCE_COLUMNS, found))
+
+    def add(self, fingerprint, row):
+        self.pending[fingerprint] = {
+            c: row[c] for c in CHUNK_REFERENCE_COLUMNS}
+
+    def inserted(self):
+        """
+        Forget pending chunks once their rows are in the database.
+        """
+        self.pending = {}
+
+    def __init__(self, bind=None):
+        self.pending = {}
+        self.bind = bind
+
+
+def index_chunks(windows, cypher, index=None):
+    """
+    Pair each window with its fingerprint and, when index is given, the
+    stored chunk it duplicates in which case the window itself is dropped.
+
+    :return: generator of tuples of window, fingerprint and reference
+    """
+    for window in windows:
+        if index is None:
+            yield window, None, None
+            continue
+        checksum = cypher.checksum()
+        checksum.update(window)
+        fingerprint = checksum.hexdigest()
+        reference = index.get(fingerprint)
+        yield None if reference else window, fingerprint, reference
+
+
+def choose_chunk_size(filesize, chunk_size=None):
+    """
+    Size policy of fixed chunking, files are cut into about
+    CHUNK_TARGET_COUNT chunks of a power of two length between
+    CHUNK_MIN_LENGTH and CHUNK_MAX_LENGTH, so small files keep small chunks
+    while the rows of a large file stay proportionate to it.
+
+    :param filesize: int length of the file
+    :param chunk_size: int length chosen by the user, used when given
+    :return: int chunk length in bytes
+    """
+    if chunk_size:
+        return chunk_size
+    target = (filesize or 0) // CHUNK_TARGET_COUNT
+    length = CHUNK_MIN_LENGTH
+    while length < target and length < CHUNK_MAX_LENGTH:
+        length *= 2
+    return length
+
+
+def batch_length(chunk_size=None):
+    """
+    :param chunk_size: int length of fixed chunks, None for content defined
+    :return: int number of chunks handed to a worker at a time, batches of
+             large chunks being kept within WORKER_BATCH_BYTES
+    """
+    if not chunk_size:
+        return WORKER_BATCH_LENGTH
+    return max(min(WORKER_BATCH_LENGTH, WORKER_BATCH_BYTES // chunk_size), 1)
+
+
+def build_file(
+    cypher, password_iv, filename, is_dir, filesize, mtime, file_key=None,
+    chunk_size=None, run_id=None,
+):
+    """
+    Create the CryptoFile recording a stored file, its test copy is sealed by
+    cypher so the master password can be checked before restoring, as is the
+    data key of file_key when its chunks are encrypted by one.
+    """
     test_copy = get_encryptable_password()
-    file = CryptoFile(
+    data_key = None
+    if file_key is not None:
+        data_key = cypher.seal(file_key.key)
+    return CryptoFile(
         # public_key=password_key,
         private_key=password_iv,
         test_copy=test_copy,
-        test_encrypted=cypher.encrypt(test_copy).hex(),
-        filename=location.name,
-        is_dir=location.is_dir(),
+        test_encrypted=cypher.seal(test_copy),
+        filename=filename,
+        is_dir=is_dir,
+        format_version=FORMAT_VERSION,
+        filesize=filesize,
+        mtime=mtime,
+        data_key=data_key,
+        chunk_size=chunk_size,
+        run_id=run_id,
     )
-    session.add(file)
-    session.commit()
-    files = []
-    if location.is_file():
-        read = read_location(location).hex()
-        length = len(read)
-        i = 0
-        iv456 = md5(str(Password()).encode()).hexdigest()[:16]
-        for i in range(ceil(length / byte_length)):
-            password_store = get_encryptable_password()
-            password = md5(password_store.encode()).hexdigest()
-            file_location = get_available_filename()
-            text_value = read[i * byte_length: (i + 1) * byte_length]
-            text_length = len(text_value)
-            if len(text_value) < byte_length:
-                text_value += ''.join(['0'] * (byte_length - len(text_value)))
-            aes_object = AES.new(password, AES.MODE_CBC, iv456)
-            write_location(file_location, aes_object.encrypt(text_value).hex())
-            file_store = CryptoStore(
-                public_key=cypher.encrypt(password_store).hex(),
-                private_key=cypher.encrypt(iv456).hex(),
-                filename=cypher.encrypt(file_location.name).hex(),
-                filesize=text_length,
-                cryptofile=file
-            )
-            files.append(file_store)
-            session.add(file_store)
-    if files:
-        session.commit()
-    return file
+
+
+def new_file_key(chunking):
+    """
+    Chunks of content defined chunking may be referenced by other files, so
+    each keeps a password of its own, otherwise every chunk of a file is
+    encrypted by a single data key.
+
+    :return: FileKey or None
+    """
+    if chunking == CHUNKING_CONTENT:
+        return None
+    return FileKey()
+
+
+def new_iv456():
+    return md5(str(Password()).encode()).hexdigest()[:16]
+
+
+def write_chunk(item, chunk, sequence, cypher, writer=None, position=None):
+    """
+    Write the cipher text of an encrypted chunk to the segments of writer, or
+    a file of its own without one, and build its CryptoStore row. A chunk
+    referencing one already stored is only recorded.
+
+    :param item: tuple of window, fingerprint and reference from index_chunks
+    :param chunk: tuple from encrypt_windows or None for a reference
+    :param sequence: int position of the chunk within its file
+    :param position: int offset of the chunk within the plain text of its file
+    :return: dict of column values, without cryptofile_id
+    """
+    window, fingerprint, reference = item
+    file_store = {
+        'public_key': None,
+        'private_key': None,
+        'filename': None,
+        'filesize': None,
+        'segment_id': None,
+        'segment_offset': None,
+        'segment_length': None,
+        'sequence': sequence,
+        'position': position,
+        'fingerprint': fingerprint,
+        'codec': None,
+        'checksum': None,
+    }
+    if reference:
+        file_store.update(reference)
+        return file_store
+    public_key, private_key, encrypted, filesize, used, mac = chunk
+    file_store['public_key'] = public_key
+    file_store['private_key'] = private_key
+    file_store['filesize'] = filesize
+    file_store['codec'] = used
+    file_store['checksum'] = mac
+    if writer:
+        segment_id, offset, length = writer.write(encrypted)
+        file_store['segment_id'] = segment_id
+        file_store['segment_offset'] = offset
+        file_store['segment_length'] = length
+    else:
+        file_location = get_available_filename()
+        write_location(file_location, encrypted, write_bytes=True)
+        file_store['filename'] = cypher.seal(
+            get_relative_filename(file_location))
+    return file_store
 
 
 def dencrypt_hash(data, cypher):
     pass
 
 
-def encrypt_detailed_location(details, aes_pass, password_key, password_iv):
-    detail_files = []
-    for key in details.keys():
-        path = details[key]
-        if type(path) is dict:
-            encrypt_detailed_location(path)
+class FileJob:
+    """
+    A file travelling through a StorePipeline. Batches of its chunks are
+    encrypted and written in any order, the commit stage counts them in and
+    the file is complete once chunks, known when reading finishes, arrived.
+    A file resumed from an interrupted run continues its CryptoFile from the
+    sequence and position of its last chunk committed in order.
+    """
+    entry = None
+    stored = None
+    verify = False
+    unchanged = False
+    file = None
+    file_id = None
+    queued = False
+    iv456 = None
+    file_key = None
+    checksum = None
+    chunks = None
+    received = 0
+    resume = None
+    sequence = 0
+    position = 0
+
+    def __init__(self, entry, stored=None, verify=False, resume=None):
+        self.entry = entry
+        self.stored = stored
+        self.verify = verify
+        if resume is not None:
+            self.resume, self.sequence, self.position = resume
+            self.file_id = self.resume.id
+            self.queued = True
+            self.received = self.sequence
+
+
+class StorePipeline:
+    """
+    Store the files of a walk through a Pipeline of stages connected by
+    bounded queues: readers threads read and fingerprint files into batches
+    of chunks, the batches are encrypted across workers, a WorkerPool, with a
+    thread per job feeding it, writers threads append the cipher text to
+    the segments of writer and a single commit stage, owning a database
+    session of its own, inserts the rows and commits batch_size rows at a
+    time. A file is recorded with its checksum once all of its chunks are
+    committed, the live version it replaces is retired in the same
+    transaction so only one version of a filename is ever live. The
+    WalkEntry of every file committed, or found unchanged, is collected in
+    committed.
+
+    Every run is journaled as a StoreRun. With resume the last run
+    interrupted is continued: files it completed are skipped, files it was
+    storing continue from their last chunk committed in order when unchanged
+    on disk and are discarded otherwise, and the garbage it left in the
+    output directory is collected before anything is written.
+
+    Example use: `StorePipeline(master, password_iv, writer=writer).run(walk)`
+    """
+    cypher = None
+    password_iv = None
+    writer = None
+    workers = None
+    batch_size = CHUNK_BATCH_SIZE
+    incremental = False
+    resume = False
+    resumed = False
+    run_id = None
+    garbage = None
+    partials = None
+    abandoned = None
+    chunking = CHUNKING_FIXED
+    chunk_size = None
+    codec = None
+    readers = DEFAULT_READERS
+    writers = DEFAULT_WRITERS
+    queue_size = PIPELINE_QUEUE_SIZE
+    manifest = None
+    index = None
+    index_session = None
+    db = None
+    files = None
+    rows = None
+    complete = None
+    committed = None
+    walk_errors = ()
+
+    def jobs(self, details):
+        """
+        Walk stage, run in the calling thread, turning each WalkEntry needing
+        to be stored into a FileJob. The live version of a file is replaced
+        and retired whether or not the run is incremental, a full run only
+        skips files a resumed run already stored.
+        """
+        for entry in details:
+            if [s for s in IGNORE_LIST if s in entry.location.name]:
+                continue
+            stored = self.manifest.pop(entry.path, None)
+            unchanged = compare_stored(stored, entry)
+            if not self.incremental and not (
+                    stored is not None and stored.run_id == self.run_id):
+                unchanged = False
+            resume = self.partials.pop(entry.path, None)
+            if resume is not None:
+                file = resume[0]
+                if (not unchanged and file.filesize == entry.size and
+                        file.mtime == entry.mtime):
+                    yield FileJob(entry, stored, resume=resume)
+                    continue
+                self.abandoned.append(file.id)
+            if unchanged:
+                self.committed.append(entry)
+                continue
+            yield FileJob(entry, stored, verify=unchanged is None)
+
+    def read(self, job):
+        """
+        Read stage, stream a file into batches of chunks. The last batch of a
+        file is only handed on once the number of chunks and checksum of the
+        file are known.
+        """
+        entry = job.entry
+        if job.verify:
+            checksum = file_checksum(entry.location, self.cypher)
+            if checksum == job.stored.checksum:
+                job.unchanged = True
+                job.chunks = 0
+                yield StoreBatch(job, 0, 0, [])
+                return
+        chunking = self.chunking
+        if job.resume is None:
+            job.file_key = new_file_key(chunking)
+            chunk_size = None
+            if chunking != CHUNKING_CONTENT:
+                chunk_size = choose_chunk_size(entry.size, self.chunk_size)
+            job.file = build_file(
+                self.cypher, self.password_iv, entry.path, False, entry.size,
+                entry.mtime, file_key=job.file_key, chunk_size=chunk_size,
+                run_id=self.run_id,
+            )
+        else:
+            chunk_size = job.resume.chunk_size
+            if not chunk_size:
+                chunking = CHUNKING_CONTENT
+            if job.resume.data_key:
+                job.file_key = FileKey(self.cypher.unseal(job.resume.data_key))
+        if job.file_key is None:
+            job.iv456 = new_iv456()
+        checksum = self.cypher.checksum()
+        checksum_prefix(entry.location, checksum, job.position)
+        index = None
+        if chunking == CHUNKING_CONTENT:
+            index = self.index
+            windows = read_content_chunks(
+                entry.location, offset=job.position)
+        else:
+            windows = read_windows(
+                entry.location, chunk_size, offset=job.position)
+        items = index_chunks(
+            copy_windows(windows, checksum), self.cypher, index)
+        sequence = job.sequence
+        position = job.position
+        previous = None
+        batches = instrument.iterate(
+            'store.read', batched(items, batch_length(chunk_size)),
+            size=lambda b: sum(len(w) for w, _, _ in b if w is not None))
+        for batch in batches:
+            if previous is not None:
+                yield previous
+            previous = StoreBatch(job, sequence, position, batch)
+            sequence += len(batch)
+            position += sum(
+                len(window) if window is not None else reference['filesize']
+                for window, _, reference in batch
+            )
+        if self.index_session is not None:
+            self.index_session.remove()
+        job.checksum = checksum.hexdigest()
+        job.chunks = sequence
+        yield previous or StoreBatch(job, 0, 0, [])
+
+    def encrypt(self, batch):
+        """
+        Encrypt stage, pairing each item of a batch with its encrypted chunk.
+        """
+        if not batch.items:
+            return [batch]
+        encrypt = partial(
+            encrypt_windows, iv456=batch.job.iv456, master=self.cypher,
+            codec=self.codec, file_key=batch.job.file_key,
+            sequence=batch.sequence,
+        )
+        with instrument.measure('store.encrypt', items=len(batch.items)):
+            chunks = self.workers.run(
+                encrypt, [window for window, _, _ in batch.items])
+        return [batch._replace(items=list(zip(batch.items, chunks)))]
+
+    def write(self, batch):
+        """
+        Write stage, writing the cipher text of a batch and turning its items
+        into rows. The writer is flushed so no row is committed before the
+        chunk it locates has reached the segment file.
+        """
+        rows = []
+        position = batch.position
+        with instrument.measure('store.write', items=len(batch.items)):
+            for offset, (item, chunk) in enumerate(batch.items):
+                row = write_chunk(
+                    item, chunk, batch.sequence + offset, self.cypher,
+                    self.writer, position=position,
+                )
+                position += row['filesize']
+                if self.index is not None and item[1] and not item[2]:
+                    self.index.add(item[1], row)
+                rows.append(row)
+            if self.writer:
+                self.writer.flush()
+        return [batch._replace(items=rows)]
+
+    def commit(self, batch):
+        """
+        Commit stage, collect the rows of a batch and flush once batch_size
+        rows or completed files are waiting.
+        """
+        job = batch.job
+        if not job.unchanged and not job.queued:
+            job.queued = True
+            self.files.append(job)
+        self.rows.extend((job, row) for row in batch.items)
+        job.received += len(batch.items)
+        if job.chunks is not None and job.received == job.chunks:
+            self.complete.append(job)
+        if len(self.rows) + len(self.complete) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Insert the files and rows collected by the commit stage and record the
+        files completed as a single transaction.
+        """
+        with instrument.measure('store.commit', items=len(self.rows)):
+            self.record()
+        if self.index is not None:
+            self.index.inserted()
+        self.files = []
+        self.rows = []
+        self.complete = []
+
+    def record(self):
+        db = self.db
+        now = datetime.now()
+        retired = []
+        completed = 0
+        for job in self.complete:
+            self.committed.append(job.entry)
+            if job.unchanged:
+                db.query(CryptoFile).filter(
+                    CryptoFile.id == job.stored.id,
+                ).update({'mtime': job.entry.mtime}, synchronize_session=False)
+                continue
+            completed += 1
+            if job.stored is not None:
+                retired.append(job.stored.id)
+            if job.file_id is None:
+                job.file.checksum = job.checksum
+                continue
+            db.query(CryptoFile).filter(
+                CryptoFile.id == job.file_id,
+            ).update({'checksum': job.checksum}, synchronize_session=False)
+        for job in self.files:
+            db.add(job.file)
+        db.flush()
+        for job in self.files:
+            job.file_id = job.file.id
+            job.file = None
+        bulk_insert(
+            CryptoStore,
+            [dict(row, cryptofile_id=job.file_id) for job, row in self.rows],
+            bind=db,
+        )
+        retire_files(retired, now, bind=db)
+        db.query(StoreRun).filter(StoreRun.id == self.run_id).update({
+            'files': StoreRun.files + completed,
+            'chunks': StoreRun.chunks + len(self.rows),
+        }, synchronize_session=False)
+        commit(db)
+        db.expunge_all()
+
+    def start_run(self):
+        """
+        Journal a new run, or with resume reopen the last run interrupted and
+        find where each of its incomplete files resumes. A run is only resumed
+        with the master key every one of its files was stored with.
+        """
+        db = self.db
+        now = datetime.now()
+        run = None
+        if self.resume:
+            run = db.query(StoreRun).filter(
+                StoreRun.finished_at.is_(None),
+            ).order_by(StoreRun.id.desc()).first()
+        self.resumed = run is not None
+        if run is not None:
+            files = db.query(CryptoFile).filter(CryptoFile.run_id == run.id)
+            if not all(password_matches(file, self.cypher) for file in files):
+                raise Exception(
+                    'Run {} was stored with another password, it can not be '
+                    'resumed.'.format(run.id))
+        if run is None:
+            run = StoreRun(
+                started_at=now, resumes=0, incremental=self.incremental,
+                chunking=self.chunking, chunk_size=self.chunk_size,
+                codec=self.codec, files=0, chunks=0,
+            )
+            db.add(run)
         else:
-            file = encrypt_location(path, aes_pass, password_key, password_iv)
-            if file and path.is_file():
-                detail_files.append(file)
-            # elif key == '.':
-            #     current_dir = file
-    # for file in detail_files:
-    #     file.directory = current_dir
-    session.commit()
+            run.resumed_at = now
+            run.resumes = (run.resumes or 0) + 1
+        db.flush()
+        self.run_id = run.id
+        self.partials = {}
+        self.abandoned = []
+        if self.resumed:
+            for filename, file in get_partials(self.run_id).items():
+                self.partials[filename] = (file,) + resume_point(file, db)
+        commit(db)
+        self.manifest = get_manifest()
+        if self.resumed:
+            self.garbage = collect_garbage(self.cypher, bind=db)
+
+    def finish_run(self):
+        """
+        Discard the incomplete files of a resumed run which could not be
+        resumed, when incremental retire the files no longer present, and
+        record the run finished. Files below a directory the walk failed to
+        list are not known to be gone and stay live.
+        """
+        db = self.db
+        discard_files(
+            self.abandoned + [f.id for f, _, _ in self.partials.values()],
+            bind=db,
+        )
+        if self.incremental:
+            retire_files(
+                [
+                    stored.id for filename, stored in self.manifest.items()
+                    if not is_below(filename, self.walk_errors)
+                ],
+                datetime.now(), bind=db,
+            )
+        db.query(StoreRun).filter(StoreRun.id == self.run_id).update(
+            {'finished_at': datetime.now()}, synchronize_session=False)
+        commit(db)
+
+    def run(self, details):
+        """
+        Store every file of details, an iterable of WalkEntry. When
+        incremental only files new or changed since the last store are
+        stored, files no longer present are retired once the walk is done.
+        """
+        self.files = []
+        self.rows = []
+        self.complete = []
+        self.committed = []
+        self.index = None
+        self.index_session = None
+        if self.chunking == CHUNKING_CONTENT:
+            self.index_session = scoped_session(Session)
+            self.index = ChunkIndex(bind=self.index_session)
+        self.db = Session()
+        try:
+            self.start_run()
+            Pipeline([
+                Stage('read', self.read, workers=self.readers),
+                Stage('encrypt', self.encrypt, workers=self.workers.jobs),
+                Stage('write', self.write, workers=self.writers),
+                Stage('commit', self.commit, finish=self.flush),
+            ], queue_size=self.queue_size).run(self.jobs(details))
+            self.finish_run()
+        finally:
+            self.db.close()
 
+    def __init__(
+        self, cypher, password_iv, writer=None, workers=None,
+        batch_size=CHUNK_BATCH_SIZE, incremental=False,
+        chunking=CHUNKING_FIXED, codec=None, readers=DEFAULT_READERS,
+        writers=DEFAULT_WRITERS, queue_size=PIPELINE_QUEUE_SIZE,
+        chunk_size=None, resume=False, walk_errors=None,
+    ):
+        self.cypher = cypher
+        self.password_iv = password_iv
+        self.writer = writer
+        self.workers = workers or WorkerPool(jobs=1)
+        self.batch_size = max(batch_size or CHUNK_BATCH_SIZE, 1)
+        self.incremental = incremental
+        self.chunking = chunking
+        self.codec = codec
+        self.readers = readers
+        self.writers = writers
+        self.queue_size = queue_size
+        self.chunk_size = chunk_size
+        self.resume = resume
+        self.walk_errors = () if walk_errors is None else walk_errors
 
-def main():
+
+def is_below(path, directories):
+    """
+    :param path: str path relative to the walked directory
+    :param directories: iterable of str relative paths, '' being the walked
+                        directory itself
+    :return: bool True when path lies below any of directories
+    """
+    return any(
+        not directory or path.startswith(directory + '/')
+        for directory in directories
+    )
+
+
+def retire_files(file_ids, retired_at, bind=None):
+    """
+    Mark the CryptoFile rows of file_ids retired, a few hundred at a time to
+    stay within the SQLite limit of bound parameters.
+    """
+    for ids in batched(file_ids, ID_BATCH_SIZE):
+        (bind or session).query(CryptoFile).filter(
+            CryptoFile.id.in_(ids),
+        ).update({'retired_at': retired_at}, synchronize_session=False)
+
+
+def encrypt_detailed_location(
+    details, aes_pass, password_key, password_iv, writer=None, workers=None,
+    batch_size=CHUNK_BATCH_SIZE, incremental=False, chunking=CHUNKING_FIXED,
+    codec=None, readers=DEFAULT_READERS, writers=DEFAULT_WRITERS,
+    queue_size=PIPELINE_QUEUE_SIZE, chunk_size=None, resume=False,
+    walk_errors=None,
+):
+    """
+    Encrypt every file of details, an iterable of WalkEntry, under its path
+    relative to the walked directory through a StorePipeline. The versions
+    replaced are retired. When incremental only files new or changed since
+    the last store are encrypted and files no longer present are retired,
+    except below the directories of walk_errors the walk could not list.
+    A shared writer must allocate segments with allocate_committed_segment.
+    Fixed chunks are chunk_size bytes long, chosen per file when not given.
+    With resume the last run interrupted is continued.
+
+    :return: StorePipeline run
+    """
+    pipeline = StorePipeline(
+        aes_pass, password_iv, writer=writer, workers=workers,
+        batch_size=batch_size, incremental=incremental, chunking=chunking,
+        codec=codec, readers=readers, writers=writers, queue_size=queue_size,
+        chunk_size=chunk_size, resume=resume, walk_errors=walk_errors,
+    )
+    pipeline.run(details)
+    return pipeline
+
+
+def store_input(
+    aes_pass, password_key, password_iv, jobs=None, pool=POOL_PROCESS,
+    wipe=False, wipe_with=WIPE_PATTERN, **options
+):
+    """
+    Store the input directory as the store mode of the CLI, options are
+    passed on to encrypt_detailed_location. With wipe the input files this
+    run committed, or found unchanged, are wiped once they are stored, files
+    changed or created since they were walked are kept.
+
+    :return: StorePipeline which stored the input directory
+    """
+    walk_errors = []
+    location_details = instrument.iterate(
+        'diskio.walk',
+        walk_location(DEFAULT_INPUT_DIRECTORY, errors=walk_errors),
+        size=lambda entry: entry.size)
+    with SegmentWriter(allocate_committed_segment) as writer, \
+            WorkerPool(jobs=jobs, pool=pool) as workers:
+        pipeline = encrypt_detailed_location(
+            location_details, aes_pass, password_key, password_iv,
+            writer=writer, workers=workers, walk_errors=walk_errors,
+            **options)
+    if walk_errors:
+        print('Could not walk {} directories, their files were not '
+              'stored.'.format(len(walk_errors)))
+    if pipeline.resumed:
+        print('Resumed run {}, collected {} files, {} bytes.'.format(
+            pipeline.run_id, *pipeline.garbage))
+    if wipe:
+        wiped = remove_disk_contents(
+            [DEFAULT_INPUT_DIRECTORY], jobs=jobs, mode=wipe_with,
+            keep_root=True, entries=pipeline.committed,
+        )
+        print('Wiped {} files, {} bytes.'.format(*wiped))
+    return pipeline
+
+
+def read_stored_range(aes_pass, filename, offset, length):
+    """
+    Write a byte range of a stored file to standard output as the partial
+    restore mode of the CLI.
+    """
+    db = Session()
+    try:
+        file = find_file(db, filename)
+        if file is None:
+            raise Exception('File not stored: {}.'.format(filename))
+        data = read_range(
+            file, offset, length, aes_pass, DEFAULT_OUTPUT_DIRECTORY,
+            session=db,
+        )
+    finally:
+        db.close()
+    stream = sys.stdout.buffer
+    stream.write(data)
+    stream.flush()
+
+
+def list_chunks(names, limit=10):
+    """
+    :return: str of the first limit chunk names followed by the total count
+    """
+    listed = ', '.join(str(name) for name in names[:limit])
+    if len(names) > limit:
+        listed += ', ...'
+    return '{} ({} in total)'.format(listed, len(names))
+
+
+def verify_store(aes_pass, jobs=None):
+    """
+    Verify every chunk of the store as the verify mode of the CLI, printing
+    the chunks missing or corrupt of each file.
+
+    :return: bool True when no chunk is missing or corrupt and any file was
+             sealed by the master key
+    """
+    reports = verify_files(aes_pass, DEFAULT_OUTPUT_DIRECTORY, jobs=jobs)
+    skipped = len([r for r in reports if not r.matched])
+    reports = [r for r in reports if r.matched]
+    missing = 0
+    corrupt = 0
+    for report in reports:
+        if report.missing:
+            print('Missing chunks of {}: {}'.format(
+                report.filename, list_chunks(report.missing)))
+        if report.corrupt:
+            print('Corrupt chunks of {}: {}'.format(
+                report.filename, list_chunks(report.corrupt)))
+        missing += len(report.missing)
+        corrupt += len(report.corrupt)
+    print(
+        'Verified {} files, {} chunks: {} missing, {} corrupt, {} without a '
+        'MAC.'.format(
+            len(reports), sum(r.chunks for r in reports), missing, corrupt,
+            sum(r.unchecked for r in reports),
+        ))
+    if skipped:
+        print('Skipped {} files sealed by another password.'.format(skipped))
+    return not missing and not corrupt and bool(reports or not skipped)
+
+
+@click.command()
+@click.option(
+    '--jobs', default=DEFAULT_JOBS, show_default=True,
+    help='Number of workers encrypting chunks, restoring or verifying files.')
+@click.option(
+    '--pool', type=click.Choice(POOL_TYPES), default=POOL_PROCESS,
+    show_default=True, help='Run workers as processes or threads.')
+@click.option(
+    '--batch-size', default=CHUNK_BATCH_SIZE, show_default=True,
+    help='Number of chunk rows inserted into the database at a time.')
+@click.option(
+    '--incremental/--full', default=False, show_default=True,
+    help='Only store files new or changed since the last store.')
+@click.option(
+    '--resume/--no-resume', default=False, show_default=True,
+    help='Continue the last store interrupted rather than start over.')
+@click.option(
+    '--chunking', type=click.Choice(CHUNKING_TYPES), default=CHUNKING_FIXED,
+    show_default=True,
+    help='Cut files into fixed size or deduplicated content defined chunks.')
+@click.option(
+    '--chunk-size', type=click.IntRange(min=1), default=None,
+    help='Bytes per fixed size chunk, by default chosen from the size of '
+         'each file.')
+@click.option(
+    '--compression', type=click.Choice(CODEC_TYPES), default=CODEC_NONE,
+    show_default=True,
+    help='Compress each chunk before encryption when it shrinks the chunk.')
+@click.option(
+    '--readers', default=DEFAULT_READERS, show_default=True,
+    help='Number of threads reading files while storing.')
+@click.option(
+    '--writers', default=DEFAULT_WRITERS, show_default=True,
+    help='Number of threads writing chunks while storing.')
+@click.option(
+    '--queue-size', default=PIPELINE_QUEUE_SIZE, show_default=True,
+    help='Number of batches of chunks waiting between stages of a store.')
+@click.option(
+    '--wipe/--keep', default=False, show_default=True,
+    help='Securely wipe the input files once they are stored.')
+@click.option(
+    '--wipe-with', type=click.Choice(WIPE_TYPES), default=WIPE_PATTERN,
+    show_default=True,
+    help='Overwrite wiped files with the aubergine pattern or random bytes.')
+@click.option(
+    '--profile/--no-profile', default=False, show_default=True,
+    help='Print the time, bytes and counts of every stage of the run, work '
+         'done in worker processes only shows as time waited on them.')
+@click.option(
+    '--profile-json', default=None,
+    help='Write the stage totals of the run as JSON to a file.')
+@click.option(
+    '--profile-stats', default=None,
+    help='Write cProfile stats of every thread of the run to a file.')
+def main(
+    jobs, pool, batch_size, incremental, resume, chunking, chunk_size,
+    compression, readers, writers, queue_size, wipe, wipe_with, profile,
+    profile_json, profile_stats,
+):
     """
     Main method for application.
     """
@@ -119,42 +1149,46 @@ def main():
     password = click.prompt('Password', hide_input=True)
     password_key = md5(password.encode()).hexdigest()
     password_iv = md5(AES_IV456_AUTHENTICATION.encode()).hexdigest()[:16]
-    aes_pass = AES.new(password_key, AES.MODE_CBC, password_iv)
-    crypt_type = click.prompt('Store / Retrieve? [s/r]')
-    if crypt_type == 's':
-        location_details = detail_location('./input/')
-        encrypt_detailed_location(
-            location_details, aes_pass, password_key, password_iv)
-    elif crypt_type == 'r':
-        output = get_path('./restore')
-        output.mkdir(exist_ok=True)
-        all_files = session.query(CryptoFile).all()
-        for file in all_files:
-            tested = aes_pass.decrypt(file.test_encrypted)
-            """
-            # Matches of decrypting do not pass
-            # Encryption of same copy does not match stored
-            # Test password 'lolliepop'
-
-            (Pdb) aes_pass.decrypt(file.test_encrypted)
-            b'\xfd U\xbe\xec\xed\xe7n\x01?\x7f\xe4\x8b\xfa\x9b\xb4\xee\x1e\t\x8d\x02\xaa#\x83\x8f\xd6c+\x94t\x04\xa9\xdf5\x02=\xc8\x07\xc8>u\xab\xf7CSP\xfe:#\xd5/0\xc1f\x04y\x0e\r\x07\xc2WP\xb4\x86#\xd3\xce\x82\xb3&\x0b\xb0\x16\xbe\xd0\xea3\x8f\xe9D\x16\x10I\xe58\x1aj\xd0\xe8u\xe7\xcd1G\\(\x92u\rn\xa1\xf5K9-\xc5\n&\xf31V\xc6,\xfd%\x1d\xfa\xd5zfu\x9b\xf9\x00&v\xc4P5\xc3\xec\x0b\x90^$ZS\x16 \t:\r\xbf\xb3\x9f\x9a\xbb\xb3T\xc3Y\x0e\xa0;\xfc\x1cS\xce\xd8\x15gVf\'\xff\xa7\xc2^\xb8F\xcf\xd9n\xf2\xc7\xaeY\x9f\xdc\xc8\x84_G\xeb\xc7:\x81\x0b\xb6\xd1<\xc4`<w\x82\xc2Et\xac\xaa9O/\x0e*\xc7)8\x1c\x1dH\xd4\xc9\x0b\x06\xe4iuO(\x14b\xb9L\x07,\x12\x98\xa5z\x91\x88\x00\x17\x07\xf9.\x95U\x8d\xc9\x95\xb3\xe8\xf0n\xd4\xf0\xe8\x98m\xdb\xe5\xaa\xdd`U\xaa\xfc\x8d*\xc7\xb1_\xa2\x94/\x94\xd2\x9fE\x1c!o\x06\xeb\xd2\xca\xbe\xc7\xe64<\x0e\x8b\x0c\x14\xfcTu\xbe\x1e\xb7\xc3\x06\xa7V{\xdf7\xd6\x93\x11z=\xdc"\xbe\xe3c\xcd\xa1d\xda\xd6r\x97\x7f\x9a;\xdf\xffw\xb1\x13\xf7\x01\xac\xf0]yK\x80\xf85\xfb?\xcc\xaei\x87\xc0\x9ffl\xc8\x84\xcb\x93\xc0\xdf\x12\xe2#\x9d[\xf4\xf3x\xdc|\xaa\xbd\xd8\x88Z\x06\x1b\\\x9c,\xed\x94\xaf\x85\x9b:\xb7\xac\x14\x08\xe6\xfd'
-            (Pdb) aes_pass.encrypt(file.test_copy)
-            b'\rntH\xf3\xaa(T6\x84\xc8\xbb=\xb9\xae*\xde6\xa2\xfb2\xe37m\xc6\x0f\x1d\x02\xdb\xbc\xa3\x1c\xbb\x9b\x1d\xe2S\x81\x04\x94\xaa=\xde\x85\x82\xea\xfbN\x1f\x866U\x06Y`\xafu\xa5\xc2\xca\xaf\xc6\x11)PL\x98\xe7\x9dw\x81\xc3\x1d\xc27\xd7S\x8c\xb3\x9d\x82\xa5\xaa^e(\xca\xe2+\xd4\x07k\xd0\x82\xd6w\x1e:\x03T\xdf\xd3\xbf\xeb>3\xeb\xfa\xbb\x97\x90\xa5\xba\xf6\x08\x01>\x91\x18\x10\xcbO\x81Pi{\xe0\xcaCf\xd9 F\x129M/\x9c\x9aE\x050\xe9\xcb\x82xR0\xc5\x1eW\xc83\xe9\x1a\xf2\rw\xe8\xf7k5\xd6\x8c\x01Q\xa1\xd9\xb0\x89@\xe4\x940\r\xdd+\xef\x7f\xb6\x04ixn\xabxSE\xd9\x11\xbf\xfa'
-            (Pdb) file.test_encrypted
-            '7ba7b9460e027c305e5256020d7e52ef3658e2127b762f65fe43df357902fa36fe31a25d37415be747536efb50e403e37903e1fe181a7a1982e663f60ab0a4c3bfbe9a884f251dea9aa7309b2418282601c4809e23c43e323b6e5ec481be5b3abf74e4711585c60afe5c229018e836e91f8f89a84c3dd8f60d54e361210e086faab66857704cc686c0d247ce0f017bea3f16fe61f4cc164cac6fb1eac04ecaedb8d5d1bbbefd8df3a3bdb3e21f36e7236e1d4eb1f358d21afbd6d8e5647060f0'
-            (Pdb)
-            """
-            import pdb; pdb.set_trace()
-            if tested != file.test_copy:
-                continue
-            path = get_path(
-                '{}/{}'.format(DEFAULT_OUTPUT_DIRECTORY, file.filename))
-            output_path = get_path('{}/{}'.format(output, file.filename))
-            add_output = output_path.open(mode='a')
-            add_output.write()
-            write_location(output_path, read_location(path).hex())
-        # session.query(CryptoStore).filter_by(cryptofile_id=4).all()
-        import pdb; pdb.set_trace()
+    aes_pass = MasterKey(password_key, password_iv)
+    crypt_type = click.prompt('Store / Retrieve / Partial / Verify? [s/r/p/v]')
+    profiling = profile or profile_json or profile_stats
+    if profiling:
+        instrument.start(profile=bool(profile_stats))
+    try:
+        with instrument.profile_thread():
+            if crypt_type == 's':
+                store_input(
+                    aes_pass, password_key, password_iv, jobs=jobs,
+                    pool=pool, batch_size=batch_size, incremental=incremental,
+                    resume=resume, chunking=chunking, chunk_size=chunk_size,
+                    codec=compression, readers=readers, writers=writers,
+                    queue_size=queue_size, wipe=wipe, wipe_with=wipe_with,
+                )
+            elif crypt_type == 'r':
+                restored = restore_files(
+                    aes_pass, DEFAULT_OUTPUT_DIRECTORY,
+                    DEFAULT_RESTORE_DIRECTORY, jobs=jobs,
+                )
+                print('Restored {} files.'.format(len(restored)))
+            elif crypt_type == 'p':
+                read_stored_range(
+                    aes_pass,
+                    click.prompt('Stored filename'),
+                    click.prompt('Offset', type=int, default=0),
+                    click.prompt('Length', type=int),
+                )
+            elif crypt_type == 'v':
+                if not verify_store(aes_pass, jobs=jobs):
+                    sys.exit(1)
+    finally:
+        if profiling:
+            instrument.stop()
+            if profile:
+                print(instrument.summary())
+            if profile_json:
+                instrument.dump_json(profile_json)
+            if profile_stats:
+                instrument.dump_stats(profile_stats)
 
 
 if __name__ == '__main__':
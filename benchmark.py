@@ -0,0 +1,525 @@
+"""
+Copyright 2019 (c) GlibGlob Ltd.
+Author: Laurence Psychic
+Email: vesper.porta@protonmail.com
+
+Measure the throughput of the hot paths of VesperCrypt so a change can be
+compared against the code it replaces. Synthetic input trees are generated in
+a scratch directory, each is stored, restored and wiped in a process of its
+own so the peak RSS reported belongs to that phase alone, and micro
+benchmarks time password, alphabet and token generation and content defined
+chunking. Results can be written as JSON and compared against an earlier
+run.
+"""
+
+import click
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from hashlib import md5
+from random import choice, Random
+
+from cryptochunk import CODEC_NONE, CODEC_TYPES
+from diskio import (
+    CDC_AVERAGE_LENGTH, CDC_MAX_LENGTH, CDC_MIN_LENGTH, CHUNKING_FIXED,
+    CHUNKING_TYPES, content_mask, find_content_cut, read_content_chunks,
+    remove_disk_contents,
+)
+from password import Alphabet, Password, alphabet_table
+from workers import POOL_PROCESS, POOL_TYPES
+
+
+BENCHMARK_PASSWORD = 'benchmark'
+BENCHMARK_VERSION = 1
+MIB = 1024 * 1024
+DATA_RANDOM = 'random'
+DATA_TEXT = 'text'
+DATA_TYPES = [DATA_RANDOM, DATA_TEXT, ]
+FILES_PER_DIRECTORY = 100
+SCENARIOS = {
+    # name: (number of files, bytes per file, data type)
+    'small_random': (2000, 4 * 1024, DATA_RANDOM),
+    'small_text': (2000, 4 * 1024, DATA_TEXT),
+    'large_random': (2, 8 * MIB, DATA_RANDOM),
+    'large_text': (2, 8 * MIB, DATA_TEXT),
+}
+TEXT_WORDS = (
+    'vesper crypt chunk segment store restore cipher password alphabet '
+    'aubergine master key sealed file directory manifest index batch'
+).split()
+PHASES = ['store', 'restore', 'wipe', ]
+CHUNKING_LENGTH = 8 * MIB
+MICRO_GROUPS = ['passwords', 'alphabets', 'tokens', 'chunking', ]
+
+
+def timed(function, *args, **kwargs):
+    """
+    Call function and measure the wall time it took.
+
+    :return: tuple of seconds taken and the result of function
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def peak_rss():
+    """
+    Peak resident set size in KiB of this process or any of its children
+    waited for, worker processes included once their pool is shut down.
+    """
+    return max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+def text_block(length=MIB, seed=0):
+    """
+    A block of compressible text made of a handful of repeating words.
+    """
+    chooser = Random(seed)
+    words = []
+    size = 0
+    while size <= length:
+        word = chooser.choice(TEXT_WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return ' '.join(words).encode()[:length]
+
+
+def generate_tree(directory, count, size, data_type):
+    """
+    Write count files of size bytes of data_type below directory, grouped
+    FILES_PER_DIRECTORY to a subdirectory, one block of data is built and
+    written repeatedly so generating a large tree needs little memory.
+
+    :return: int total bytes written
+    """
+    block_length = min(max(size, 1), MIB)
+    block = text_block(block_length)
+    total = 0
+    for number in range(count):
+        location = os.path.join(
+            directory, 'd{:04d}'.format(number // FILES_PER_DIRECTORY))
+        os.makedirs(location, exist_ok=True)
+        with open(os.path.join(location, 'f{:06d}'.format(number)), 'wb') \
+                as stream:
+            written = 0
+            while written < size:
+                length = min(block_length, size - written)
+                if data_type == DATA_RANDOM:
+                    stream.write(os.urandom(length))
+                else:
+                    stream.write(block[:length])
+                written += length
+        total += size
+    return total
+
+
+def run_phase(function, *args):
+    """
+    Run function in a forked process of its own, measuring the wall and CPU
+    time and the peak RSS of that process alone.
+
+    :return: dict returned by function with the measurements added
+    """
+    context = multiprocessing.get_context('fork')
+    receive, send = context.Pipe(duplex=False)
+    process = context.Process(
+        target=phase_process, args=(send, function, args))
+    process.start()
+    send.close()
+    result = receive.recv()
+    process.join()
+    if 'error' in result:
+        raise Exception('Benchmark phase failed: {}.'.format(result['error']))
+    return result
+
+
+def phase_process(connection, function, args):
+    try:
+        start = time.perf_counter()
+        cpu = time.process_time()
+        result = function(*args)
+        result['seconds'] = time.perf_counter() - start
+        result['cpu_seconds'] = time.process_time() - cpu
+        result['peak_rss_kib'] = peak_rss()
+    except Exception as e:
+        result = {'error': repr(e)}
+    connection.send(result)
+    connection.close()
+
+
+def get_master():
+    """
+    The MasterKey of the benchmark password, derived as the CLI does.
+    """
+    from app import AES_IV456_AUTHENTICATION
+    from cryptochunk import MasterKey
+    password_key = md5(BENCHMARK_PASSWORD.encode()).hexdigest()
+    password_iv = md5(AES_IV456_AUTHENTICATION.encode()).hexdigest()[:16]
+    return MasterKey(password_key, password_iv), password_key, password_iv
+
+
+def count_rows():
+    from storage import CryptoStore, Session
+    count_session = Session()
+    try:
+        return count_session.query(CryptoStore).count()
+    finally:
+        count_session.close()
+
+
+def store_phase(workspace, options):
+    """
+    Store the input tree of workspace as the store mode of the CLI does, the
+    application is only imported here once within the workspace as its
+    database lives relative to the working directory.
+    """
+    os.chdir(workspace)
+    from app import (
+        SegmentWriter, WorkerPool, walk_location, encrypt_detailed_location,
+        allocate_committed_segment,
+    )
+    master, password_key, password_iv = get_master()
+    with SegmentWriter(allocate_committed_segment) as writer, \
+            WorkerPool(jobs=options['jobs'], pool=options['pool']) as workers:
+        encrypt_detailed_location(
+            walk_location('input'), master, password_key, password_iv,
+            writer=writer, workers=workers, chunking=options['chunking'],
+            codec=options['compression'],
+            chunk_size=options.get('chunk_size'),
+        )
+    return {'rows': count_rows()}
+
+
+def restore_phase(workspace, options):
+    os.chdir(workspace)
+    from restore import restore_files
+    master, password_key, password_iv = get_master()
+    restored = restore_files(master, 'output', 'restore', jobs=options['jobs'])
+    return {'files': len(restored), 'rows': count_rows()}
+
+
+def wipe_phase(workspace, options):
+    os.chdir(workspace)
+    wiped = remove_disk_contents(['input'], jobs=options['jobs'])
+    return {'files': wiped.files, 'bytes': wiped.bytes}
+
+
+def benchmark_scenario(directory, count, size, data_type, options):
+    """
+    Generate a tree of count files of size bytes and time storing, restoring
+    and wiping it.
+
+    :return: dict of measurements of each phase
+    """
+    workspace = tempfile.mkdtemp(prefix='vespercrypt-', dir=directory)
+    try:
+        os.makedirs(os.path.join(workspace, 'output'))
+        total = generate_tree(
+            os.path.join(workspace, 'input'), count, size, data_type)
+        results = {}
+        for phase, function in zip(
+                PHASES, [store_phase, restore_phase, wipe_phase]):
+            result = run_phase(function, workspace, options)
+            seconds = result['seconds'] or 1e-9
+            result['mb_s'] = total / MIB / seconds
+            result['files_s'] = count / seconds
+            if 'rows' in result:
+                result['rows_s'] = result['rows'] / seconds
+            results[phase] = result
+        output = os.path.join(workspace, 'output')
+        results['store']['stored_bytes'] = sum(
+            os.path.getsize(os.path.join(path, name))
+            for path, _, names in os.walk(output) for name in names)
+        results['input_bytes'] = total
+        return results
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+
+def legacy_generate(length, character_details):
+    """
+    The character by character loop Password.generate used before passwords
+    were sampled in bulk, kept as the baseline to compare against.
+    """
+    rtn = ''
+    count = 0
+    while count < length:
+        rtn += choice(character_details)
+        count += 1
+    return rtn
+
+
+def benchmark_passwords(count, length=64):
+    """
+    Compare generating count passwords one at a time with the old loop, one
+    at a time with Password and all at once with Password.generate_many.
+
+    :return: dict of passwords per second for each approach
+    """
+    character_details = list(Alphabet().detail())
+    legacy, _ = timed(
+        lambda: [legacy_generate(length, character_details)
+                 for i in range(count)])
+    single, _ = timed(
+        lambda: [str(Password(length=length)) for i in range(count)])
+    bulk, _ = timed(Password.generate_many, count, length)
+    return {
+        'legacy_loop': count / legacy,
+        'password': count / single,
+        'generate_many': count / bulk,
+    }
+
+
+def benchmark_alphabets(count):
+    """
+    Time Alphabet.detail answered from the table cache and built cold.
+
+    :return: dict of calls per second
+    """
+    cached, _ = timed(lambda: [Alphabet().detail() for i in range(count)])
+    cold_count = max(count // 1000, 1)
+
+    def cold():
+        for i in range(cold_count):
+            alphabet_table.cache_clear()
+            Alphabet(Alphabet.EXTENDED_ALPHABETS).detail()
+
+    cold_seconds, _ = timed(cold)
+    return {
+        'detail_cached': count / cached,
+        'detail_cold': cold_count / cold_seconds,
+    }
+
+
+def benchmark_chunking(directory, length=CHUNKING_LENGTH):
+    """
+    Time cutting length bytes of random data into content defined chunks as
+    a store does, reading a file scanned in bulk for candidate cuts, and the
+    byte at a time gear hash alone without the candidates.
+
+    :return: dict of bytes per second
+    """
+    data = os.urandom(length)
+    workspace = tempfile.mkdtemp(prefix='vespercrypt-', dir=directory)
+    try:
+        location = os.path.join(workspace, 'chunked')
+        with open(location, 'wb') as stream:
+            stream.write(data)
+        bulk, _ = timed(lambda: sum(1 for _ in read_content_chunks(location)))
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+    mask = content_mask(CDC_AVERAGE_LENGTH)
+
+    def scalar():
+        start = 0
+        while start < len(data):
+            start = find_content_cut(
+                data, start, CDC_MIN_LENGTH, CDC_MAX_LENGTH, mask,
+                final=True)
+
+    scalar_seconds, _ = timed(scalar)
+    return {
+        'content_chunks': length / bulk,
+        'content_cut_scalar': length / scalar_seconds,
+    }
+
+
+def token_phase(workspace, count):
+    """
+    Time the TokenManager operations within workspace, validation is timed
+    cold, loading each token from the database, and hot, answered from the
+    token cache. An operation which cannot run is recorded with its error
+    rather than a rate. Each operation returns the number it performed.
+    """
+    os.chdir(workspace)
+    from cryptotoken import TokenManager
+    manager = TokenManager()
+    results = {}
+    tokens = []
+    single_use = []
+
+    def generate():
+        for i in range(count):
+            manager.generate_sha256(str(i))
+        return count
+
+    def create():
+        for i in range(count):
+            token = manager.create_random(single_use=False)
+            tokens.append((token.key, manager.get_value(token)))
+        for i in range(count):
+            token = manager.create_random()
+            single_use.append((token.key, manager.get_value(token)))
+        manager.cache.clear()
+        return count * 2
+
+    def validate(pairs):
+        if not pairs:
+            raise Exception('No tokens were created to validate.')
+        for key, value in pairs:
+            if not manager.validation(key, value):
+                raise Exception('Token failed to validate.')
+        return len(pairs)
+
+    operations = [
+        ('generate_sha256', generate),
+        ('create_random', create),
+        ('create_many', lambda: len(manager.create_many(count))),
+        ('validation_cold', lambda: validate(tokens)),
+        ('validation_hot', lambda: validate(tokens)),
+        ('validation_single_use', lambda: validate(single_use)),
+        ('sweep', manager.sweep),
+    ]
+    for name, operation in operations:
+        try:
+            seconds, performed = timed(operation)
+            results[name] = performed / seconds
+        except Exception as e:
+            results[name] = {'error': repr(e)}
+    return {'rates': results}
+
+
+def benchmark_tokens(directory, count):
+    """
+    Run token_phase in a scratch workspace of its own, as tokens are kept in
+    the database of the working directory.
+
+    :return: dict of operations per second or errors
+    """
+    workspace = tempfile.mkdtemp(prefix='vespercrypt-', dir=directory)
+    try:
+        os.makedirs(os.path.join(workspace, 'output'))
+        return run_phase(token_phase, workspace, count)['rates']
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+
+def compare_results(baseline, results, path=()):
+    """
+    Yield the relative change of every rate in results against baseline,
+    rates being the measurements named per second.
+
+    :return: generator of tuples of name and ratio of results to baseline
+    """
+    for key, value in results.items():
+        old = baseline.get(key) if isinstance(baseline, dict) else None
+        if isinstance(value, dict):
+            yield from compare_results(old or {}, value, path + (key,))
+        elif isinstance(value, float) and isinstance(old, float) and old:
+            if key.endswith('_s') or path[:1] in [(g,) for g in MICRO_GROUPS]:
+                yield '.'.join(path + (key,)), value / old
+
+
+@click.command()
+@click.option(
+    '--count', default=100000, show_default=True,
+    help='Number of passwords generated by each approach.')
+@click.option(
+    '--length', default=64, show_default=True,
+    help='Character length of each password.')
+@click.option(
+    '--scenario', 'scenarios', type=click.Choice(list(SCENARIOS)),
+    multiple=True, help='Scenario to run, default all of them.')
+@click.option(
+    '--scale', default=1.0, show_default=True,
+    help='Multiply the number of files of every scenario.')
+@click.option(
+    '--jobs', default=os.cpu_count() or 1, show_default=True,
+    help='Number of workers storing, restoring and wiping.')
+@click.option(
+    '--pool', type=click.Choice(POOL_TYPES), default=POOL_PROCESS,
+    show_default=True, help='Run workers as processes or threads.')
+@click.option(
+    '--chunking', type=click.Choice(CHUNKING_TYPES), default=CHUNKING_FIXED,
+    show_default=True, help='Chunking used to store.')
+@click.option(
+    '--chunk-size', type=click.IntRange(min=1), default=None,
+    help='Bytes per fixed size chunk, default chosen per file.')
+@click.option(
+    '--compression', type=click.Choice(CODEC_TYPES), default=CODEC_NONE,
+    show_default=True, help='Codec used to store.')
+@click.option(
+    '--micro/--no-micro', default=True, show_default=True,
+    help='Run the password, alphabet, token and chunking micro benchmarks.')
+@click.option(
+    '--directory', default=None,
+    help='Scratch directory for synthetic trees, default the system temp.')
+@click.option(
+    '--output', default=None, help='Write the results as JSON to a file.')
+@click.option(
+    '--compare', default=None, help='JSON results of a run to compare to.')
+def main(
+    count, length, scenarios, scale, jobs, pool, chunking, chunk_size,
+    compression, micro, directory, output, compare,
+):
+    """
+    Run the benchmarks and print their results.
+    """
+    options = {
+        'jobs': jobs,
+        'pool': pool,
+        'chunking': chunking,
+        'chunk_size': chunk_size,
+        'compression': compression,
+        'scale': scale,
+    }
+    results = {
+        'version': BENCHMARK_VERSION,
+        'created_at': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'options': options,
+        'scenarios': {},
+    }
+    for name in scenarios or SCENARIOS:
+        files, size, data_type = SCENARIOS[name]
+        files = max(int(files * scale), 1)
+        measured = benchmark_scenario(
+            directory, files, size, data_type, options)
+        results['scenarios'][name] = measured
+        for phase in PHASES:
+            result = measured[phase]
+            print('{:<14}{:<9}{:>9.2f} MB/s{:>10.0f} files/s{:>10.0f} '
+                  'rows/s{:>9.0f} MiB RSS'.format(
+                      name, phase, result['mb_s'], result['files_s'],
+                      result.get('rows_s', 0),
+                      result['peak_rss_kib'] / 1024))
+    if micro:
+        results['passwords'] = benchmark_passwords(count, length=length)
+        results['alphabets'] = benchmark_alphabets(count)
+        results['tokens'] = benchmark_tokens(
+            directory, max(count // 100, 1))
+        results['chunking'] = benchmark_chunking(directory)
+        for group in MICRO_GROUPS:
+            unit = 'B/s' if group == 'chunking' else '/s'
+            for name, rate in results[group].items():
+                if isinstance(rate, dict):
+                    print('{:<24}{}'.format(name, rate['error']))
+                    continue
+                print('{:<24}{:>14,.0f} {}'.format(name, rate, unit))
+        print('generate_many is {:.1f}x the legacy loop'.format(
+            results['passwords']['generate_many'] /
+            results['passwords']['legacy_loop']))
+    if compare:
+        with open(compare) as stream:
+            baseline = json.load(stream)
+        for name, ratio in compare_results(baseline, results):
+            print('{:<48}{:>+8.1%}'.format(name, ratio - 1))
+    if output:
+        with open(output, 'w') as stream:
+            json.dump(results, stream, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,362 @@
+"""
+Copyright 2019 (c) GlibGlob Ltd.
+Author: Laurence Psychic
+Email: vesper.porta@protonmail.com
+
+Describe how a single chunk of a file is encrypted and laid out on disk. Each
+CryptoFile records the format version its chunks were written with so stores
+written by an earlier version of VesperCrypt remain restorable.
+"""
+
+import bz2
+import hmac
+import lzma
+import os
+import zlib
+from hashlib import md5, sha256
+from Crypto.Cipher import AES
+
+from instrument import instrument
+from password import Password
+
+
+FORMAT_HEX = 1
+FORMAT_BINARY = 2
+FORMAT_SEALED = 3
+FORMAT_FILE_KEY = 4
+FORMAT_VERSION = FORMAT_FILE_KEY
+AES_BLOCK_LENGTH = 16
+DATA_KEY_LENGTH = 32
+CODEC_NONE = 'none'
+CODECS = {
+    'zlib': (zlib.compress, zlib.decompressobj),
+    'lzma': (lzma.compress, lzma.LZMADecompressor),
+    'bz2': (bz2.compress, bz2.BZ2Decompressor),
+}
+CODEC_TYPES = [CODEC_NONE, ] + list(CODECS.keys())
+
+
+def get_encryptable_password():
+    password_store = str(Password())
+    while len(password_store.encode()) % 16:
+        password_store = get_encryptable_password()
+    return password_store
+
+
+def pad_block(data):
+    """
+    Pad data with zero bytes up to the next AES block boundary, the real length
+    of the data is kept alongside the chunk so the padding can be trimmed.
+
+    :param data: bytes
+    :return: bytes
+    """
+    remainder = len(data) % AES_BLOCK_LENGTH
+    if not remainder:
+        return bytes(data)
+    return bytes(data) + bytes(AES_BLOCK_LENGTH - remainder)
+
+
+def pad_value(value):
+    """
+    PKCS#7 pad a value to be sealed, unlike chunks the length of a sealed value
+    is not stored anywhere else.
+
+    :param value: bytes
+    :return: bytes
+    """
+    length = AES_BLOCK_LENGTH - len(value) % AES_BLOCK_LENGTH
+    return value + bytes([length] * length)
+
+
+def unpad_value(value):
+    """
+    Remove the PKCS#7 padding added by pad_value.
+
+    :param value: bytes
+    :return: bytes
+    """
+    return value[:-value[-1]] if value else value
+
+
+class MasterKey:
+    """
+    The key and IV derived from the master password, used to seal the
+    metadata of each chunk. From format 3 every value is sealed by a cipher of
+    its own with a random IV kept in front of the cipher text so values can be
+    unsealed independently and in any order.
+
+    Example use: `master = MasterKey(password_key, password_iv)`
+    """
+    key = None
+    iv = None
+
+    def cipher(self, iv=None):
+        """
+        Create a new AES cipher for the master key.
+
+        :param iv: bytes optional IV, default the master IV
+        :return: Crypto.Cipher.AES
+        """
+        return AES.new(self.key, AES.MODE_CBC, iv or self.iv)
+
+    def seal(self, value):
+        """
+        :param value: str or bytes
+        :return: bytes IV followed by the cipher text
+        """
+        if type(value) is str:
+            value = value.encode()
+        iv = os.urandom(AES_BLOCK_LENGTH)
+        return iv + self.cipher(iv).encrypt(pad_value(value))
+
+    def unseal(self, value):
+        """
+        :param value: bytes produced by seal
+        :return: bytes
+        """
+        iv = value[:AES_BLOCK_LENGTH]
+        value = value[AES_BLOCK_LENGTH:]
+        return unpad_value(self.cipher(iv).decrypt(value))
+
+    def checksum(self):
+        """
+        Create a keyed SHA256 HMAC for checksums of stored content, keyed by a
+        key derived from the master key so checksums reveal nothing of the
+        plain text to anyone without the master password.
+
+        :return: hmac.HMAC
+        """
+        key = sha256(b'checksum' + self.key).digest()
+        return hmac.new(key, digestmod=sha256)
+
+    def chunk_mac(self, data):
+        """
+        Keyed SHA256 HMAC of the cipher text of a chunk, recorded with the
+        chunk so it can be verified without being decrypted. Keyed apart from
+        checksum as it covers cipher text rather than plain text.
+
+        :param data: bytes cipher text
+        :return: str hex digest
+        """
+        key = sha256(b'chunk' + self.key).digest()
+        with instrument.measure('chunk.mac', size=len(data), items=1):
+            return hmac.new(key, data, sha256).hexdigest()
+
+    def unseal_chained(self, values, previous=None):
+        """
+        Unseal values written by stores before format 3, which sealed every
+        value of a run with one CBC cipher so each value carried on the chain
+        from the last block of the value sealed before it. Only the first value
+        depends on previous, the master IV unless known, any later value in
+        values is unsealed exactly.
+
+        :param values: iterable of bytes in the order they were sealed
+        :param previous: bytes last block sealed before the first value
+        :return: generator of bytes
+        """
+        previous = previous or self.iv
+        for value in values:
+            yield self.cipher(previous).decrypt(value)
+            previous = value[-AES_BLOCK_LENGTH:]
+
+    def __init__(self, key, iv):
+        self.key = key.encode() if type(key) is str else key
+        self.iv = iv.encode() if type(iv) is str else iv
+
+
+class FileKey:
+    """
+    The data key of a single file, from format 4 every chunk of a file not
+    shared with other files is encrypted by the one key with an IV derived
+    from the sequence of the chunk, so no key material is stored per chunk.
+    IVs are an HMAC of the sequence under a key derived from the data key,
+    unpredictable without the data key and never repeated within a file.
+
+    Example use: `file_key = FileKey(); file_key.encrypt(data, sequence)`
+    """
+    key = None
+    iv_key = None
+
+    def iv(self, sequence):
+        """
+        :param sequence: int position of the chunk within its file
+        :return: bytes
+        """
+        return hmac.new(
+            self.iv_key, sequence.to_bytes(8, 'big'), sha256,
+        ).digest()[:AES_BLOCK_LENGTH]
+
+    def cipher(self, sequence):
+        return AES.new(self.key, AES.MODE_CBC, self.iv(sequence))
+
+    def encrypt(self, data, sequence):
+        with instrument.measure('chunk.aes', size=len(data), items=1):
+            return self.cipher(sequence).encrypt(pad_block(data))
+
+    def decrypt(self, data, sequence):
+        return self.cipher(sequence).decrypt(bytes(data))
+
+    def __init__(self, key=None):
+        if key is None:
+            key = os.urandom(DATA_KEY_LENGTH)
+        elif len(key) != DATA_KEY_LENGTH:
+            # A data key unsealed by the wrong master key is not a key.
+            raise Exception('Invalid data key of {} bytes.'.format(len(key)))
+        self.key = key
+        self.iv_key = sha256(b'iv' + self.key).digest()
+
+
+def get_chunk_cipher(password_store, iv456):
+    """
+    Create the AES cipher for a single chunk from its stored password and IV.
+
+    :param password_store: str password generated for the chunk
+    :param iv456: str 16 character initialisation vector
+    :return: Crypto.Cipher.AES
+    """
+    if type(password_store) is bytes:
+        password_store = password_store.decode()
+    if type(iv456) is bytes:
+        iv456 = iv456.decode()
+    with instrument.measure('chunk.key', items=1):
+        password = md5(password_store.encode()).hexdigest()
+        return AES.new(password.encode(), AES.MODE_CBC, iv456.encode())
+
+
+def encrypt_chunk(data, password_store, iv456):
+    """
+    Encrypt a chunk of plain bytes in the current format version.
+
+    :param data: bytes, at most one chunk of plain text
+    :param password_store: str password generated for the chunk
+    :param iv456: str 16 character initialisation vector
+    :return: bytes cipher text ready to be written to disk
+    """
+    aes_object = get_chunk_cipher(password_store, iv456)
+    with instrument.measure('chunk.aes', size=len(data), items=1):
+        return aes_object.encrypt(pad_block(data))
+
+
+def compress_chunk(data, codec=None):
+    """
+    Compress a chunk with codec when that makes it smaller, chunks which do
+    not shrink, such as those already compressed or random, are kept as they
+    are.
+
+    :param data: bytes, one chunk of plain text
+    :param codec: str name of a codec in CODECS or None
+    :return: tuple of the codec used or None and the bytes to encrypt
+    """
+    if not codec or codec == CODEC_NONE:
+        return None, data
+    with instrument.measure('chunk.compress', size=len(data), items=1):
+        compressed = CODECS[codec][0](data)
+    if len(compressed) >= len(data):
+        return None, data
+    return codec, compressed
+
+
+def decompress_chunk(data, codec=None):
+    """
+    Reverse compress_chunk, data may carry trailing block padding which the
+    decompressor leaves unused past the end of the compressed stream.
+    """
+    if not codec:
+        return data
+    return CODECS[codec][1]().decompress(data)
+
+
+def encrypt_windows(
+    windows, iv456, master, codec=None, file_key=None, sequence=0
+):
+    """
+    Encrypt a batch of windows, this is the unit of work handed to a
+    WorkerPool so it must remain picklable. With file_key each window is
+    encrypted by the data key of its file, windows being the chunks from
+    sequence onwards, and no key material is returned. Otherwise each window
+    is encrypted with a newly generated password sealed by the master key,
+    passwords for the batch are generated together and need no block aligned
+    length as sealing pads them.
+
+    :param windows: list of bytes, each at most one chunk of plain text, or
+                    None for a chunk already stored which is returned as None
+    :param iv456: str 16 character initialisation vector
+    :param master: MasterKey
+    :param codec: str name of a codec to try on each window before encrypting
+    :param file_key: FileKey of the file the windows belong to
+    :param sequence: int sequence of the first window within its file
+    :return: list of tuples of sealed password, sealed IV, cipher text, plain
+             text length, codec used and MAC of the cipher text, the sealed
+             values being None with file_key
+    """
+    rtn = []
+    if file_key is not None:
+        for offset, window in enumerate(windows):
+            if window is None:
+                rtn.append(None)
+                continue
+            used, payload = compress_chunk(window, codec)
+            encrypted = file_key.encrypt(payload, sequence + offset)
+            rtn.append((
+                None, None, encrypted, len(window), used,
+                master.chunk_mac(encrypted),
+            ))
+        return rtn
+    passwords = iter(Password.generate_many(
+        len([w for w in windows if w is not None])))
+    for window in windows:
+        if window is None:
+            rtn.append(None)
+            continue
+        password_store = next(passwords)
+        used, payload = compress_chunk(window, codec)
+        encrypted = encrypt_chunk(payload, password_store, iv456)
+        with instrument.measure('chunk.seal', items=2):
+            sealed = master.seal(password_store), master.seal(iv456)
+        rtn.append(sealed + (
+            encrypted, len(window), used, master.chunk_mac(encrypted)))
+    return rtn
+
+
+def decrypt_file_chunk(data, file_key, sequence, filesize, codec=None):
+    """
+    Decrypt a chunk encrypted by the data key of its file.
+
+    :param data: bytes read from disk
+    :param file_key: FileKey of the owning CryptoFile
+    :param sequence: int position of the chunk within its file
+    :param filesize: int length of the chunk before padding
+    :param codec: str name of the codec the chunk was compressed with
+    :return: bytes
+    """
+    with instrument.measure('chunk.decrypt', size=len(data), items=1):
+        plain = decompress_chunk(file_key.decrypt(data, sequence), codec)
+        return plain[:filesize]
+
+
+def decrypt_chunk(
+    data, password_store, iv456, filesize, version=None, codec=None
+):
+    """
+    Decrypt a chunk read from disk back into the plain bytes of the file.
+
+    Format 1 chunks were hex text of hex encoded plain text padded with '0'
+    characters and filesize counted hex characters, format 2 chunks are the raw
+    cipher text of the plain bytes and filesize counts bytes.
+
+    :param data: bytes read from the chunk file
+    :param password_store: str password generated for the chunk
+    :param iv456: str 16 character initialisation vector
+    :param filesize: int length of the chunk before padding
+    :param version: int format version of the owning CryptoFile
+    :param codec: str name of the codec the chunk was compressed with
+    :return: bytes
+    """
+    aes_object = get_chunk_cipher(password_store, iv456)
+    with instrument.measure('chunk.decrypt', size=len(data), items=1):
+        if (version or FORMAT_HEX) == FORMAT_HEX:
+            plain = aes_object.decrypt(bytes.fromhex(data.decode()))
+            return bytes.fromhex(plain[:filesize].decode())
+        plain = decompress_chunk(aes_object.decrypt(bytes(data)), codec)
+        return plain[:filesize]
@@ -1,7 +1,9 @@
 """Tokenisation of objects for simple authentication."""
 
-import random
+import hmac
+import threading
 
+from collections import OrderedDict, namedtuple
 from datetime import timedelta, datetime
 from Crypto.Cipher import AES
 from Crypto.Hash import SHA256
@@ -10,22 +12,117 @@ from sqlalchemy import Table, Column, Integer, Unicode, Binary, DateTime, Boolea
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 
+from password import sample_characters
+from storage import Session, bulk_insert, engine, upgrade_schema
+
 
 HASH_FIELD_ALPHABET = 'abcdefghijklmnopqrstuvwxyz1234567890'
 HASH_FIELD_ALPHABET += 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
 HASH_FIELD_ALPHABET += '1234567890'
 AES_KEY_AUTHENTICATION = 'XH5dFRNwUfPCJo9mB0ErcGDjT3Yi8q4V'
 AES_IV456_AUTHENTICATION = 'm80uUNH4qo5eyFXD'
+AES_BLOCK_LENGTH = 16
 TOKEN_RANDOM_KEY_LENGTH = 32
 TOKEN_RANDOM_VALUE_LENGTH = 64
 TOKEN_SALT_START = 'Kx(62Q~o0kjRyl|_sr1<*z8+.HN>b/5ci4LtMqmT,Y3@^`fJEh'
 TOKEN_SALT_END = 'HDQcA&yv<^Chf2u*L>wJ]BOtW;K=9$x8Zl?Viz!7,3Xp[1.:0s'
+TOKEN_EXPIRY = timedelta(days=1)
+TOKEN_CACHE_SIZE = 4096
+TOKEN_CACHE_TTL = timedelta(minutes=1)
+TOKEN_SWEEP_BATCH_SIZE = 500
+TOKEN_SWEEP_INTERVAL = 60
+
+TokenState = namedtuple(
+    'TokenState', ['id', 'key', 'value', 'single_use', 'validated', 'expiry'])
 
 
 Base = declarative_base()
 
 
+def normalise_value(token_value):
+    """Values are stored padded with spaces, so trailing whitespace is not
+    part of a value when it is created, read or presented.
+
+    @:param token_value: str value of a token.
+
+    @:return str
+    """
+    return str(token_value).rstrip()
+
+
+class TokenCache:
+    """Bounded LRU of the decrypted state of live tokens by key.
+
+    An entry is evicted once its token expires or it has been cached for ttl,
+    whichever comes first, so changes made by another TokenManager are seen
+    within ttl. Safe to share between threads.
+    """
+
+    def get(self, key, now=None):
+        """Find the cached state of a token, refreshing its recent use.
+
+        @:param key: str token key.
+        @:param now: datetime to test expiry against, default now.
+
+        @:return TokenState or None
+        """
+        now = now or datetime.now()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            state, evict_at = entry
+            if evict_at <= now:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return state
+
+    def put(self, state, now=None):
+        """Cache the state of a token until its expiry or for ttl.
+
+        @:param state: TokenState.
+        @:param now: datetime the state was read, default now.
+        """
+        now = now or datetime.now()
+        evict_at = min(state.expiry, now + self.ttl)
+        if evict_at <= now:
+            return
+        with self.lock:
+            self.entries[state.key] = (state, evict_at)
+            self.entries.move_to_end(state.key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __init__(self, size=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL):
+        self.size = max(size, 1)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+
 class TokenManager:
+    """Issue and validate tokens stored through a session.
+
+    Validation is served from a TokenCache of decrypted token state, the
+    database is only read when a key is not cached and only written when the
+    state of a token changes: first validated, consumed or expired. A manager
+    holds a session so each thread should use a manager of its own, a cache
+    may be shared between them.
+    """
+    session = None
+    cache = None
 
     def get_cipher(self):
         """Create AES cipher to manage the storage of values.
@@ -33,9 +130,9 @@ class TokenManager:
         @:return Crypto.cipher.AES
         """
         return AES.new(
-            AES_KEY_AUTHENTICATION,
+            AES_KEY_AUTHENTICATION.encode(),
             AES.MODE_CBC,
-            AES_IV456_AUTHENTICATION,
+            AES_IV456_AUTHENTICATION.encode(),
         )
 
     def get_value(self, token):
@@ -46,7 +143,18 @@ class TokenManager:
         @:returns str
         """
         aes_object = self.get_cipher()
-        return aes_object.decrypt(bytes(token.value)).rstrip()
+        return normalise_value(aes_object.decrypt(bytes(token.value)).decode())
+
+    def encrypt_value(self, token_value):
+        """Encrypt a value padded with spaces to the AES block length.
+
+        @:param token_value: str value to store.
+
+        @:return bytes
+        """
+        value = token_value.encode()
+        value += b' ' * (-len(value) % AES_BLOCK_LENGTH)
+        return self.get_cipher().encrypt(value)
 
     def generate_sha256(self, seed=None):
         """Generate a random hexadecimal str, 2 salts are used.
@@ -62,6 +170,23 @@ class TokenManager:
         sha_hash.update(hashing.encode('utf-8'))
         return sha_hash.hexdigest()
 
+    def generate_random(self, n=1):
+        """Generate random keys and values in bulk from the OS CSPRNG.
+
+        @:param n: int number of key value pairs.
+
+        @:return list of tuples of str key and str value
+        """
+        length = TOKEN_RANDOM_KEY_LENGTH + TOKEN_RANDOM_VALUE_LENGTH
+        characters = sample_characters(HASH_FIELD_ALPHABET, n * length)
+        return [
+            (
+                characters[i:i + TOKEN_RANDOM_KEY_LENGTH],
+                characters[i + TOKEN_RANDOM_KEY_LENGTH:i + length],
+            )
+            for i in range(0, n * length, length)
+        ]
+
     def create_random(self, expiry=None, single_use=True):
         """Generate a token based on a random key and value.
 
@@ -70,27 +195,55 @@ class TokenManager:
 
         @:return Token
         """
+        token_key, token_value = self.generate_random()[0]
         return self.create_token(
-            ''.join(
-                [
-                    random.choice(HASH_FIELD_ALPHABET)
-                    for i in range(TOKEN_RANDOM_KEY_LENGTH)
-                ]
-            ),
-            token_value=''.join(
-                [
-                    random.choice(HASH_FIELD_ALPHABET)
-                    for i in range(TOKEN_RANDOM_VALUE_LENGTH)
-                ]
-            ),
+            token_key,
+            token_value=token_value,
             expiry=expiry,
             single_use=single_use,
         )
 
+    def create_many(self, n, expiry=None, single_use=True):
+        """Mint n random tokens inserted together in a single transaction.
+
+        Keys are fresh random values so, unlike create_token, no earlier token
+        of the same key is looked for. The tokens are not cached, each is read
+        from the database when first validated.
+
+        @:param n: int number of tokens.
+        @:param expiry: datetime the tokens will expire.
+        @:param single_use: bool determines a one off use.
+
+        @:return list of tuples of str key and str value
+        """
+        now = datetime.now()
+        pairs = self.generate_random(n)
+        bulk_insert(Token, [
+            {
+                'key': token_key,
+                'value': self.encrypt_value(token_value),
+                'expiry': expiry or now + TOKEN_EXPIRY,
+                'single_use': single_use,
+                'validated': False,
+                'created_at': now,
+                'modified_at': now,
+            }
+            for token_key, token_value in pairs
+        ], bind=self.session)
+        self.session.commit()
+        return pairs
+
+    def sweep(self, now=None, batch_size=TOKEN_SWEEP_BATCH_SIZE):
+        """Delete expired and consumed tokens, see sweep_tokens.
+
+        @:return int
+        """
+        return sweep_tokens(self.session, now=now, batch_size=batch_size)
+
     def create_token(
         self, token_key, token_value=None, expiry=None, single_use=True
     ):
-        """Create a token.
+        """Create a token, any unvalidated token of the same key is deleted.
 
         @:param token_key: str the key to identify this Token by.
         @:param token_value: str optional value to store as validation value.
@@ -99,66 +252,227 @@ class TokenManager:
 
         @:return Token
         """
-        expire_in_day = datetime.timestamp(datetime.now()) + timedelta(days=1)
-        expiry_expected = expiry if expiry else expire_in_day
-        aes_object = self.get_cipher()
+        now = datetime.now()
         if not token_value:
             token_value = self.generate_sha256(token_key)
-        cipher_text = aes_object.encrypt(token_value)
-        self.filter(
-            key=token_key,
-            validated=False,
-        ).update(deleted_at=datetime.timestamp(datetime.now()))
-        return Token.objects.create(
+        token_value = normalise_value(token_value)
+        self.session.query(Token).filter(
+            Token.key == token_key,
+            Token.validated.isnot(True),
+            Token.deleted_at.is_(None),
+        ).update(
+            {'deleted_at': now, 'modified_at': now},
+            synchronize_session=False,
+        )
+        token = Token(
             key=token_key,
-            value=cipher_text,
-            expiry=expiry_expected,
+            value=self.encrypt_value(token_value),
+            expiry=expiry or now + TOKEN_EXPIRY,
             single_use=single_use,
+            validated=False,
+            created_at=now,
+            modified_at=now,
         )
+        self.session.add(token)
+        self.session.flush()
+        state = token.state(token_value)
+        self.session.commit()
+        self.cache.put(state, now=now)
+        return token
+
+    def load(self, token_key):
+        """Read the live token of a key from the database.
+
+        @:param token_key: str identifier.
+
+        @:return TokenState or None
+        """
+        token = self.session.query(Token).filter(
+            Token.key == token_key,
+            Token.deleted_at.is_(None),
+        ).order_by(Token.id.desc()).first()
+        self.session.commit()
+        if token is None:
+            return None
+        return token.state(self.get_value(token))
+
+    def write_state(self, state, now, **values):
+        """Write changed columns of a live token, only the manager which
+        changes the row first succeeds.
+
+        @:return bool
+        """
+        values['modified_at'] = now
+        changed = self.session.query(Token).filter(
+            Token.id == state.id,
+            Token.deleted_at.is_(None),
+        ).update(values, synchronize_session=False)
+        self.session.commit()
+        return bool(changed)
 
     def validation(self, token_key, token_value):
         """Validate a key value pair.
 
+        A single use token is consumed by its first successful validation and
+        an expired token is deleted when it is presented.
+
         @:param token_key: str identifier.
         @:param token_value: str value stored in cipher.
 
         @:return bool
         """
-        token = Token.objects.filter(key=token_key).first()
-        return token.validate(token_value)
+        now = datetime.now()
+        state = self.cache.get(token_key, now=now)
+        if state is None:
+            state = self.load(token_key)
+            if state is None:
+                return False
+            self.cache.put(state, now=now)
+        if state.expiry <= now:
+            self.cache.invalidate(token_key)
+            self.write_state(state, now, deleted_at=now)
+            return False
+        if not hmac.compare_digest(
+                state.value.encode(), normalise_value(token_value).encode()):
+            return False
+        if state.single_use:
+            self.cache.invalidate(token_key)
+            return self.write_state(
+                state, now, validated=True, deleted_at=now)
+        if not state.validated:
+            self.cache.put(state._replace(validated=True), now=now)
+            self.write_state(state, now, validated=True)
+        return True
+
+    def __init__(self, session=None, cache=None):
+        self.session = session or Session()
+        # An empty cache is falsy, so is only replaced when not given.
+        self.cache = TokenCache() if cache is None else cache
 
 
 class Token(Base):
     """Simple token object."""
 
+    __tablename__ = 'token'
     id = Column(Integer, primary_key=True)
-    key = Column(Unicode())
+    key = Column(Unicode(), index=True)
     value = Column(Binary())
     single_use = Column(Boolean())
     validated = Column(Boolean())
-    expiry = Column(DateTime())
+    expiry = Column(DateTime(), index=True)
     created_at = Column(DateTime())
     modified_at = Column(DateTime())
-    deleted_at = Column(DateTime())
+    deleted_at = Column(DateTime(), index=True)
 
-    def validate(self, expected_value):
-        """Validate the stored value against an expected.
+    def state(self, value):
+        """The state of this token as cached by a TokenManager.
 
-        @:param expected_value: str value expected to match.
+        @:param value: str decrypted value of the token.
 
-        @:return bool
+        @:return TokenState
         """
-        if not self.value:
-            return False
-        now = datetime.timestamp(datetime.now())
-        expired = self.expiry < now
-        is_valid = self.objects.get_value(self) == expected_value
-        if expired or is_valid:
-            self.validated = True
-            self.expiry = now
-            self.save()
-        if expired or self.single_use:
-            self.delete()
-        if expired:
-            return False
-        return is_valid
+        return TokenState(
+            self.id,
+            self.key,
+            value,
+            bool(self.single_use),
+            bool(self.validated),
+            self.expiry,
+        )
+
+
+Base.metadata.create_all(engine)
+upgrade_schema(engine, metadata=Base.metadata)
+
+
+def sweep_tokens(session, now=None, batch_size=TOKEN_SWEEP_BATCH_SIZE):
+    """Delete tokens expired by now and tokens consumed or replaced.
+
+    Rows are found through the expiry and deleted_at indexes and deleted
+    batch_size at a time, each batch in a transaction of its own so the
+    table is never locked for long.
+
+    @:param session: Session to delete with.
+    @:param now: datetime tokens expire by, default now.
+    @:param batch_size: int rows deleted per transaction.
+
+    @:return int number of tokens deleted
+    """
+    now = now or datetime.now()
+    batch_size = max(batch_size, 1)
+    deleted = 0
+    for condition, order in [
+        (Token.expiry < now, Token.expiry),
+        (Token.deleted_at.isnot(None), Token.deleted_at),
+    ]:
+        while True:
+            ids = session.query(Token.id).filter(condition).order_by(
+                order).limit(batch_size).subquery()
+            count = session.query(Token).filter(
+                Token.id.in_(ids),
+            ).delete(synchronize_session=False)
+            session.commit()
+            deleted += count
+            if count < batch_size:
+                break
+    return deleted
+
+
+class TokenSweeper:
+    """Sweep expired and consumed tokens every interval seconds on a
+    background thread with a session of its own.
+
+    Example use: `with TokenSweeper(interval=60): serve()`
+    """
+    interval = TOKEN_SWEEP_INTERVAL
+    batch_size = TOKEN_SWEEP_BATCH_SIZE
+    deleted = 0
+    thread = None
+    stopped = None
+
+    def sweep(self):
+        """Sweep once now.
+
+        @:return int
+        """
+        session = Session()
+        try:
+            count = sweep_tokens(session, batch_size=self.batch_size)
+        finally:
+            session.close()
+        self.deleted += count
+        return count
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sweep()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self.run, name='token-sweeper', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+
+    def __init__(
+        self, interval=TOKEN_SWEEP_INTERVAL,
+        batch_size=TOKEN_SWEEP_BATCH_SIZE,
+    ):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.stopped = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
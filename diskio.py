@@ -8,11 +8,48 @@ write content supplied or Aubergine.
 """
 
 import os
-from random import choice
+import secrets
+import threading
+from collections import namedtuple
+from functools import lru_cache, partial
+from hashlib import sha256
 from pathlib import Path
 
+from instrument import instrument
+from workers import WorkerPool, POOL_THREAD
 
-file_sizes = []
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+SEGMENT_BYTE_LENGTH = 64 * 1024 * 1024
+SHARD_DEPTH = 2
+CHUNKING_FIXED = 'fixed'
+CHUNKING_CONTENT = 'content'
+CHUNKING_TYPES = [CHUNKING_FIXED, CHUNKING_CONTENT, ]
+CDC_MIN_LENGTH = 2 * 1024
+CDC_AVERAGE_LENGTH = 8 * 1024
+CDC_MAX_LENGTH = 64 * 1024
+CDC_READ_LENGTH = 1024 * 1024
+GEAR_TABLE = tuple(
+    int.from_bytes(sha256(bytes([i])).digest()[:8], 'big')
+    for i in range(256)
+)
+GEAR_MASK = (1 << 64) - 1
+GEAR_WINDOW = 64
+GEAR_ARRAY = None
+if numpy is not None:
+    GEAR_ARRAY = numpy.array(GEAR_TABLE, dtype=numpy.uint64)
+WIPE_BUFFER_LENGTH = 1024 * 1024
+WIPE_PATTERN = 'pattern'
+WIPE_RANDOM = 'random'
+WIPE_TYPES = [WIPE_PATTERN, WIPE_RANDOM, ]
+AUBERGINE = '🍆'.encode()
+
+WalkEntry = namedtuple('WalkEntry', ['path', 'location', 'size', 'mtime'])
+WipeTotals = namedtuple('WipeTotals', ['files', 'bytes'])
 
 
 def get_path(location):
@@ -22,6 +59,74 @@ def get_path(location):
     return Path(location)
 
 
+def allocate_location(directory, depth=SHARD_DEPTH):
+    """
+    Allocate a new location under directory without probing the disk. Names
+    are 128 random bits from the OS CSPRNG so collisions are not a practical
+    concern, and the leading bytes of the name fan locations out into nested
+    subdirectories, ab/cd/abcd..., keeping every directory small.
+
+    :param directory: str or Path to allocate within
+    :param depth: int number of subdirectory levels
+    :return: Path
+    """
+    name = secrets.token_hex(16)
+    shards = [name[i * 2:i * 2 + 2] for i in range(depth)]
+    location = get_path(directory).joinpath(*shards, name)
+    location.parent.mkdir(parents=True, exist_ok=True)
+    return location
+
+
+def walk_location(location, errors=None):
+    """
+    Lazily walk every file below location with os.scandir, yielding each file
+    as soon as it is found so work can start before the walk is finished.
+    Sizes and modified times come from the stat cached on each DirEntry and
+    symbolic links are followed, a directory reached a second time through a
+    link is skipped so link cycles cannot recurse forever. A directory which
+    can not be listed is skipped and its relative path appended to errors.
+
+    :param location: str or Path of a directory or a file
+    :param errors: list collecting the paths of directories not walked
+    :return: generator of WalkEntry, path being relative to location
+    """
+    location = get_path(location)
+    if not location.exists():
+        return
+    if not location.is_dir():
+        stat = location.stat()
+        yield WalkEntry(
+            location.name, location, stat.st_size, stat.st_mtime_ns)
+        return
+    stat = location.stat()
+    visited = {(stat.st_dev, stat.st_ino)}
+    pending = [(location, '')]
+    while pending:
+        directory, relative = pending.pop()
+        try:
+            entries = sorted(os.scandir(directory), key=lambda e: e.name)
+        except OSError:
+            if errors is not None:
+                errors.append(relative)
+            continue
+        for entry in entries:
+            path = '{}/{}'.format(relative, entry.name).lstrip('/')
+            try:
+                stat = entry.stat()
+                is_dir = entry.is_dir()
+            except OSError:
+                continue  # Broken symbolic link or removed during the walk.
+            if is_dir:
+                identity = (stat.st_dev, stat.st_ino)
+                if identity in visited:
+                    continue
+                visited.add(identity)
+                pending.append((get_path(entry.path), path))
+            elif entry.is_file():
+                yield WalkEntry(
+                    path, get_path(entry.path), stat.st_size, stat.st_mtime_ns)
+
+
 def detail_location(location):
     """
     Search through all child files of a directory and return a dict object with
@@ -31,83 +136,373 @@ def detail_location(location):
     location = get_path(location)
     if not location.exists():
         return None
-    if location.is_symlink():
-        sym_target = os.readlink(location)
-        return detail_location(sym_target)
-    if location.is_file():
-        return {location.name: location}
-    rtn = {}
-    sub_list = [x for x in location.iterdir()]
-    for x in sub_list:
-        rtn.update(detail_location(x) if x.is_dir() else {x.name: x})
-    return rtn
+    return {entry.path: entry.location for entry in walk_location(location)}
 
 
-def aubergine_file(size, file_path):
+@lru_cache(maxsize=1)
+def aubergine_buffer(length=WIPE_BUFFER_LENGTH):
     """
-    Write a file to disk matching the bytes as an argument with '🍆'.
+    A buffer of length bytes of repeated '🍆', built once and reused for every
+    file overwritten with the pattern.
     """
-    if type(file_path) is not Path:
-        return
-    chr_length = 4
-    i = 0
-    length = 16
-    filename = ''
-    while i < length:
-        i += 1
-        filename += chr(choice(range(97, 122)))
-    size += chr_length - (size % chr_length)
-    file_path.write_text(''.join(['🍆'] * int(size / chr_length)))
+    return (AUBERGINE * (length // len(AUBERGINE) + 1))[:length]
+
+
+def aubergine_file(location, mode=WIPE_PATTERN):
+    """
+    Overwrite a file in place with '🍆' or, with WIPE_RANDOM, bytes from the OS
+    CSPRNG, writing a single buffer of at most WIPE_BUFFER_LENGTH bytes over
+    and over so memory stays flat however large the file. The contents are
+    synced to disk before returning.
+
+    :param location: str or Path of a regular file
+    :param mode: str one of WIPE_TYPES
+    :return: int number of bytes overwritten
+    """
+    if mode not in WIPE_TYPES:
+        raise Exception('Unknown wipe mode: mode = {}.'.format(mode))
+    with get_path(location).open('r+b', buffering=0) as stream:
+        size = os.fstat(stream.fileno()).st_size
+        length = min(size, WIPE_BUFFER_LENGTH)
+        with instrument.measure('diskio.wipe', size=size, items=1):
+            if mode == WIPE_RANDOM:
+                view = memoryview(secrets.token_bytes(length))
+            else:
+                view = memoryview(aubergine_buffer())
+            written = 0
+            while written < size:
+                written += stream.write(view[:min(size - written, length)])
+        with instrument.measure('diskio.fsync', items=1):
+            os.fsync(stream.fileno())
+    return size
 
 
 def read_location(location):
+    """
+    Read the whole of a location into memory, only suitable for small files
+    use read_windows for anything of unknown size.
+    """
     location = get_path(location)
     if not location.exists():
         return None
-    read_file = location.read_bytes()  # TODO: Large file handling required
+    with instrument.measure('diskio.read', items=1) as measured:
+        read_file = location.read_bytes()
+        measured.add(len(read_file))
     return read_file
 
 
+def read_windows(location, size, offset=0):
+    """
+    Stream the contents of a location from offset in windows of size bytes,
+    the final window may be shorter. A single buffer is reused for every
+    window so the memoryview yielded is only valid until the next window is
+    requested, copy it if it must outlive the iteration.
+    """
+    location = get_path(location)
+    if not location.exists():
+        return
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    with location.open('rb', buffering=0) as stream:
+        if offset:
+            stream.seek(offset)
+        while True:
+            with instrument.measure('diskio.read') as measured:
+                filled = 0
+                while filled < size:
+                    read = stream.readinto(view[filled:])
+                    if not read:
+                        break
+                    filled += read
+                measured.add(filled, 1)
+            if not filled:
+                break
+            yield view[:filled]
+            if filled < size:
+                break
+
+
+def content_mask(average_length):
+    """
+    The mask of the top bits of the gear hash which must all be clear to cut
+    a chunk, one position in about average_length has them clear.
+
+    :return: int
+    """
+    bits = max(average_length.bit_length() - 1, 1)
+    return ((1 << bits) - 1) << (64 - bits)
+
+
+@instrument.timed('diskio.content_scan')
+def find_content_candidates(data, mask):
+    """
+    Find in bulk every position of data the gear hash of the GEAR_WINDOW
+    bytes ending there has none of the bits of mask set. The hash of every
+    window is summed by doubling, adding the hashes of the half windows
+    before each position, so the whole of data is hashed a few vectorised
+    passes at a time rather than a byte at a time. Positions before the
+    first whole window are left out.
+
+    :param data: bytes or bytearray
+    :param mask: int from content_mask
+    :return: numpy array of int positions in order, None without numpy
+    """
+    if numpy is None:
+        return None
+    hashed = GEAR_ARRAY[numpy.frombuffer(data, dtype=numpy.uint8)]
+    step = 1
+    while step < GEAR_WINDOW:
+        hashed[step:] += hashed[:-step] << numpy.uint64(step)
+        step *= 2
+    candidates = numpy.flatnonzero((hashed & numpy.uint64(mask)) == 0)
+    return candidates[candidates >= GEAR_WINDOW - 1]
+
+
+@instrument.timed('diskio.content_cut')
+def find_content_cut(
+    data, start, min_length, max_length, mask, final=False, candidates=None,
+):
+    """
+    Find where the chunk starting at start ends using a gear rolling hash,
+    the hash only depends on the last 64 bytes seen so the same content cuts
+    at the same place wherever it lies in a file. With the candidates of data
+    from find_content_candidates only the first bytes, hashed before a whole
+    window lies within the chunk, are hashed here.
+
+    :return: int end of the chunk or None when more data is needed
+    """
+    end = min(len(data), start + max_length)
+    first = start + min_length
+    scanned = end
+    if candidates is not None:
+        scanned = min(end, first + GEAR_WINDOW - 1)
+    gear = GEAR_TABLE
+    hashed = 0
+    for i in range(first, scanned):
+        hashed = ((hashed << 1) + gear[data[i]]) & GEAR_MASK
+        if not hashed & mask:
+            return i + 1
+    if scanned < end:
+        found = candidates.searchsorted(scanned)
+        if found < len(candidates) and candidates[found] < end:
+            return int(candidates[found]) + 1
+    if end - start == max_length or (final and end > start):
+        return end
+    return None
+
+
+def read_content_chunks(
+    location,
+    min_length=CDC_MIN_LENGTH,
+    average_length=CDC_AVERAGE_LENGTH,
+    max_length=CDC_MAX_LENGTH,
+    offset=0,
+):
+    """
+    Stream the contents of a location from offset cut into content defined
+    chunks of between min_length and max_length bytes, averaging about
+    average_length. Inserting or removing bytes only changes the chunks
+    around the change rather than every chunk after it, as it would with
+    fixed size chunks.
+    """
+    mask = content_mask(average_length)
+    pending = bytearray()
+    for window in read_windows(location, CDC_READ_LENGTH, offset=offset):
+        pending += window
+        candidates = find_content_candidates(pending, mask)
+        start = 0
+        while True:
+            cut = find_content_cut(
+                pending, start, min_length, max_length, mask,
+                candidates=candidates)
+            if cut is None:
+                break
+            yield bytes(pending[start:cut])
+            start = cut
+        del pending[:start]
+    candidates = find_content_candidates(pending, mask)
+    start = 0
+    while start < len(pending):
+        cut = find_content_cut(
+            pending, start, min_length, max_length, mask, final=True,
+            candidates=candidates)
+        yield bytes(pending[start:cut])
+        start = cut
+
+
 def write_location(location, contents, write_bytes=False):
     location = get_path(location)
-    if write_bytes:
-        location.write_bytes(contents)
+    with instrument.measure('diskio.write', size=len(contents), items=1):
+        if write_bytes:
+            location.write_bytes(contents)
+            return
+        location.write_text(contents)
+
+
+class SegmentWriter:
+    """
+    Append chunks to large segment files so a store produces a handful of
+    large files written sequentially rather than one file per chunk. A new
+    segment is requested from allocate, a callable returning the segment id
+    and Path, whenever the current segment would grow past max_size bytes.
+    Writes are serialised by a lock so several threads may share a writer.
+    """
+    segment_id = None
+    stream = None
+    offset = 0
+    lock = None
+
+    def write(self, contents):
+        """
+        Append contents to the current segment.
+
+        :param contents: bytes
+        :return: tuple of segment id, offset and length written
+        """
+        length = len(contents)
+        with self.lock, instrument.measure(
+                'diskio.segment_write', size=length, items=1):
+            if self.stream is None or self.offset + length > self.max_size:
+                self.roll()
+            offset = self.offset
+            self.stream.write(contents)
+            self.offset += length
+            return self.segment_id, offset, length
+
+    def roll(self):
+        """
+        Close the current segment and start appending to a new one.
+        """
+        self.close()
+        instrument.count('diskio.segment_roll')
+        self.segment_id, location = self.allocate()
+        self.stream = get_path(location).open('ab')
+        self.offset = self.stream.tell()
+
+    def flush(self):
+        with self.lock:
+            if self.stream is not None:
+                self.stream.flush()
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+        self.stream = None
+
+    def __init__(self, allocate, max_size=SEGMENT_BYTE_LENGTH):
+        self.allocate = allocate
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def wipe_location(location, mode=WIPE_PATTERN):
+    """
+    Overwrite a regular file with aubergine_file and remove it. Symbolic links
+    and anything else which is not a regular file are only removed, the
+    target of a link may lie outside of what is being wiped.
+
+    :return: int number of bytes overwritten
+    """
+    location = get_path(location)
+    size = 0
+    if location.is_file() and not location.is_symlink():
+        size = aubergine_file(location, mode=mode)
+    location.unlink()
+    return size
+
+
+def walk_wipe_location(location, directories):
+    """
+    Yield every file below location without following symbolic links,
+    directories are appended to directories parents first so they can be
+    removed in reverse once emptied.
+    """
+    if location.is_symlink() or not location.is_dir():
+        if location.is_symlink() or location.exists():
+            yield location
         return
-    location.write_text(contents)
+    pending = [location]
+    while pending:
+        directory = pending.pop()
+        directories.append(directory)
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(get_path(entry.path))
+                else:
+                    yield get_path(entry.path)
 
 
-def remove_location(location):
+def wipe_walked_location(location, walked, mode=WIPE_PATTERN):
     """
-    Remove the location Path object, sybolic links will be removed after the
-    target of the symbolic link is removed.
+    Wipe a file only when it was walked, a WalkEntry of walked keyed by
+    location, and its size and modified time are still those walked.
+
+    :return: int number of bytes overwritten or None when the file is kept
     """
-    if location.is_symlink():
-        sym_target = os.readlink(location)
-        file_sizes.append(sym_target.stat().st_size)
-        remove_location(sym_target)
-    if location.is_file():
-        file_sizes.append(location.stat().st_size)
-        os.remove(location)
-    else:
-        try:
-            os.rmdir(location)
-        except FileNotFoundError:
-            pass
-        except OSError:
-            remove_disk_contents([location])
+    entry = walked.get(location)
+    if entry is None:
+        return None
+    try:
+        stat = location.stat()
+    except OSError:
+        return None
+    if stat.st_size != entry.size or stat.st_mtime_ns != entry.mtime:
+        return None
+    return wipe_location(location, mode=mode)
 
 
-def remove_disk_contents(locations=None):
+def remove_disk_contents(
+    locations=None, jobs=None, mode=WIPE_PATTERN, keep_root=False,
+    entries=None,
+):
     """
-    Recurse through a list of file locations and remove all files and folders
-    in directories and remove all files listed independantly.
+    Wipe every file of a list of locations, files or directories walked
+    without following symbolic links, jobs files at a time on a pool of
+    threads, then remove the emptied directories. With keep_root the
+    locations themselves are kept, emptied, when they are directories.
+
+    Given entries, WalkEntry found by walk_location on the same locations,
+    only those files are wiped and only while unchanged since they were
+    walked. Anything else is kept together with the directories holding it.
+
+    :param locations: list of str or Path
+    :param jobs: int number of files wiped in parallel
+    :param mode: str one of WIPE_TYPES
+    :param keep_root: bool keep directories given in locations
+    :param entries: iterable of WalkEntry, every file is wiped when None
+    :return: WipeTotals of files removed and bytes overwritten
     """
     if not locations:
-        return
-    for location in locations:
-        path = get_path(location)
-        if path.is_dir():
-            sub_list = [x for x in path.iterdir()]
-            for sub_loc in sub_list:
-                remove_location(sub_loc)
-        remove_location(path)
+        return WipeTotals(0, 0)
+    roots = [get_path(location) for location in locations]
+    directories = []
+    files = (
+        path for root in roots
+        for path in walk_wipe_location(root, directories))
+    if entries is None:
+        wipe = partial(wipe_location, mode=mode)
+    else:
+        walked = {entry.location: entry for entry in entries}
+        wipe = partial(wipe_walked_location, walked=walked, mode=mode)
+    count = 0
+    total = 0
+    with WorkerPool(jobs=jobs, pool=POOL_THREAD) as workers:
+        for size in workers.map(wipe, files):
+            if size is None:
+                continue
+            count += 1
+            total += size
+    for directory in reversed(directories):
+        if keep_root and directory in roots:
+            continue
+        if entries is not None and any(directory.iterdir()):
+            continue
+        directory.rmdir()
+    return WipeTotals(count, total)
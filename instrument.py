@@ -0,0 +1,282 @@
+"""
+Copyright 2019 (c) GlibGlob Ltd.
+Author: Laurence Psychic
+Email: vesper.porta@protonmail.com
+
+Record where the time of a run goes. Named stages accumulate their calls,
+items, bytes, wall time and CPU time of the thread measuring them, which is
+only done while the instrument is started so an ordinary run pays no more
+than a flag test per measured block. Threads can also be profiled with
+cProfile, each thread keeping a profile of its own merged when dumped.
+
+Example use: `with instrument.measure('diskio.write', len(data)): ...`
+"""
+
+import cProfile
+import json
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+
+MIB = 1024 * 1024
+
+
+class Stat:
+    """
+    Totals of a single named stage.
+    """
+    __slots__ = ['calls', 'items', 'bytes', 'wall', 'cpu']
+
+    def __init__(self):
+        self.calls = 0
+        self.items = 0
+        self.bytes = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+
+
+class Measure:
+    """
+    Time one block of a stage, the bytes and items handled can be added while
+    the block runs when they are not known up front.
+    """
+    __slots__ = ['instrument', 'name', 'size', 'items', 'wall', 'cpu']
+
+    def add(self, size=0, items=0):
+        self.size += size
+        self.items += items
+
+    def __init__(self, instrument, name, size=0, items=0):
+        self.instrument = instrument
+        self.name = name
+        self.size = size
+        self.items = items
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *args):
+        self.instrument.record(
+            self.name,
+            wall=time.perf_counter() - self.wall,
+            cpu=time.thread_time() - self.cpu,
+            size=self.size,
+            items=self.items,
+        )
+
+
+class NullMeasure:
+    """
+    Stand in for Measure while the instrument is stopped.
+    """
+
+    def add(self, size=0, items=0):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+NULL_MEASURE = NullMeasure()
+
+
+class Instrument:
+    """
+    Named stage totals for a run, stages are named after the module they
+    measure, 'diskio.read' or 'storage.commit'. Work done in worker processes
+    is not recorded, only the time the calling thread waited on it.
+    """
+    enabled = False
+    profiling = False
+    stats = None
+    lock = None
+    profiles = None
+    local = None
+    started = None
+    elapsed = 0.0
+
+    def start(self, profile=False):
+        """
+        Reset every stage and start recording, with profile threads entering
+        profile_thread are also profiled.
+        """
+        self.stats = {}
+        self.profiles = []
+        self.local = threading.local()
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+        self.profiling = profile
+        self.enabled = True
+
+    def stop(self):
+        if self.enabled:
+            self.elapsed = time.perf_counter() - self.started
+        self.enabled = False
+        self.profiling = False
+
+    def record(self, name, wall=0.0, cpu=0.0, size=0, items=0, calls=1):
+        with self.lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = Stat()
+            stat.calls += calls
+            stat.items += items
+            stat.bytes += size
+            stat.wall += wall
+            stat.cpu += cpu
+
+    def measure(self, name, size=0, items=0):
+        """
+        Context manager timing a block as a call of the stage name.
+
+        :param name: str stage name
+        :param size: int bytes handled by the block
+        :param items: int items handled by the block
+        :return: Measure or NULL_MEASURE when stopped
+        """
+        if not self.enabled:
+            return NULL_MEASURE
+        return Measure(self, name, size=size, items=items)
+
+    def count(self, name, size=0, items=1):
+        """
+        Count a call of the stage name without timing it.
+        """
+        if self.enabled:
+            self.record(name, size=size, items=items)
+
+    def timed(self, name):
+        """
+        Decorate a function so each call is measured as the stage name.
+        """
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with Measure(self, name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def iterate(self, name, iterable, size=None):
+        """
+        Measure the time taken producing each item of iterable, not the time
+        the consumer spends between items.
+
+        :param size: callable giving the bytes of an item, default none
+        :return: iterable
+        """
+        if not self.enabled:
+            return iterable
+        return self._iterate(name, iter(iterable), size)
+
+    def _iterate(self, name, iterator, size):
+        while True:
+            with Measure(self, name, items=1) as measured:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    measured.items = 0
+                    return
+                if size is not None:
+                    measured.add(size(item))
+            yield item
+
+    @contextmanager
+    def profile_thread(self):
+        """
+        Profile the calling thread with cProfile while the block runs, nested
+        use within a thread already profiled does nothing.
+        """
+        if not self.profiling or getattr(self.local, 'profile', None):
+            yield
+            return
+        profile = cProfile.Profile()
+        self.local.profile = profile
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.local.profile = None
+
+    def profiled(self, function):
+        """
+        Wrap function so every call is made within profile_thread, for work
+        handed to threads this module does not start itself.
+        """
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not self.profiling:
+                return function(*args, **kwargs)
+            with self.profile_thread():
+                return function(*args, **kwargs)
+        return wrapper
+
+    def report(self):
+        """
+        :return: dict of the totals of every stage and the elapsed time
+        """
+        elapsed = self.elapsed
+        if self.enabled:
+            elapsed = time.perf_counter() - self.started
+        return {
+            'elapsed': elapsed,
+            'stages': {
+                name: {s: getattr(stat, s) for s in Stat.__slots__}
+                for name, stat in sorted((self.stats or {}).items())
+            },
+        }
+
+    def summary(self):
+        """
+        :return: str table of the totals of every stage
+        """
+        report = self.report()
+        lines = ['{:<24}{:>10}{:>12}{:>10}{:>10}{:>10}{:>10}'.format(
+            'stage', 'calls', 'items', 'MiB', 'wall s', 'cpu s', 'MB/s')]
+        for name, stat in report['stages'].items():
+            rate = stat['bytes'] / MIB / stat['wall'] if stat['wall'] else 0
+            lines.append(
+                '{:<24}{:>10}{:>12}{:>10.1f}{:>10.3f}{:>10.3f}{:>10.1f}'
+                .format(
+                    name, stat['calls'], stat['items'], stat['bytes'] / MIB,
+                    stat['wall'], stat['cpu'], rate,
+                ))
+        lines.append('elapsed {:.3f} s'.format(report['elapsed']))
+        return '\n'.join(lines)
+
+    def dump_json(self, path):
+        with open(path, 'w') as stream:
+            json.dump(self.report(), stream, indent=2)
+
+    def dump_stats(self, path):
+        """
+        Merge the cProfile profile of every profiled thread into a single
+        pstats file, readable with `python -m pstats`.
+        """
+        profiles = [p for p in self.profiles or [] if p.getstats()]
+        if not profiles:
+            return
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+
+instrument = Instrument()
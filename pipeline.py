@@ -0,0 +1,141 @@
+"""
+Copyright 2019 (c) GlibGlob Ltd.
+Author: Laurence Psychic
+Email: vesper.porta@protonmail.com
+
+Run work as a series of stages connected by bounded queues, each stage with a
+pool of worker threads of its own. A stage blocks when the queue in front of
+the next stage is full so a fast stage can never run far ahead of a slow one,
+while disk reads, CPU work and database writes of different items overlap.
+"""
+
+import threading
+from queue import Queue
+
+from instrument import instrument
+
+
+PIPELINE_QUEUE_SIZE = 16
+
+_STOP = object()
+
+
+class Stage:
+    """
+    A step of a Pipeline. Function takes one item and returns an iterable of
+    items for the next stage, finish is called once after the last item of
+    the stage has been processed by every worker and may also return items.
+
+    Example use: `Stage('read', read_file, workers=2)`
+    """
+    name = ''
+    function = None
+    finish = None
+    workers = 1
+
+    def __init__(self, name, function, workers=1, finish=None):
+        self.name = name
+        self.function = function
+        self.workers = max(workers or 1, 1)
+        self.finish = finish
+
+
+class Pipeline:
+    """
+    Feed items from a source through stages in order, items produced by the
+    last stage are discarded. The first error raised by any stage stops the
+    remaining work and is raised again from run once every thread is done.
+
+    Example use: `Pipeline([Stage(...), Stage(...)]).run(items)`
+    """
+    stages = None
+    queue_size = PIPELINE_QUEUE_SIZE
+    error = None
+
+    def run(self, source):
+        """
+        Run every item of source through the stages, the source is iterated in
+        the calling thread.
+
+        :param source: iterable of items for the first stage
+        """
+        self.error = None
+        queues = [Queue(maxsize=self.queue_size) for s in self.stages]
+        queues.append(None)
+        threads = []
+        for index, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            lock = threading.Lock()
+            for i in range(stage.workers):
+                thread = threading.Thread(
+                    target=self.work,
+                    args=(stage, queues[index], queues[index + 1],
+                          remaining, lock),
+                    name='{}-{}'.format(stage.name, i),
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+        try:
+            for item in source:
+                if self.error is not None:
+                    break
+                queues[0].put(item)
+        except BaseException as e:
+            self.error = self.error or e
+        for i in range(self.stages[0].workers):
+            queues[0].put(_STOP)
+        for thread in threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def put(self, outbox, items, stage):
+        """
+        Hand items on to the next stage, the time spent blocked on a full
+        queue is recorded as the stage name followed by '.blocked'.
+        """
+        if outbox is None or items is None:
+            return
+        name = 'pipeline.{}.blocked'.format(stage.name)
+        for item in items:
+            with instrument.measure(name, items=1):
+                outbox.put(item)
+
+    def work(self, stage, inbox, outbox, remaining, lock):
+        """
+        Worker thread of a stage, once stopped the last worker of a stage to
+        finish runs its finish hook and stops every worker of the next stage.
+        """
+        with instrument.profile_thread():
+            self.drain(stage, inbox, outbox, remaining, lock)
+
+    def drain(self, stage, inbox, outbox, remaining, lock):
+        while True:
+            item = inbox.get()
+            if item is _STOP:
+                break
+            if self.error is not None:
+                continue  # Drain so earlier stages never block on put.
+            try:
+                self.put(outbox, stage.function(item), stage)
+            except BaseException as e:
+                self.error = self.error or e
+        with lock:
+            remaining[0] -= 1
+            last = not remaining[0]
+        if not last:
+            return
+        if stage.finish and self.error is None:
+            try:
+                self.put(outbox, stage.finish(), stage)
+            except BaseException as e:
+                self.error = self.error or e
+        if outbox is not None:
+            next_stage = self.stages[self.stages.index(stage) + 1]
+            for i in range(next_stage.workers):
+                outbox.put(_STOP)
+
+    def __init__(self, stages, queue_size=PIPELINE_QUEUE_SIZE):
+        self.stages = stages
+        self.queue_size = max(queue_size or PIPELINE_QUEUE_SIZE, 1)
@@ -0,0 +1,598 @@
+"""
+Copyright 2019 (c) GlibGlob Ltd.
+Author: Laurence Psychic
+Email: vesper.porta@protonmail.com
+
+Restore stored files from the chunks recorded in the database. Chunks are
+read in order through the cryptofile index, contiguous chunks of a segment are
+read together and each file is streamed chunk by chunk into its restored
+location so no file is ever held in memory whole. A stored file can also be
+opened as a seekable file object, decrypting its chunks only as they are read
+so no plain text is written to disk.
+"""
+
+import io
+import mmap
+from bisect import bisect_right
+from collections import OrderedDict, namedtuple
+from functools import partial
+from sqlalchemy import func
+
+from cryptochunk import (
+    FORMAT_HEX, FORMAT_SEALED, AES_BLOCK_LENGTH, FileKey, decrypt_chunk,
+    decrypt_file_chunk,
+)
+from diskio import get_path, read_location
+from instrument import instrument
+from storage import (
+    CryptoFile, CryptoStore, Session, CHUNK_BATCH_SIZE, file_complete,
+)
+from workers import WorkerPool, POOL_THREAD
+
+
+READ_BYTE_LENGTH = 4 * 1024 * 1024
+READER_CACHE_SIZE = 64
+
+Chunk = namedtuple('Chunk', ['store', 'password', 'iv456', 'filename'])
+
+
+def password_matches(file, master):
+    """
+    Test the master key against the test copy kept with a file.
+
+    :param file: CryptoFile
+    :param master: MasterKey
+    :return: bool
+    """
+    test_copy = file.test_copy.encode()
+    if (file.format_version or FORMAT_HEX) >= FORMAT_SEALED:
+        return master.unseal(file.test_encrypted) == test_copy
+    # The value sealed before the test copy is unknown, so only the blocks
+    # after the first can be compared.
+    tested = next(master.unseal_chained([file.test_encrypted]))
+    return tested[AES_BLOCK_LENGTH:] == test_copy[AES_BLOCK_LENGTH:]
+
+
+def unseal_file_key(file, master):
+    """
+    :param file: CryptoFile
+    :param master: MasterKey
+    :return: FileKey of the file or None when its chunks carry their own keys
+    """
+    if not file.data_key:
+        return None
+    return FileKey(master.unseal(file.data_key))
+
+
+def query_chunks(session, file):
+    """
+    Query the chunks of a file in order, loading batches of rows at a time.
+    """
+    return session.query(CryptoStore).filter(
+        CryptoStore.cryptofile_id == file.id,
+    ).order_by(
+        CryptoStore.sequence, CryptoStore.id,
+    ).yield_per(CHUNK_BATCH_SIZE)
+
+
+def unseal_chunks(file, stores, master):
+    """
+    Unseal the password, IV and filename of each chunk of a file, chunks
+    encrypted by the data key of the file have no password or IV.
+
+    :param file: CryptoFile
+    :param stores: iterable of CryptoStore in order
+    :param master: MasterKey
+    :return: generator of Chunk
+    """
+    if (file.format_version or FORMAT_HEX) >= FORMAT_SEALED:
+        for store in stores:
+            filename = None
+            if store.filename:
+                filename = master.unseal(store.filename).decode()
+            if store.public_key is None:
+                yield Chunk(store, None, None, filename)
+                continue
+            yield Chunk(
+                store,
+                master.unseal(store.public_key).decode(),
+                master.unseal(store.private_key).decode(),
+                filename,
+            )
+        return
+    previous = file.test_encrypted[-AES_BLOCK_LENGTH:]
+    for store in stores:
+        values = [store.public_key, store.private_key]
+        if store.filename:
+            values.append(store.filename)
+        unsealed = list(master.unseal_chained(values, previous=previous))
+        previous = values[-1][-AES_BLOCK_LENGTH:]
+        filename = unsealed[2].decode() if store.filename else None
+        yield Chunk(
+            store, unsealed[0].decode(), unsealed[1].decode(), filename)
+
+
+def read_chunks(chunks, directory):
+    """
+    Read the cipher text of each chunk, runs of chunks lying next to each
+    other in a segment are read with a single read of up to READ_BYTE_LENGTH.
+
+    :param chunks: iterable of Chunk in order
+    :param directory: str output directory holding chunks and segments
+    :return: generator of tuples of Chunk and bytes, bytes is None if missing
+    """
+    directory = get_path(directory)
+    streams = {}
+    run = []
+
+    def read_run():
+        if not run:
+            return
+        first = run[0].store
+        stream = streams.get(first.segment_id)
+        if stream is None:
+            location = directory / first.segment.filename
+            if not location.exists():
+                for chunk in run:
+                    yield chunk, None
+                return
+            stream = streams[first.segment_id] = location.open('rb')
+        stream.seek(first.segment_offset)
+        data = stream.read(sum(c.store.segment_length for c in run))
+        offset = 0
+        for chunk in run:
+            length = chunk.store.segment_length
+            value = data[offset:offset + length]
+            yield chunk, value if len(value) == length else None
+            offset += length
+
+    try:
+        for chunk in chunks:
+            store = chunk.store
+            if store.segment_id is None:
+                yield from read_run()
+                run = []
+                yield chunk, read_location(directory / chunk.filename)
+                continue
+            if run:
+                last = run[-1].store
+                contiguous = (
+                    last.segment_id == store.segment_id and
+                    last.segment_offset + last.segment_length ==
+                    store.segment_offset
+                )
+                run_length = sum(c.store.segment_length for c in run)
+                if (not contiguous or
+                        run_length + store.segment_length > READ_BYTE_LENGTH):
+                    yield from read_run()
+                    run = []
+            run.append(chunk)
+        yield from read_run()
+    finally:
+        for stream in streams.values():
+            stream.close()
+
+
+def decrypt_stored(chunk, data, file, file_key=None):
+    """
+    Decrypt the cipher text of a chunk by the password of the chunk or, when
+    it has none, by the data key of its file.
+
+    :param chunk: Chunk
+    :param data: bytes read by read_chunks
+    :param file: CryptoFile the chunk belongs to
+    :param file_key: FileKey of the file
+    :return: bytes
+    """
+    if data is None:
+        raise Exception('Chunk missing from disk: {} in {}.'.format(
+            chunk.store.id, file.filename,
+        ))
+    if chunk.password is None:
+        return decrypt_file_chunk(
+            data,
+            file_key,
+            chunk.store.sequence,
+            chunk.store.filesize,
+            codec=chunk.store.codec,
+        )
+    return decrypt_chunk(
+        data,
+        chunk.password,
+        chunk.iv456,
+        chunk.store.filesize,
+        version=file.format_version,
+        codec=chunk.store.codec,
+    )
+
+
+def restore_file(file, master, directory, output, session):
+    """
+    Restore a single file into the output directory.
+
+    :param file: CryptoFile
+    :param master: MasterKey
+    :param directory: str output directory holding chunks and segments
+    :param output: str directory to restore into
+    :param session: Session to query chunks with
+    :return: Path restored or None when the master key does not match
+    """
+    if not password_matches(file, master):
+        return None
+    path = get_path(output) / file.filename
+    if file.is_dir:
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    file_key = unseal_file_key(file, master)
+    chunks = unseal_chunks(file, query_chunks(session, file), master)
+    with path.open('wb') as stream, instrument.measure(
+            'restore.file', size=file.filesize or 0, items=1):
+        for chunk, data in read_chunks(chunks, directory):
+            stream.write(decrypt_stored(chunk, data, file, file_key))
+    return path
+
+
+def find_file(session, filename):
+    """
+    :param session: Session to query with
+    :param filename: str path of a file relative to the input directory
+    :return: CryptoFile stored last under filename and not retired, or None
+    """
+    return session.query(CryptoFile).filter(
+        CryptoFile.filename == filename,
+        CryptoFile.retired_at.is_(None),
+        file_complete(),
+    ).order_by(CryptoFile.id.desc()).first()
+
+
+def range_chunks(session, file, master, offset, end):
+    """
+    Find the chunks of a file covering the plain text from offset up to end.
+    Chunks recording their position are found through the position index of
+    the file, only the rows in range are loaded. Rows stored before positions
+    were recorded, or sealed before format 3 so every value depends on the
+    one before it, are scanned in order from the first chunk instead.
+
+    :return: generator of tuples of Chunk and int position of the chunk
+    """
+    first = session.query(CryptoStore.position).filter(
+        CryptoStore.cryptofile_id == file.id,
+    ).order_by(CryptoStore.sequence, CryptoStore.id).first()
+    if first is None:
+        return
+    indexed = (
+        first.position is not None and
+        (file.format_version or FORMAT_HEX) >= FORMAT_SEALED
+    )
+    if not indexed:
+        position = 0
+        stores = query_chunks(session, file)
+        for chunk in unseal_chunks(file, stores, master):
+            start = position
+            position += chunk.store.filesize
+            if position <= offset:
+                continue
+            if start >= end:
+                return
+            yield chunk, start
+        return
+    start = session.query(CryptoStore.position).filter(
+        CryptoStore.cryptofile_id == file.id,
+        CryptoStore.position <= offset,
+    ).order_by(CryptoStore.position.desc()).first()
+    stores = session.query(CryptoStore).filter(
+        CryptoStore.cryptofile_id == file.id,
+        CryptoStore.position >= (start.position if start else 0),
+        CryptoStore.position < end,
+    ).order_by(CryptoStore.position)
+    for chunk in unseal_chunks(file, stores, master):
+        yield chunk, chunk.store.position
+
+
+def read_range(file, offset, length, master, directory, session=None):
+    """
+    Read length bytes of the plain text of a stored file from offset, only
+    the chunks covering the range are read and decrypted. The range is cut
+    short at the end of the file.
+
+    :param file: CryptoFile
+    :param offset: int offset of the first byte within the file
+    :param length: int number of bytes to read
+    :param master: MasterKey
+    :param directory: str output directory holding chunks and segments
+    :param session: Session to query chunks with, default a new one
+    :return: bytes
+    """
+    if offset < 0 or length < 0:
+        raise Exception('Invalid range: offset = {}, length = {}.'.format(
+            offset, length,
+        ))
+    if not password_matches(file, master):
+        raise Exception('Password does not match: {}.'.format(file.filename))
+    owned = session is None
+    session = session or Session()
+    end = offset + length
+    parts = []
+    try:
+        with instrument.measure('restore.range', items=1) as measured:
+            file_key = unseal_file_key(file, master)
+            chunks = range_chunks(session, file, master, offset, end)
+            positions = {}
+
+            def located():
+                for chunk, position in chunks:
+                    positions[chunk.store.id] = position
+                    yield chunk
+
+            for chunk, data in read_chunks(located(), directory):
+                plain = decrypt_stored(chunk, data, file, file_key)
+                start = positions.pop(chunk.store.id)
+                parts.append(plain[max(offset - start, 0):end - start])
+            measured.add(size=sum(len(p) for p in parts))
+    finally:
+        if owned:
+            session.close()
+    return b''.join(parts)
+
+
+class StoredFile(io.RawIOBase):
+    """
+    A read only, seekable raw file object over the plain text of a stored
+    file. Rows of the file are loaded CHUNK_BATCH_SIZE at a time through the
+    position index around the offset read, chunks are decrypted when first
+    read and the last cache_size of them kept. Segment files are mapped with
+    mmap and chunks of a segment sliced from the map. Files stored before
+    positions were recorded, or sealed before format 3, have every row loaded
+    and unsealed in order when opened.
+
+    Example use: `with open_stored(file, master, directory) as stream: ...`
+    """
+    file = None
+    master = None
+    directory = None
+    session = None
+    owned = False
+    file_key = None
+    cache_size = READER_CACHE_SIZE
+    cache = None
+    maps = None
+    indexed = True
+    positions = None
+    stores = None
+    unsealed = None
+    length = 0
+    offset = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.offset
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.offset
+        elif whence == io.SEEK_END:
+            offset += self.length
+        elif whence != io.SEEK_SET:
+            raise ValueError('Invalid whence: {}.'.format(whence))
+        if offset < 0:
+            raise ValueError('Negative seek position: {}.'.format(offset))
+        self.offset = offset
+        return offset
+
+    def readinto(self, buffer):
+        """
+        Fill buffer from the current offset with as many bytes as remain.
+
+        :param buffer: writable bytes like object
+        :return: int number of bytes read, 0 at the end of the file
+        """
+        view = memoryview(buffer).cast('B')
+        read = 0
+        while read < len(view) and self.offset < self.length:
+            position, plain = self.chunk_at(self.offset)
+            start = self.offset - position
+            length = min(len(plain) - start, len(view) - read)
+            if length <= 0:
+                break
+            view[read:read + length] = plain[start:start + length]
+            read += length
+            self.offset += length
+        return read
+
+    def chunk_at(self, offset):
+        """
+        :param offset: int offset within the plain text of the file
+        :return: tuple of int position and bytes of the chunk covering offset
+        """
+        index = bisect_right(self.positions, offset) - 1
+        loaded = index >= 0 and (
+            offset < self.positions[index] + self.stores[index].filesize)
+        if self.indexed and not loaded:
+            self.load(offset)
+            index = bisect_right(self.positions, offset) - 1
+        store = self.stores[index]
+        plain = self.cache.get(store.id)
+        if plain is None:
+            plain = self.decrypt(store)
+            self.cache[store.id] = plain
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(store.id)
+        return self.positions[index], plain
+
+    def load(self, offset):
+        """
+        Load the rows of the file from the chunk covering offset onwards.
+        """
+        start = self.session.query(CryptoStore.position).filter(
+            CryptoStore.cryptofile_id == self.file.id,
+            CryptoStore.position <= offset,
+        ).order_by(CryptoStore.position.desc()).first()
+        self.stores = self.session.query(CryptoStore).filter(
+            CryptoStore.cryptofile_id == self.file.id,
+            CryptoStore.position >= (start.position if start else 0),
+        ).order_by(CryptoStore.position).limit(CHUNK_BATCH_SIZE).all()
+        self.positions = [store.position for store in self.stores]
+
+    def load_all(self):
+        """
+        Load and unseal every row of the file in order, positions following
+        from the lengths of the chunks before.
+        """
+        self.stores = []
+        self.positions = []
+        self.unsealed = {}
+        position = 0
+        stores = query_chunks(self.session, self.file)
+        for chunk in unseal_chunks(self.file, stores, self.master):
+            self.stores.append(chunk.store)
+            self.positions.append(position)
+            self.unsealed[chunk.store.id] = chunk
+            position += chunk.store.filesize
+        self.length = position
+
+    def read_store(self, store, filename=None):
+        """
+        :return: bytes cipher text of a chunk, or None when missing from disk
+        """
+        if store.segment_id is None:
+            return read_location(get_path(self.directory) / filename)
+        segment = self.maps.get(store.segment_id)
+        if segment is None:
+            location = get_path(self.directory) / store.segment.filename
+            if not location.exists():
+                return None
+            with location.open('rb') as stream:
+                segment = mmap.mmap(
+                    stream.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[store.segment_id] = segment
+        end = store.segment_offset + store.segment_length
+        if end > len(segment):
+            return None
+        with instrument.measure(
+                'diskio.read', size=store.segment_length, items=1):
+            return segment[store.segment_offset:end]
+
+    def decrypt(self, store):
+        if self.unsealed is not None:
+            chunk = self.unsealed[store.id]
+        else:
+            chunk = next(unseal_chunks(self.file, [store], self.master))
+        data = self.read_store(store, chunk.filename)
+        return decrypt_stored(chunk, data, self.file, self.file_key)
+
+    def close(self):
+        if self.closed:
+            return
+        for segment in (self.maps or {}).values():
+            segment.close()
+        self.maps = {}
+        self.cache = OrderedDict()
+        if self.owned and self.session is not None:
+            self.session.close()
+        super().close()
+
+    def __init__(
+        self, file, master, directory, session=None,
+        cache_size=READER_CACHE_SIZE,
+    ):
+        super().__init__()
+        if not password_matches(file, master):
+            raise Exception(
+                'Password does not match: {}.'.format(file.filename))
+        self.file = file
+        self.master = master
+        self.directory = directory
+        self.owned = session is None
+        self.session = session or Session()
+        self.cache_size = max(cache_size or READER_CACHE_SIZE, 1)
+        self.cache = OrderedDict()
+        self.maps = {}
+        self.file_key = unseal_file_key(file, master)
+        self.positions = []
+        self.stores = []
+        last = self.session.query(
+            CryptoStore.position, CryptoStore.filesize,
+        ).filter(
+            CryptoStore.cryptofile_id == file.id,
+        ).order_by(
+            CryptoStore.sequence.desc(), CryptoStore.id.desc(),
+        ).first()
+        if last is None:
+            return
+        self.indexed = (
+            last.position is not None and
+            (file.format_version or FORMAT_HEX) >= FORMAT_SEALED
+        )
+        if not self.indexed:
+            self.load_all()
+            return
+        self.length = last.position + last.filesize
+
+
+def open_stored(
+    file, master, directory, session=None, cache_size=READER_CACHE_SIZE,
+    buffering=io.DEFAULT_BUFFER_SIZE,
+):
+    """
+    Open the plain text of a stored file for reading, a BufferedReader over a
+    StoredFile.
+
+    :param file: CryptoFile
+    :param master: MasterKey
+    :param directory: str output directory holding chunks and segments
+    :param session: Session to query chunks with, default a new one closed
+                    with the file object
+    :param cache_size: int number of decrypted chunks kept
+    :param buffering: int buffer size of the BufferedReader
+    :return: io.BufferedReader
+    """
+    raw = StoredFile(
+        file, master, directory, session=session, cache_size=cache_size)
+    return io.BufferedReader(raw, buffer_size=buffering)
+
+
+def restore_file_id(file_id, master, directory, output):
+    """
+    Restore the file with file_id using a session of its own, so files can be
+    restored in parallel from a WorkerPool of threads.
+    """
+    session = Session()
+    try:
+        file = session.query(CryptoFile).get(file_id)
+        return restore_file(file, master, directory, output, session)
+    finally:
+        session.close()
+
+
+def restore_files(master, directory, output, jobs=1):
+    """
+    Restore the latest complete version not retired of every stored file,
+    jobs files at a time. Only one version of a filename is restored so no
+    two workers ever write the same path.
+
+    :param master: MasterKey
+    :param directory: str output directory holding chunks and segments
+    :param output: str directory to restore into
+    :param jobs: int number of files restored in parallel
+    :return: list of Path restored
+    """
+    session = Session()
+    file_ids = sorted(
+        row[0] for row in session.query(func.max(CryptoFile.id)).filter(
+            CryptoFile.retired_at.is_(None),
+            file_complete(),
+        ).group_by(CryptoFile.filename))
+    session.close()
+    get_path(output).mkdir(parents=True, exist_ok=True)
+    restore = partial(
+        restore_file_id, master=master, directory=directory, output=output)
+    with WorkerPool(jobs=jobs, pool=POOL_THREAD) as workers:
+        return [path for path in workers.map(restore, file_ids) if path]
@@ -8,11 +8,25 @@ data to and from disk using a public and private AES-RSA key.
 """
 
 from sqlalchemy import (
-    Column, Integer, Unicode, Binary, Boolean, DateTime, ForeignKey
+    Column, Integer, Unicode, LargeBinary, Boolean, DateTime, ForeignKey,
+    Index, or_,
 )
 from sqlalchemy.orm import relationship, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.types import TypeDecorator
+
+from instrument import instrument
+
+
+CHUNK_BATCH_SIZE = 1000
+ID_BATCH_SIZE = 500
+SQLITE_PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-65536',
+]
 
 
 # engine = create_engine('sqlite:///:memory:')
@@ -22,6 +36,40 @@ Base = declarative_base()
 session = Session()
 
 
+@event.listens_for(engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Use write ahead logging and relaxed syncing on every connection so bulk
+    chunk inserts are not bound by a journal sync per transaction.
+    """
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+@event.listens_for(engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if instrument.enabled:
+        measure = instrument.measure('storage.execute', items=1)
+        conn.info.setdefault('measures', []).append(measure.__enter__())
+
+
+@event.listens_for(engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    measures = conn.info.get('measures')
+    if measures:
+        measures.pop().__exit__(None, None, None)
+
+
+@event.listens_for(engine, 'handle_error')
+def handle_error(context):
+    if context.connection is not None:
+        context.connection.info.pop('measures', None)
+
+
 """
 Create an AE-RSA key for each bytes length of data being encoded and keep the
 key in DB associated with the file. This key and filename are encrypted with a
@@ -35,16 +83,46 @@ encrypted on the drive are erased and replaced with 🍆's.
 """
 
 
+class CipherBytes(TypeDecorator):
+    """
+    Raw cipher text stored as bytes, rows written before the binary format
+    kept the same values as hex text and are decoded back to bytes on load.
+    """
+    impl = LargeBinary
+
+    def result_processor(self, dialect, coltype):
+        def process(value):
+            if value is None:
+                return None
+            if type(value) is str:
+                return bytes.fromhex(value)
+            return bytes(value)
+        return process
+
+
 class CryptoStore(Base):
     __tablename__ = 'cryptostore'
     id = Column(Integer, primary_key=True)
-    public_key = Column(Unicode())
-    private_key = Column(Unicode())
-    filename = Column(Unicode())
+    public_key = Column(CipherBytes())
+    private_key = Column(CipherBytes())
+    filename = Column(CipherBytes())
     checksum = Column(Unicode())
     filesize = Column(Integer())
+    segment_id = Column(Integer, ForeignKey('cryptosegment.id'))
+    segment_offset = Column(Integer())
+    segment_length = Column(Integer())
+    sequence = Column(Integer())
+    position = Column(Integer())
+    fingerprint = Column(Unicode(), index=True)
+    codec = Column(Unicode())
     cryptofile_id = Column(Integer, ForeignKey('cryptofile.id'))
     cryptofile = relationship('CryptoFile', backref='cryptostores')
+    segment = relationship('CryptoSegment')
+
+    __table_args__ = (
+        Index('ix_cryptostore_cryptofile_sequence', cryptofile_id, sequence),
+        Index('ix_cryptostore_cryptofile_position', cryptofile_id, position),
+    )
 
     def __repr__(self):
         return '<CryptoStore(id="{}", filename="{}", filesize="{}")>'.format(
@@ -52,15 +130,66 @@ class CryptoStore(Base):
         )
 
 
+class CryptoSegment(Base):
+    """
+    A segment file in the output directory holding the cipher text of many
+    chunks appended one after another, CryptoStore rows locate their chunk by
+    segment, offset and length.
+    """
+    __tablename__ = 'cryptosegment'
+    id = Column(Integer, primary_key=True)
+    filename = Column(Unicode())
+
+    def __repr__(self):
+        return '<CryptoSegment(id="{}", filename="{}")>'.format(
+            self.id, self.filename,
+        )
+
+
+class StoreRun(Base):
+    """
+    Journal of a store run. Files stored by a run refer to it and are
+    complete once their checksum is recorded, until then the chunk rows
+    committed for a file are its progress. A run without finished_at was
+    interrupted and can be resumed, files and chunks count what it has
+    committed.
+    """
+    __tablename__ = 'storerun'
+    id = Column(Integer, primary_key=True)
+    started_at = Column(DateTime())
+    resumed_at = Column(DateTime())
+    finished_at = Column(DateTime(), index=True)
+    resumes = Column(Integer())
+    incremental = Column(Boolean())
+    chunking = Column(Unicode())
+    chunk_size = Column(Integer())
+    codec = Column(Unicode())
+    files = Column(Integer())
+    chunks = Column(Integer())
+
+    def __repr__(self):
+        return '<StoreRun(id="{}", started_at="{}")>'.format(
+            self.id, self.started_at,
+        )
+
+
 class CryptoFile(Base):
     __tablename__ = 'cryptofile'
     id = Column(Integer, primary_key=True)
     # public_key = Column(Unicode())
     private_key = Column(Unicode())
     test_copy = Column(Unicode())
-    test_encrypted = Column(Unicode())
-    filename = Column(Unicode())
+    test_encrypted = Column(CipherBytes())
+    filename = Column(Unicode(), index=True)
     is_dir = Column(Boolean())
+    format_version = Column(Integer())
+    filesize = Column(Integer())
+    mtime = Column(Integer())
+    checksum = Column(Unicode())
+    retired_at = Column(DateTime())
+    data_key = Column(CipherBytes())
+    chunk_size = Column(Integer())
+    run_id = Column(Integer, ForeignKey('storerun.id'), index=True)
 
     def __repr__(self):
         return '<CryptoFile(id="{}", filename="{}")>'.format(
@@ -68,5 +197,59 @@ class CryptoFile(Base):
         )
 
 
+def file_complete():
+    """
+    Filter of the CryptoFile rows fully stored, a file stored by a run is
+    incomplete until its checksum is recorded.
+    """
+    return or_(CryptoFile.run_id.is_(None), CryptoFile.checksum.isnot(None))
+
+
+def bulk_insert(model, rows, bind=None):
+    """
+    Insert a list of dicts of column values for model as a single executemany
+    within the current transaction of bind, the module session by default.
+    """
+    if not rows:
+        return
+    with instrument.measure('storage.insert', items=len(rows)):
+        (bind or session).execute(model.__table__.insert(), rows)
+
+
+def commit(bind=None):
+    """
+    Commit the current transaction of bind, the module session by default.
+    """
+    with instrument.measure('storage.commit', items=1):
+        (bind or session).commit()
+
+
+def upgrade_schema(bind, metadata=None):
+    """
+    Add any columns and indexes missing from tables created by an earlier
+    version, SQLite only supports adding columns so existing rows keep NULL for
+    new columns. Tables of metadata are upgraded, Base by default.
+    """
+    inspector = inspect(bind)
+    tables = inspector.get_table_names()
+    for table in (metadata or Base.metadata).sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = [c['name'] for c in inspector.get_columns(table.name)]
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            bind.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                table.name,
+                column.name,
+                column.type.compile(dialect=bind.dialect),
+            ))
+        indexes = [i['name'] for i in inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(bind)
+
+
 CryptoStore.metadata.create_all(engine)
 CryptoFile.metadata.create_all(engine)
+upgrade_schema(engine)
@@ -0,0 +1,121 @@
+"""
+Copyright 2019 (c) GlibGlob Ltd.
+Author: Laurence Psychic
+Email: vesper.porta@protonmail.com
+
+Fixtures shared by the tests. The database lives at output/data.sqlite
+relative to the working directory when storage is first imported, so every
+test runs in one scratch workspace made the working directory here before
+anything of VesperCrypt is imported, emptied again before each test.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+from hashlib import md5
+from pathlib import Path
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKSPACE = tempfile.mkdtemp(prefix='vespercrypt-tests-')
+sys.path.insert(0, ROOT)
+os.chdir(WORKSPACE)
+os.makedirs('output')
+
+from storage import Base, engine, session  # noqa: E402
+
+PASSWORD = 'correct horse'
+PASSWORD_IV = md5('84d1a35654ab9af8'.encode()).hexdigest()[:16]
+
+
+def master_key(password=PASSWORD):
+    """
+    The MasterKey the CLI derives from password.
+    """
+    from cryptochunk import MasterKey
+    return MasterKey(md5(password.encode()).hexdigest(), PASSWORD_IV)
+
+
+@pytest.fixture(autouse=True)
+def workspace():
+    """
+    Empty the database and the input, output and restore directories.
+    """
+    session.rollback()
+    session.expunge_all()
+    for table in reversed(Base.metadata.sorted_tables):
+        engine.execute(table.delete())
+    for name in ['input', 'restore']:
+        shutil.rmtree(name, ignore_errors=True)
+    for entry in Path('output').iterdir():
+        if entry.name.startswith('data.sqlite'):
+            continue
+        if entry.is_dir():
+            shutil.rmtree(str(entry))
+        else:
+            entry.unlink()
+    os.makedirs('input')
+    yield Path(WORKSPACE)
+
+
+@pytest.fixture
+def master():
+    return master_key()
+
+
+@pytest.fixture
+def write_tree():
+    """
+    Write a dict of relative path to bytes below the input directory.
+    """
+    def write(files):
+        for name, contents in files.items():
+            location = Path('input') / name
+            location.parent.mkdir(parents=True, exist_ok=True)
+            location.write_bytes(contents)
+        return files
+    return write
+
+
+@pytest.fixture
+def read_tree():
+    """
+    Read every file below a directory into a dict of relative path to bytes.
+    """
+    def read(directory):
+        directory = Path(directory)
+        return {
+            location.relative_to(directory).as_posix(): location.read_bytes()
+            for location in directory.rglob('*') if location.is_file()
+        }
+    return read
+
+
+@pytest.fixture
+def store(master):
+    """
+    Store the input directory as the store mode of the CLI does.
+    """
+    from app import store_input
+    from workers import POOL_THREAD
+
+    def run(key=None, jobs=1, pool=POOL_THREAD, **options):
+        key = key or master
+        return store_input(
+            key, key.key.decode(), PASSWORD_IV, jobs=jobs, pool=pool,
+            **options)
+    return run
+
+
+@pytest.fixture
+def restore(master):
+    """
+    Restore every stored file into the restore directory.
+    """
+    from restore import restore_files
+
+    def run(key=None, jobs=1):
+        return restore_files(key or master, 'output', 'restore', jobs=jobs)
+    return run
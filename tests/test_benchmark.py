@@ -0,0 +1,47 @@
+"""
+Copyright 2019 (c) GlibGlob Ltd.
+Author: Laurence Psychic
+Email: vesper.porta@protonmail.com
+
+Synthetic trees and comparing benchmark results.
+"""
+
+from benchmark import (
+    DATA_RANDOM, DATA_TEXT, FILES_PER_DIRECTORY, compare_results,
+    generate_tree, text_block,
+)
+
+
+def test_text_block():
+    assert all(len(text_block(length)) == length for length in range(500))
+    block = text_block(10000)
+    assert block == text_block(10000)
+    assert len(set(block.split())) < 30
+
+
+def test_generate_tree(tmp_path):
+    assert generate_tree(str(tmp_path), 150, 3000, DATA_TEXT) == 450000
+    files = sorted(p for p in tmp_path.rglob('*') if p.is_file())
+    assert len(files) == 150
+    assert len({p.parent for p in files}) == 2
+    assert len(list(tmp_path.glob('d0000/*'))) == FILES_PER_DIRECTORY
+    assert all(p.stat().st_size == 3000 for p in files)
+    assert generate_tree(str(tmp_path / 'random'), 1, 0, DATA_RANDOM) == 0
+
+
+def test_compare_results():
+    baseline = {
+        'scenarios': {'small': {'store': {'mb_s': 10.0, 'seconds': 2.0}}},
+        'passwords': {'generate_many': 100.0},
+        'chunking': {'content_chunks': 4.0},
+    }
+    results = {
+        'scenarios': {'small': {'store': {'mb_s': 15.0, 'seconds': 1.0}}},
+        'passwords': {'generate_many': 50.0, 'new': 1.0},
+        'chunking': {'content_chunks': 40.0},
+    }
+    assert dict(compare_results(baseline, results)) == {
+        'scenarios.small.store.mb_s': 1.5,
+        'passwords.generate_many': 0.5,
+        'chunking.content_chunks': 10.0,
+    }
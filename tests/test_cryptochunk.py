@@ -0,0 +1,40 @@
+"""
+Copyright 2019 (c) GlibGlob Ltd.
+Author: Laurence Psychic
+Email: vesper.porta@protonmail.com
+
+Encrypting and decrypting single chunks.
+"""
+
+import os
+
+import pytest
+
+from cryptochunk import (
+    AES_BLOCK_LENGTH, FORMAT_BINARY, FORMAT_HEX, decrypt_chunk,
+    encrypt_chunk, get_chunk_cipher, get_encryptable_password, pad_block,
+)
+
+IV456 = 'a1b2c3d4e5f6a7b8'
+
+
+@pytest.mark.parametrize('length', [0, 1, 15, 16, 17, 4096])
+def test_binary_chunk(length):
+    data = os.urandom(length)
+    password = get_encryptable_password()
+    encrypted = encrypt_chunk(data, password, IV456)
+    assert len(encrypted) == len(pad_block(data))
+    assert len(encrypted) % AES_BLOCK_LENGTH == 0
+    assert decrypt_chunk(
+        encrypted, password, IV456, length, version=FORMAT_BINARY) == data
+
+
+def test_hex_chunk_still_decrypted():
+    data = os.urandom(100)
+    password = get_encryptable_password()
+    plain = data.hex().encode()
+    padded = plain + b'0' * (-len(plain) % AES_BLOCK_LENGTH)
+    encrypted = get_chunk_cipher(password, IV456).encrypt(padded)
+    assert decrypt_chunk(
+        encrypted.hex().encode(), password, IV456, len(plain),
+        version=FORMAT_HEX) == data
@@ -0,0 +1,207 @@
+"""
+Copyright 2019 (c) GlibGlob Ltd.
+Author: Laurence Psychic
+Email: vesper.porta@protonmail.com
+
+Content defined chunking of files read from disk.
+"""
+
+import os
+
+import pytest
+
+import diskio
+from diskio import (
+    AUBERGINE, CDC_MAX_LENGTH, CDC_MIN_LENGTH, WIPE_RANDOM, WIPE_TYPES,
+    SegmentWriter, allocate_location, aubergine_file, detail_location,
+    read_content_chunks, read_windows, remove_disk_contents,
+    walk_location,
+)
+
+CONTENTS = {
+    'random': os.urandom(3000000),
+    'repeated': b'a' * 300000,
+    'mixed': os.urandom(200000) + b'vesper porta ' * 20000 + os.urandom(5),
+    'short': os.urandom(100),
+    'empty': b'',
+}
+
+
+def content_chunks(location, monkeypatch, bulk):
+    if not bulk:
+        monkeypatch.setattr(diskio, 'numpy', None)
+    chunks = list(read_content_chunks(location))
+    monkeypatch.undo()
+    return chunks
+
+
+@pytest.mark.parametrize('name', list(CONTENTS))
+def test_bulk_scan_cuts_as_scalar(name, tmp_path, monkeypatch):
+    pytest.importorskip('numpy')
+    location = tmp_path / name
+    location.write_bytes(CONTENTS[name])
+    chunks = content_chunks(location, monkeypatch, True)
+    assert chunks == content_chunks(location, monkeypatch, False)
+    assert b''.join(chunks) == CONTENTS[name]
+    for chunk in chunks[:-1]:
+        assert CDC_MIN_LENGTH <= len(chunk) <= CDC_MAX_LENGTH
+
+
+def test_cuts_follow_content(tmp_path):
+    contents = CONTENTS['random']
+    (tmp_path / 'a').write_bytes(contents)
+    (tmp_path / 'b').write_bytes(os.urandom(1000) + contents)
+    first = list(read_content_chunks(tmp_path / 'a'))
+    second = list(read_content_chunks(tmp_path / 'b'))
+    assert len(set(first) & set(second)) >= len(first) - 2
+
+
+@pytest.mark.parametrize('length', [0, 1, 4095, 4096, 4097, 40000])
+def test_read_windows(length, tmp_path):
+    contents = os.urandom(length)
+    location = tmp_path / 'windows'
+    location.write_bytes(contents)
+    windows = [bytes(window) for window in read_windows(location, 4096)]
+    assert b''.join(windows) == contents
+    assert all(len(window) == 4096 for window in windows[:-1])
+    assert all(windows)
+    offset = [bytes(w) for w in read_windows(location, 4096, offset=100)]
+    assert b''.join(offset) == contents[100:]
+
+
+def test_read_windows_of_missing_location(tmp_path):
+    assert list(read_windows(tmp_path / 'missing', 4096)) == []
+
+
+def test_segment_writer(tmp_path):
+    segments = []
+
+    def allocate():
+        segments.append(tmp_path / 'segment{}'.format(len(segments)))
+        return len(segments) - 1, segments[-1]
+
+    contents = [os.urandom(length) for length in [40, 50, 10, 100, 1]]
+    with SegmentWriter(allocate, max_size=100) as writer:
+        written = [writer.write(data) for data in contents]
+    assert [(s, o) for s, o, _ in written] == [
+        (0, 0), (0, 40), (0, 90), (1, 0), (2, 0)]
+    assert [length for _, _, length in written] == [40, 50, 10, 100, 1]
+    for (segment, offset, length), data in zip(written, contents):
+        assert segments[segment].read_bytes()[offset:][:length] == data
+
+
+@pytest.mark.parametrize('depth', [0, 1, 2])
+def test_allocate_location(depth, tmp_path):
+    locations = [allocate_location(tmp_path, depth=depth) for i in range(500)]
+    assert len(set(locations)) == 500
+    for location in locations:
+        relative = location.relative_to(tmp_path).parts
+        assert len(relative) == depth + 1
+        name = relative[-1]
+        assert len(name) == 32
+        assert list(relative[:-1]) == [
+            name[i * 2:i * 2 + 2] for i in range(depth)]
+        assert location.parent.is_dir()
+        assert not location.exists()
+
+
+def test_walk_location(tmp_path):
+    for name, contents in [('b', b'bb'), ('a/c', b'c'), ('a/d/e', b''),
+                           ('f/g', b'gggg')]:
+        location = tmp_path / name
+        location.parent.mkdir(parents=True, exist_ok=True)
+        location.write_bytes(contents)
+    (tmp_path / 'empty').mkdir()
+    os.symlink(str(tmp_path), str(tmp_path / 'f' / 'cycle'))
+    os.symlink(str(tmp_path / 'missing'), str(tmp_path / 'broken'))
+    entries = {entry.path: entry for entry in walk_location(tmp_path)}
+    assert sorted(entries) == ['a/c', 'a/d/e', 'b', 'f/g']
+    for path, entry in entries.items():
+        assert entry.location == tmp_path / path
+        stat = entry.location.stat()
+        assert (entry.size, entry.mtime) == (stat.st_size, stat.st_mtime_ns)
+    assert detail_location(tmp_path) == {
+        path: entry.location for path, entry in entries.items()}
+
+
+def test_walk_single_file(tmp_path):
+    location = tmp_path / 'single'
+    location.write_bytes(b'single')
+    assert [(e.path, e.size) for e in walk_location(location)] == [
+        ('single', 6)]
+    assert list(walk_location(tmp_path / 'missing')) == []
+
+
+def test_walk_location_records_errors(tmp_path, monkeypatch):
+    for name in ['a', 'sub/b', 'sub/deeper/c', 'other/d']:
+        location = tmp_path / name
+        location.parent.mkdir(parents=True, exist_ok=True)
+        location.write_bytes(b'walked')
+    scandir = os.scandir
+
+    def failing_scandir(path):
+        if os.path.basename(path) == 'sub':
+            raise PermissionError(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', failing_scandir)
+    errors = []
+    paths = [entry.path for entry in walk_location(tmp_path, errors=errors)]
+    assert sorted(paths) == ['a', 'other/d']
+    assert errors == ['sub']
+    assert detail_location(tmp_path / 'missing') is None
+
+
+@pytest.mark.parametrize('length', [0, 5, 3 * 1024 * 1024 + 3])
+def test_aubergine_file(length, tmp_path):
+    location = tmp_path / 'wiped'
+    location.write_bytes(b'\0' * length)
+    assert aubergine_file(location) == length
+    contents = location.read_bytes()
+    assert len(contents) == length
+    assert contents == (AUBERGINE * length)[:length]
+    assert aubergine_file(location, mode=WIPE_RANDOM) == length
+    assert len(location.read_bytes()) == length
+    with pytest.raises(Exception, match='Unknown wipe mode'):
+        aubergine_file(location, mode='shred')
+
+
+@pytest.mark.parametrize('mode', WIPE_TYPES)
+@pytest.mark.parametrize('keep_root', [True, False])
+def test_remove_disk_contents(mode, keep_root, tmp_path):
+    root = tmp_path / 'root'
+    outside = tmp_path / 'outside'
+    outside.write_bytes(b'kept')
+    for name, contents in [('a', b'aa'), ('b/c', b'ccc'), ('b/d/e', b'')]:
+        location = root / name
+        location.parent.mkdir(parents=True, exist_ok=True)
+        location.write_bytes(contents)
+    os.symlink(str(outside), str(root / 'b' / 'link'))
+    os.symlink(str(tmp_path), str(root / 'directory_link'))
+    single = tmp_path / 'single'
+    single.write_bytes(b'single')
+    wiped = remove_disk_contents([root, single], jobs=2, mode=mode,
+                                 keep_root=keep_root)
+    assert wiped == (6, 11)
+    assert root.exists() == keep_root
+    assert not keep_root or list(root.iterdir()) == []
+    assert not single.exists()
+    assert outside.read_bytes() == b'kept'
+    assert remove_disk_contents([]) == (0, 0)
+
+
+def test_remove_disk_contents_of_entries(tmp_path):
+    root = tmp_path / 'root'
+    for name in ['a', 'b/c', 'b/d', 'e/f']:
+        location = root / name
+        location.parent.mkdir(parents=True, exist_ok=True)
+        location.write_bytes(b'walked')
+    entries = list(walk_location(root))
+    (root / 'b' / 'd').write_bytes(b'changed')
+    (root / 'e' / 'g').write_bytes(b'new')
+    wiped = remove_disk_contents([root], keep_root=True, entries=[
+        entry for entry in entries if entry.path != 'e/f'])
+    assert wiped == (2, 12)
+    assert sorted(
+        p.relative_to(root).as_posix() for p in root.rglob('*')
+    ) == ['b', 'b/d', 'e', 'e/f', 'e/g']
@@ -0,0 +1,76 @@
+"""
+Copyright 2019 (c) GlibGlob Ltd.
+Author: Laurence Psychic
+Email: vesper.porta@protonmail.com
+
+Stage totals and thread profiles of a run.
+"""
+
+import json
+import pstats
+
+import pytest
+
+from instrument import NULL_MEASURE, Instrument, instrument
+
+
+def test_nothing_recorded_while_stopped():
+    measured = Instrument()
+    assert measured.measure('stage') is NULL_MEASURE
+    measured.count('stage')
+    assert measured.timed('stage')(lambda: 1)() == 1
+    assert list(measured.iterate('stage', [1, 2])) == [1, 2]
+    assert measured.report()['stages'] == {}
+
+
+def test_stages_recorded():
+    measured = Instrument()
+    measured.start()
+    with measured.measure('read', size=10, items=1) as block:
+        block.add(5, 1)
+    measured.count('roll')
+    assert measured.timed('work')(lambda value: value * 2)(4) == 8
+    assert list(measured.iterate('walk', 'abc', size=lambda item: 2)) == [
+        'a', 'b', 'c']
+    measured.stop()
+    stages = measured.report()['stages']
+    assert {name: (s['calls'], s['items'], s['bytes'])
+            for name, s in stages.items()} == {
+        'read': (1, 2, 15),
+        'roll': (1, 1, 0),
+        'work': (1, 0, 0),
+        'walk': (4, 3, 6),
+    }
+    assert stages['read']['wall'] >= 0
+    assert 'elapsed' in measured.summary()
+
+
+def test_store_profiled(tmp_path, write_tree, store):
+    write_tree({'a.bin': b'vesper porta' * 100000})
+    instrument.start(profile=True)
+    try:
+        store(jobs=2)
+    finally:
+        instrument.stop()
+    stages = instrument.report()['stages']
+    for name in ['diskio.read', 'store.encrypt', 'store.write',
+                 'store.commit', 'chunk.aes']:
+        assert stages[name]['calls'] > 0
+    assert stages['diskio.read']['bytes'] == 1200000
+    instrument.dump_json(str(tmp_path / 'stages.json'))
+    with open(str(tmp_path / 'stages.json')) as stream:
+        assert json.load(stream)['stages'].keys() == stages.keys()
+    instrument.dump_stats(str(tmp_path / 'profile.pstats'))
+    functions = pstats.Stats(str(tmp_path / 'profile.pstats')).stats
+    assert any(name == 'encrypt_windows' for _, _, name in functions)
+
+
+def test_nested_profile_thread():
+    profiled = Instrument()
+    profiled.start(profile=True)
+    with profiled.profile_thread(), profiled.profile_thread():
+        pass
+    profiled.stop()
+    assert len(profiled.profiles) == 1
+    with pytest.raises(ZeroDivisionError):
+        profiled.profiled(lambda: 1 / 0)()
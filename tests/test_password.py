@@ -0,0 +1,72 @@
+"""
+Copyright 2019 (c) GlibGlob Ltd.
+Author: Laurence Psychic
+Email: vesper.porta@protonmail.com
+
+Alphabet tables and password generation.
+"""
+
+from collections import Counter
+
+import pytest
+
+from password import (
+    Alphabet, Password, alphabet_table, normalize_alphabets,
+    sample_characters, sampling_table,
+)
+
+
+def test_normalize_alphabets():
+    assert normalize_alphabets('Hiragana, basic latin,hiragana') == (
+        'basic latin', 'hiragana')
+    assert normalize_alphabets(['Katakana', 'ASCII']) == (
+        'ascii', 'katakana')
+
+
+def test_alphabet_table_cached():
+    alphabet_table.cache_clear()
+    first = Alphabet(['Basic Latin', 'Hiragana']).detail()
+    second = Alphabet('hiragana,basic latin').detail()
+    assert first is second
+    assert alphabet_table.cache_info().misses == 1
+    assert first == ''.join(chr(i) for i in range(32, 127)) + ''.join(
+        chr(i) for i in range(12352, 12447))
+
+
+def test_default_alphabets():
+    assert str(Alphabet()) == Alphabet(Alphabet.DEFAULT_ALPHABETS).detail()
+    assert Alphabet('ascii').detail() == ''.join(
+        chr(i) for i in range(33, 122))
+
+
+@pytest.mark.parametrize('size', [1, 3, 256, 300, 70000, 0x10001])
+def test_sampling_table(size):
+    table = ''.join(chr(i) for i in range(size))
+    extended, width, _, limit = sampling_table(table)
+    assert limit % size == 0
+    assert limit <= 1 << (width * 8)
+    sampled = sample_characters(table, 1000)
+    assert len(sampled) == 1000
+    assert set(sampled) <= set(table)
+
+
+def test_sample_characters_uniform():
+    sampled = Counter(sample_characters('abc', 30000))
+    assert set(sampled) == set('abc')
+    assert all(9000 < count < 11000 for count in sampled.values())
+
+
+def test_generate_many():
+    alphabet = Alphabet('ascii')
+    passwords = Password.generate_many(500, length=20, alphabet=alphabet)
+    assert len(passwords) == 500
+    assert len(set(passwords)) == 500
+    assert all(len(password) == 20 for password in passwords)
+    assert set(''.join(passwords)) <= set(alphabet.detail())
+    assert Password.generate_many(0) == []
+
+
+def test_password():
+    password = Password(length=12, alphabet=['ascii'])
+    assert len(str(password)) == 12
+    assert password.complexity == len(Alphabet('ascii').detail())
@@ -0,0 +1,81 @@
+"""
+Copyright 2019 (c) GlibGlob Ltd.
+Author: Laurence Psychic
+Email: vesper.porta@protonmail.com
+
+Stages of worker threads connected by bounded queues.
+"""
+
+import threading
+import time
+
+import pytest
+
+from pipeline import Pipeline, Stage
+
+
+def test_items_pass_every_stage():
+    results = []
+    squared = []
+    finished = []
+
+    def square(item):
+        squared.append(item)
+        return [item * item]
+
+    def finish():
+        finished.append(len(squared))
+        return ['last']
+
+    Pipeline([
+        Stage('double', lambda item: [item, item], workers=3),
+        Stage('square', square, workers=2, finish=finish),
+        Stage('collect', results.append),
+    ], queue_size=2).run(range(20))
+    assert results.pop() == 'last'
+    assert sorted(results) == sorted(2 * [i * i for i in range(20)])
+    assert finished == [40]
+
+
+def test_error_stops_run():
+    read = []
+
+    def source():
+        for item in range(1000):
+            read.append(item)
+            yield item
+
+    def fail(item):
+        if item == 5:
+            raise ValueError('Stage failed.')
+        return [item]
+
+    with pytest.raises(ValueError, match='Stage failed'):
+        Pipeline([
+            Stage('fail', fail, workers=2),
+            Stage('sink', lambda item: None),
+        ], queue_size=2).run(source())
+    assert len(read) < 1000
+
+
+def test_source_bounded_by_slow_stage():
+    read = []
+    started = threading.Event()
+
+    def source():
+        for item in range(100):
+            read.append(item)
+            yield item
+
+    def slow(item):
+        started.set()
+        time.sleep(0.01)
+
+    pipeline = threading.Thread(target=Pipeline(
+        [Stage('slow', slow)], queue_size=4).run, args=(source(),))
+    pipeline.start()
+    started.wait()
+    time.sleep(0.05)
+    assert len(read) <= 4 + 8
+    pipeline.join()
+    assert len(read) == 100
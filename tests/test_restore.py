@@ -0,0 +1,182 @@
+"""
+Copyright 2019 (c) GlibGlob Ltd.
+Author: Laurence Psychic
+Email: vesper.porta@protonmail.com
+
+Streaming restore of stored files.
+"""
+
+import io
+import os
+import random
+
+import pytest
+
+from app import CHUNKING_CONTENT, CHUNKING_FIXED
+from instrument import instrument
+from restore import StoredFile, find_file, open_stored, read_range
+from storage import Session
+from workers import POOL_PROCESS
+
+TREE = {
+    'a.bin': os.urandom(300000),
+    'empty': b'',
+    'sub/text.txt': b'vesper porta\n' * 5000,
+    'sub/deep/small': b'x',
+}
+
+
+def test_round_trip(write_tree, read_tree, store, restore):
+    write_tree(TREE)
+    store(jobs=2, pool=POOL_PROCESS)
+    assert len(restore(jobs=4)) == len(TREE)
+    assert read_tree('restore') == TREE
+
+
+def test_wrong_password_restores_nothing(write_tree, store, restore):
+    from conftest import master_key
+    write_tree(TREE)
+    store()
+    assert restore(key=master_key('wrong')) == []
+
+
+def test_parallel_restore_of_replaced_file(write_tree, read_tree, store,
+                                           restore):
+    write_tree({'big.bin': os.urandom(5000000)})
+    store()
+    latest = write_tree({'big.bin': os.urandom(3000000)})
+    store()
+    restored = restore(jobs=8)
+    assert len(restored) == 1
+    assert read_tree('restore') == latest
+
+
+@pytest.fixture
+def stored_file(master, write_tree, store):
+    """
+    Store a single file and open a session on it, yielding the contents and
+    a function reading a range of the stored file.
+    """
+    def run(contents, **options):
+        write_tree({'ranged.bin': contents})
+        store(**options)
+        file = find_file(session, 'ranged.bin')
+        return file, lambda offset, length, key=None: read_range(
+            file, offset, length, key or master, 'output', session=session)
+
+    session = Session()
+    yield run
+    session.close()
+
+
+RANGES = [
+    (0, 0), (0, 1), (0, 4096), (4095, 2), (4096, 4096), (1000, 50000),
+    (99990, 10), (99990, 100), (100000, 5), (200000, 5), (12345, 0),
+]
+
+
+@pytest.mark.parametrize('options', [
+    {'chunk_size': 4096},
+    {'chunk_size': 4096, 'codec': 'zlib'},
+    {'chunking': CHUNKING_CONTENT},
+])
+def test_read_range(options, stored_file):
+    contents = (os.urandom(50000) + b'vesper porta ' * 4000)[:100000]
+    file, read = stored_file(contents, **options)
+    for offset, length in RANGES:
+        assert read(offset, length) == contents[offset:offset + length]
+
+
+def test_read_range_decrypts_only_chunks_in_range(stored_file):
+    contents = os.urandom(100000)
+    file, read = stored_file(contents, chunking=CHUNKING_FIXED,
+                             chunk_size=4096)
+    instrument.start()
+    try:
+        assert read(4095, 2) == contents[4095:4097]
+    finally:
+        instrument.stop()
+    assert instrument.report()['stages']['chunk.decrypt']['calls'] == 2
+
+
+def test_read_range_refused(stored_file):
+    from conftest import master_key
+    file, read = stored_file(os.urandom(1000))
+    with pytest.raises(Exception, match='Invalid range'):
+        read(-1, 10)
+    with pytest.raises(Exception, match='Invalid range'):
+        read(0, -10)
+    with pytest.raises(Exception, match='Password does not match'):
+        read(0, 10, key=master_key('wrong'))
+
+
+def test_read_stored_range(master, write_tree, store, capfdbinary):
+    from app import read_stored_range
+    write_tree({'sub/a.txt': b'first version'})
+    store()
+    write_tree({'sub/a.txt': b'vesper porta'})
+    store()
+    capfdbinary.readouterr()
+    read_stored_range(master, 'sub/a.txt', 7, 100)
+    assert capfdbinary.readouterr().out == b'porta'
+    with pytest.raises(Exception, match='File not stored'):
+        read_stored_range(master, 'missing', 0, 1)
+
+
+@pytest.mark.parametrize('options', [
+    {'chunk_size': 512},
+    {'chunk_size': 4096, 'codec': 'lzma'},
+    {'chunking': CHUNKING_CONTENT},
+])
+def test_open_stored(options, master, write_tree, store):
+    contents = (os.urandom(300000) + b'vesper porta ' * 30000)[:700000]
+    write_tree({'seek.bin': contents})
+    store(**options)
+    session = Session()
+    file = find_file(session, 'seek.bin')
+    with open_stored(file, master, 'output', session=session,
+                     cache_size=4) as stream:
+        assert stream.seekable()
+        assert stream.read(10) == contents[:10]
+        assert stream.tell() == 10
+        assert stream.seek(-5, io.SEEK_END) == len(contents) - 5
+        assert stream.read() == contents[-5:]
+        assert stream.read(10) == b''
+        assert stream.seek(-100, io.SEEK_CUR) == len(contents) - 100
+        assert stream.read(50) == contents[-100:-50]
+        chooser = random.Random(0)
+        for i in range(50):
+            offset = chooser.randrange(len(contents) + 10)
+            length = chooser.randrange(20000)
+            stream.seek(offset)
+            assert stream.read(length) == contents[offset:offset + length]
+        stream.seek(0)
+        assert stream.read() == contents
+    session.close()
+
+
+def test_stored_file(master, write_tree, store):
+    write_tree({'empty': b'', 'small': b'vesper porta'})
+    store()
+    session = Session()
+    try:
+        raw = StoredFile(find_file(session, 'small'), master, 'output')
+        buffer = bytearray(20)
+        assert raw.readinto(buffer) == 12
+        assert bytes(buffer[:12]) == b'vesper porta'
+        assert raw.readinto(buffer) == 0
+        with pytest.raises(ValueError, match='Negative seek'):
+            raw.seek(-1)
+        with pytest.raises(ValueError, match='Invalid whence'):
+            raw.seek(0, 3)
+        raw.close()
+        assert raw.closed
+        with open_stored(find_file(session, 'empty'), master,
+                         'output') as stream:
+            assert stream.read() == b''
+        from conftest import master_key
+        with pytest.raises(Exception, match='Password does not match'):
+            StoredFile(find_file(session, 'small'), master_key('wrong'),
+                       'output')
+    finally:
+        session.close()
@@ -0,0 +1,124 @@
+"""
+Copyright 2019 (c) GlibGlob Ltd.
+Author: Laurence Psychic
+Email: vesper.porta@protonmail.com
+
+Resuming a store run interrupted part way through a file.
+"""
+
+import os
+from pathlib import Path
+
+import pytest
+
+from app import StorePipeline
+from conftest import master_key
+from cryptochunk import FileKey
+from storage import (
+    CryptoFile, CryptoSegment, CryptoStore, Session, StoreRun,
+)
+from verify import verify_files
+
+TREE = {
+    'big.bin': os.urandom(2000000),
+    'small.txt': b'vesper porta\n' * 100,
+}
+
+
+@pytest.fixture
+def interrupted(monkeypatch, write_tree, store):
+    """
+    Store TREE in 4 KiB chunks with the run failing half way through
+    big.bin, once some of its chunks are committed and more are written.
+    """
+    commit = StorePipeline.commit
+
+    def failing_commit(self, batch):
+        if batch.sequence >= 256:
+            raise Exception('Interrupted.')
+        return commit(self, batch)
+
+    write_tree(TREE)
+    monkeypatch.setattr(StorePipeline, 'commit', failing_commit)
+    with pytest.raises(Exception, match='Interrupted'):
+        store(chunk_size=4096, batch_size=16, readers=1, writers=1)
+    monkeypatch.setattr(StorePipeline, 'commit', commit)
+    session = Session()
+    try:
+        run = session.query(StoreRun).one()
+        assert run.finished_at is None
+        partial = session.query(CryptoFile).filter(
+            CryptoFile.checksum.is_(None)).one()
+        assert session.query(CryptoStore).filter(
+            CryptoStore.cryptofile_id == partial.id).count() > 0
+        return run.id
+    finally:
+        session.close()
+
+
+def test_resume(interrupted, read_tree, store, restore):
+    pipeline = store(chunk_size=4096, resume=True)
+    assert pipeline.resumed
+    assert pipeline.run_id == interrupted
+    restore()
+    assert read_tree('restore') == TREE
+
+
+def test_resume_refused_with_wrong_password(interrupted, read_tree, store,
+                                            restore):
+    with pytest.raises(Exception, match='another password'):
+        store(key=master_key('wrong'), resume=True)
+    pipeline = store(resume=True)
+    assert pipeline.run_id == interrupted
+    restore()
+    assert read_tree('restore') == TREE
+
+
+def test_file_key_refuses_invalid_key():
+    with pytest.raises(Exception):
+        FileKey(b'')
+    with pytest.raises(Exception):
+        FileKey(os.urandom(7))
+    assert len(FileKey().key) == 32
+
+
+def test_resume_collects_garbage(interrupted, store):
+    pipeline = store(chunk_size=4096, resume=True)
+    assert pipeline.garbage.bytes > 0
+    session = Session()
+    try:
+        for segment in session.query(CryptoSegment):
+            end = max(
+                chunk.segment_offset + chunk.segment_length
+                for chunk in session.query(CryptoStore).filter(
+                    CryptoStore.segment_id == segment.id))
+            assert (Path('output') / segment.filename).stat().st_size == end
+    finally:
+        session.close()
+    reports = verify_files(master_key(), 'output')
+    assert all(not r.missing and not r.corrupt for r in reports)
+
+
+def test_resume_abandons_changed_file(interrupted, write_tree, read_tree,
+                                      store, restore):
+    changed = write_tree({'big.bin': os.urandom(1500000)})
+    pipeline = store(chunk_size=4096, resume=True)
+    assert pipeline.run_id == interrupted
+    session = Session()
+    try:
+        files = session.query(CryptoFile).filter(
+            CryptoFile.filename == 'big.bin').all()
+        assert len(files) == 1
+        assert files[0].filesize == 1500000
+    finally:
+        session.close()
+    restore()
+    assert read_tree('restore') == dict(TREE, **changed)
+
+
+def test_new_run_without_resume(interrupted, read_tree, store, restore):
+    pipeline = store(chunk_size=4096)
+    assert not pipeline.resumed
+    assert pipeline.run_id != interrupted
+    restore()
+    assert read_tree('restore') == TREE
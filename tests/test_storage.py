@@ -0,0 +1,72 @@
+"""
+Copyright 2019 (c) GlibGlob Ltd.
+Author: Laurence Psychic
+Email: vesper.porta@protonmail.com
+
+Bulk inserts and upgrading the schema of an earlier version.
+"""
+
+import os
+
+import pytest
+from sqlalchemy import create_engine, inspect
+
+from storage import (
+    Base, CryptoSegment, CryptoStore, Session, bulk_insert, commit,
+    upgrade_schema,
+)
+
+
+def test_bulk_insert():
+    session = Session()
+    try:
+        bulk_insert(CryptoSegment, [], bind=session)
+        bulk_insert(CryptoSegment, [
+            {'filename': 'segment{}'.format(i)} for i in range(100)],
+            bind=session)
+        commit(session)
+        assert session.query(CryptoSegment).count() == 100
+    finally:
+        session.close()
+
+
+def test_bulk_insert_within_transaction():
+    session = Session()
+    try:
+        bulk_insert(CryptoSegment, [{'filename': 'rolled back'}],
+                    bind=session)
+        session.rollback()
+        assert session.query(CryptoSegment).count() == 0
+    finally:
+        session.close()
+
+
+def test_upgrade_schema(tmp_path):
+    engine = create_engine('sqlite:///{}'.format(tmp_path / 'old.sqlite'))
+    engine.execute(
+        'CREATE TABLE cryptostore (id INTEGER PRIMARY KEY, filesize INTEGER)')
+    upgrade_schema(engine)
+    inspector = inspect(engine)
+    columns = [c['name'] for c in inspector.get_columns('cryptostore')]
+    assert sorted(columns) == sorted(
+        c.name for c in CryptoStore.__table__.columns)
+    indexes = [i['name'] for i in inspector.get_indexes('cryptostore')]
+    assert sorted(indexes) == sorted(
+        i.name for i in CryptoStore.__table__.indexes)
+    assert inspector.get_table_names() == ['cryptostore']
+    Base.metadata.create_all(engine)
+    upgrade_schema(engine)
+
+
+@pytest.mark.parametrize('batch_size', [1, 7, 1000])
+def test_batch_size(batch_size, write_tree, read_tree, store, restore):
+    tree = write_tree({
+        'f{}'.format(i): os.urandom(i * 1000) for i in range(10)})
+    store(chunk_size=1024, batch_size=batch_size)
+    session = Session()
+    try:
+        assert session.query(CryptoStore).count() == sum(range(10))
+    finally:
+        session.close()
+    restore()
+    assert read_tree('restore') == tree
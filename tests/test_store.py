@@ -0,0 +1,289 @@
+"""
+Copyright 2019 (c) GlibGlob Ltd.
+Author: Laurence Psychic
+Email: vesper.porta@protonmail.com
+
+Full and incremental store runs and the versions they leave live.
+"""
+
+import os
+from pathlib import Path
+
+import pytest
+
+from app import (
+    CHUNK_MAX_LENGTH, CHUNK_MIN_LENGTH, CHUNKING_CONTENT, WORKER_BATCH_BYTES,
+    WORKER_BATCH_LENGTH, batch_length, choose_chunk_size,
+)
+from cryptochunk import CODEC_TYPES, FORMAT_FILE_KEY
+from storage import (
+    CryptoFile, CryptoSegment, CryptoStore, Session, StoreRun,
+)
+from workers import POOL_PROCESS
+
+
+def live_files():
+    """
+    :return: dict of filename to the number of live versions stored
+    """
+    session = Session()
+    try:
+        live = {}
+        for file in session.query(CryptoFile).filter(
+                CryptoFile.retired_at.is_(None)):
+            live[file.filename] = live.get(file.filename, 0) + 1
+        return live
+    finally:
+        session.close()
+
+
+def files_stored(pipeline):
+    """
+    :return: int number of files the run of pipeline stored
+    """
+    session = Session()
+    try:
+        return session.query(StoreRun).get(pipeline.run_id).files
+    finally:
+        session.close()
+
+
+def written_bytes():
+    """
+    :return: int bytes of chunks and segments written to the output directory
+    """
+    return sum(
+        location.stat().st_size for location in Path('output').rglob('*')
+        if location.is_file() and not location.name.startswith('data.'))
+
+
+def test_full_store_retires_replaced_version(write_tree, read_tree, store,
+                                             restore):
+    write_tree({'a.bin': os.urandom(70000), 'b.txt': b'unchanged'})
+    store()
+    latest = write_tree({'a.bin': os.urandom(50000)})
+    store()
+    assert live_files() == {'a.bin': 1, 'b.txt': 1}
+    restore()
+    assert read_tree('restore') == dict(latest, **{'b.txt': b'unchanged'})
+
+
+def test_incremental_store(write_tree, read_tree, store, restore):
+    write_tree({
+        'same': b'same' * 1000,
+        'changed': b'before' * 1000,
+        'deleted': b'deleted',
+        'touched': b'touched' * 1000,
+    })
+    first = store(incremental=True)
+    assert files_stored(first) == 4
+    write_tree({'changed': b'after' * 1000})
+    os.remove('input/deleted')
+    touched = Path('input/touched')
+    os.utime(str(touched), (1, 1))
+    second = store(incremental=True)
+    assert files_stored(second) == 1
+    assert live_files() == {'same': 1, 'changed': 1, 'touched': 1}
+    restore()
+    assert read_tree('restore') == {
+        'same': b'same' * 1000,
+        'changed': b'after' * 1000,
+        'touched': b'touched' * 1000,
+    }
+
+
+def test_incremental_store_keeps_files_not_walked(write_tree, read_tree,
+                                                  store, monkeypatch):
+    write_tree({'a': b'a', 'sub/b': b'b', 'sub/deeper/c': b'c'})
+    store(incremental=True)
+    os.remove('input/a')
+    scandir = os.scandir
+
+    def failing_scandir(path):
+        if Path(path).name == 'sub':
+            raise PermissionError(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', failing_scandir)
+    store(incremental=True)
+    assert live_files() == {'sub/b': 1, 'sub/deeper/c': 1}
+
+
+def test_content_chunking_with_process_pool(write_tree, read_tree, store,
+                                            restore):
+    tree = write_tree({
+        'a.bin': os.urandom(300000),
+        'b.bin': os.urandom(200000),
+        'sub/text.txt': b'vesper porta\n' * 5000,
+    })
+    store(jobs=2, pool=POOL_PROCESS, chunking=CHUNKING_CONTENT, readers=2)
+    restore()
+    assert read_tree('restore') == tree
+
+
+def test_content_chunking_deduplicates(write_tree, read_tree, store, restore):
+    contents = os.urandom(1000000)
+    tree = write_tree({'a.bin': contents})
+    store(chunking=CHUNKING_CONTENT)
+    tree.update(write_tree({'b.bin': b'prefix' + contents}))
+    store(chunking=CHUNKING_CONTENT, incremental=True)
+    assert written_bytes() < len(contents) * 1.2
+    restore()
+    assert read_tree('restore') == tree
+
+
+def test_fixed_chunks_use_file_key(write_tree, read_tree, store, restore):
+    tree = write_tree({'a.bin': os.urandom(100000), 'empty': b''})
+    store(chunk_size=4096)
+    session = Session()
+    try:
+        file = session.query(CryptoFile).filter(
+            CryptoFile.filename == 'a.bin').one()
+        assert file.format_version == FORMAT_FILE_KEY
+        assert file.data_key
+        stores = session.query(CryptoStore).filter(
+            CryptoStore.cryptofile_id == file.id,
+        ).order_by(CryptoStore.sequence).all()
+        assert len(stores) == 25
+        assert all(store.public_key is None for store in stores)
+        assert [store.sequence for store in stores] == list(range(25))
+    finally:
+        session.close()
+    restore()
+    assert read_tree('restore') == tree
+
+
+@pytest.mark.parametrize('length', [4096 * 64, 4096 * 64 + 1, 4095])
+def test_file_streamed_in_many_batches(length, write_tree, read_tree, store,
+                                       restore):
+    tree = write_tree({'a.bin': os.urandom(length)})
+    store(chunk_size=4096, batch_size=3, queue_size=2)
+    restore()
+    assert read_tree('restore') == tree
+
+
+def test_chunks_stored_as_binary(write_tree, store):
+    write_tree({'a.bin': os.urandom(100000)})
+    store(chunk_size=4096)
+    assert 100000 <= written_bytes() < 100000 + 25 * 16
+
+
+def test_chunks_packed_into_segments(master, write_tree, store):
+    write_tree({
+        'd{}/f{}'.format(i // 10, i): os.urandom(1000) for i in range(50)})
+    store(chunk_size=4096)
+    session = Session()
+    try:
+        segments = session.query(CryptoSegment).all()
+        assert len(segments) == 1
+        stores = session.query(CryptoStore).order_by(
+            CryptoStore.segment_offset).all()
+        assert len(stores) == 50
+        offset = 0
+        for chunk in stores:
+            assert chunk.filename is None
+            assert chunk.segment_id == segments[0].id
+            assert chunk.segment_offset == offset
+            offset += chunk.segment_length
+        data = (Path('output') / segments[0].filename).read_bytes()
+        assert len(data) == offset
+        assert all(
+            master.chunk_mac(data[c.segment_offset:][:c.segment_length]) ==
+            c.checksum for c in stores)
+    finally:
+        session.close()
+
+
+@pytest.mark.parametrize('codec', CODEC_TYPES)
+def test_compression(codec, write_tree, read_tree, store, restore):
+    tree = write_tree({
+        'text.txt': b'vesper porta ' * 20000,
+        'random.bin': os.urandom(100000),
+    })
+    store(chunk_size=16384, codec=codec)
+    session = Session()
+    try:
+        codecs = {
+            file.filename: {store.codec for store in file.cryptostores}
+            for file in session.query(CryptoFile)}
+    finally:
+        session.close()
+    assert codecs['random.bin'] == {None}
+    if codec == 'none':
+        assert codecs['text.txt'] == {None}
+        assert written_bytes() >= 360000
+    else:
+        assert codecs['text.txt'] == {codec}
+        assert written_bytes() < 130000
+    restore()
+    assert read_tree('restore') == tree
+
+
+def test_store_and_wipe(write_tree, read_tree, store, restore):
+    tree = write_tree({'a.bin': os.urandom(10000), 'sub/b.txt': b'b'})
+    store(wipe=True)
+    assert list(Path('input').iterdir()) == []
+    restore()
+    assert read_tree('restore') == tree
+
+
+def test_wipe_keeps_files_written_during_run(
+        write_tree, read_tree, store, restore, monkeypatch):
+    from app import StorePipeline
+    tree = write_tree({
+        'a.bin': os.urandom(10000), 'sub/b.txt': b'b', 'sub/c.txt': b'c'})
+    finish_run = StorePipeline.finish_run
+
+    def write_then_finish(pipeline):
+        Path('input/sub/c.txt').write_bytes(b'changed')
+        Path('input/sub/new.txt').write_bytes(b'new')
+        finish_run(pipeline)
+
+    monkeypatch.setattr(StorePipeline, 'finish_run', write_then_finish)
+    pipeline = store(wipe=True)
+    assert sorted(e.path for e in pipeline.committed) == [
+        'a.bin', 'sub/b.txt', 'sub/c.txt']
+    assert read_tree('input') == {
+        'sub/c.txt': b'changed', 'sub/new.txt': b'new'}
+    restore()
+    assert read_tree('restore') == tree
+
+
+@pytest.mark.parametrize('filesize, expected', [
+    (0, CHUNK_MIN_LENGTH),
+    (1000, CHUNK_MIN_LENGTH),
+    (1024 * 1024, 1024),
+    (1024 * 1024 + 1024, 2048),
+    (64 * 1024 * 1024, 65536),
+    (10 ** 12, CHUNK_MAX_LENGTH),
+])
+def test_choose_chunk_size(filesize, expected):
+    assert choose_chunk_size(filesize) == expected
+    assert choose_chunk_size(filesize, chunk_size=3000) == 3000
+
+
+def test_batch_length():
+    assert batch_length() == WORKER_BATCH_LENGTH
+    assert batch_length(CHUNK_MIN_LENGTH) == WORKER_BATCH_LENGTH
+    assert batch_length(CHUNK_MAX_LENGTH) * CHUNK_MAX_LENGTH <= \
+        WORKER_BATCH_BYTES
+    assert batch_length(WORKER_BATCH_BYTES * 2) == 1
+
+
+def test_chunk_size_chosen_per_file(write_tree, read_tree, store, restore):
+    tree = write_tree({
+        'small': os.urandom(3000),
+        'large': os.urandom(3 * 1024 * 1024),
+    })
+    store()
+    session = Session()
+    try:
+        files = {f.filename: f for f in session.query(CryptoFile)}
+        assert files['small'].chunk_size == CHUNK_MIN_LENGTH
+        assert len(files['small'].cryptostores) == 6
+        assert files['large'].chunk_size == 4096
+        assert len(files['large'].cryptostores) == 768
+    finally:
+        session.close()
+    restore()
+    assert read_tree('restore') == tree
@@ -0,0 +1,176 @@
+"""
+Copyright 2019 (c) GlibGlob Ltd.
+Author: Laurence Psychic
+Email: vesper.porta@protonmail.com
+
+Issuing, validating and sweeping tokens.
+"""
+
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from cryptotoken import (
+    Base, Token, TokenCache, TokenManager, TokenSweeper, sweep_tokens,
+)
+from storage import Session, engine
+
+
+@pytest.fixture(autouse=True)
+def tokens():
+    for table in reversed(Base.metadata.sorted_tables):
+        engine.execute(table.delete())
+
+
+@pytest.fixture
+def manager():
+    manager = TokenManager()
+    yield manager
+    manager.session.close()
+
+
+def live_tokens():
+    session = Session()
+    try:
+        return session.query(Token).filter(Token.deleted_at.is_(None)).count()
+    finally:
+        session.close()
+
+
+def test_single_use(manager):
+    token = manager.create_random()
+    value = manager.get_value(token)
+    assert not manager.validation(token.key, 'wrong')
+    assert manager.validation(token.key, value)
+    assert not manager.validation(token.key, value)
+
+
+def test_reusable(manager):
+    token = manager.create_random(single_use=False)
+    value = manager.get_value(token)
+    assert manager.validation(token.key, value)
+    manager.cache.clear()
+    assert manager.validation(token.key, value)
+
+
+@pytest.mark.parametrize('cached', [True, False])
+def test_trailing_whitespace(manager, cached):
+    token = manager.create_token('key', token_value='value \n')
+    if not cached:
+        manager.cache.clear()
+    assert manager.get_value(token) == 'value'
+    assert manager.validation('key', 'value \n')
+
+
+def test_validated_by_another_manager(manager):
+    other = TokenManager()
+    try:
+        token = manager.create_random(single_use=False)
+        assert other.validation(token.key, manager.get_value(token))
+    finally:
+        other.session.close()
+
+
+def test_expired(manager):
+    token = manager.create_random(
+        expiry=datetime.now() - timedelta(seconds=1))
+    assert not manager.validation(token.key, manager.get_value(token))
+    assert live_tokens() == 0
+
+
+def test_create_token_replaces_unvalidated(manager):
+    manager.create_token('key', token_value='first')
+    manager.create_token('key', token_value='second')
+    manager.cache.clear()
+    assert not manager.validation('key', 'first')
+    assert manager.validation('key', 'second')
+
+
+def test_create_many(manager):
+    pairs = manager.create_many(20)
+    assert len({key for key, _ in pairs}) == 20
+    assert all(manager.validation(key, value) for key, value in pairs)
+    assert live_tokens() == 0
+
+
+def test_cache_ttl():
+    cache = TokenCache(ttl=timedelta(minutes=1))
+    now = datetime.now()
+    manager = TokenManager(cache=cache)
+    try:
+        token = manager.create_random(single_use=False)
+        state = manager.load(token.key)
+    finally:
+        manager.session.close()
+    cache.put(state, now=now)
+    assert cache.get(token.key, now=now + timedelta(seconds=59)) == state
+    assert cache.get(token.key, now=now + timedelta(minutes=1)) is None
+    assert len(cache) == 0
+    cache.put(state._replace(expiry=now + timedelta(seconds=5)), now=now)
+    assert cache.get(token.key, now=now + timedelta(seconds=5)) is None
+
+
+def test_cache_size():
+    cache = TokenCache(size=2)
+    manager = TokenManager(cache=cache)
+    try:
+        keys = [manager.create_random().key for i in range(3)]
+    finally:
+        manager.session.close()
+    assert len(cache) == 2
+    assert cache.get(keys[0]) is None
+    assert cache.get(keys[2]) is not None
+
+
+def test_sweep(manager):
+    now = datetime.now()
+    manager.create_random(expiry=now - timedelta(seconds=1))
+    consumed = manager.create_random()
+    manager.validation(consumed.key, manager.get_value(consumed))
+    kept = manager.create_random().key
+    assert sweep_tokens(manager.session, now=now, batch_size=1) == 2
+    assert [token.key for token in manager.session.query(Token)] == [kept]
+
+
+def test_sweeper():
+    manager = TokenManager()
+    try:
+        manager.create_random(expiry=datetime.now() - timedelta(seconds=1))
+    finally:
+        manager.session.close()
+    with TokenSweeper(interval=60) as sweeper:
+        assert sweeper.sweep() == 1
+    assert sweeper.thread is None
+    assert sweeper.deleted == 1
+
+
+def test_create_many_not_cached(manager):
+    expiry = datetime.now() + timedelta(hours=1)
+    pairs = manager.create_many(5, expiry=expiry, single_use=False)
+    assert len(manager.cache) == 0
+    tokens = manager.session.query(Token).all()
+    assert {token.key for token in tokens} == {key for key, _ in pairs}
+    assert all(token.expiry == expiry for token in tokens)
+    assert all(manager.validation(key, value) for key, value in pairs)
+    assert live_tokens() == 5
+
+
+def test_sweep_in_batches(manager):
+    manager.create_many(23, expiry=datetime.now() - timedelta(seconds=1))
+    assert manager.sweep(batch_size=5) == 23
+    assert live_tokens() == 0
+
+
+def test_sweeper_thread():
+    manager = TokenManager()
+    try:
+        manager.create_many(3, expiry=datetime.now() - timedelta(seconds=1))
+    finally:
+        manager.session.close()
+    with TokenSweeper(interval=0.01) as sweeper:
+        deadline = datetime.now() + timedelta(seconds=5)
+        while sweeper.deleted < 3 and datetime.now() < deadline:
+            time.sleep(0.01)
+    assert sweeper.deleted == 3
+    assert live_tokens() == 0
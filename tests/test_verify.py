@@ -0,0 +1,100 @@
+"""
+Copyright 2019 (c) GlibGlob Ltd.
+Author: Laurence Psychic
+Email: vesper.porta@protonmail.com
+
+Verifying stored chunks against their MACs without restoring them.
+"""
+
+import os
+from pathlib import Path
+
+import pytest
+
+from conftest import master_key
+from storage import CryptoFile, CryptoSegment, CryptoStore, Session
+from verify import verify_files
+
+TREE = {
+    'a.bin': os.urandom(100000),
+    'b.txt': b'vesper porta\n' * 1000,
+    'empty': b'',
+}
+
+
+def segment_of(filename):
+    """
+    :return: tuple of the Path of the segment holding the chunks of filename
+             and the CryptoStore rows of its chunks in order
+    """
+    session = Session()
+    try:
+        file = session.query(CryptoFile).filter(
+            CryptoFile.filename == filename).one()
+        stores = session.query(CryptoStore).filter(
+            CryptoStore.cryptofile_id == file.id,
+        ).order_by(CryptoStore.sequence).all()
+        segment = session.query(CryptoSegment).get(stores[0].segment_id)
+        return Path('output') / segment.filename, stores
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def stored(write_tree, store):
+    write_tree(TREE)
+    store(chunk_size=4096)
+
+
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_verify_clean_store(stored, master, jobs):
+    reports = {r.filename: r for r in verify_files(master, 'output', jobs)}
+    assert sorted(reports) == sorted(TREE)
+    for report in reports.values():
+        assert report.matched
+        assert (report.missing, report.corrupt, report.unchecked) == (
+            [], [], 0)
+    assert reports['a.bin'].chunks == 25
+    assert reports['empty'].chunks == 0
+
+
+def test_verify_finds_corrupt_chunk(stored, master):
+    location, stores = segment_of('a.bin')
+    with location.open('r+b') as stream:
+        stream.seek(stores[3].segment_offset + 5)
+        byte = stream.read(1)
+        stream.seek(-1, os.SEEK_CUR)
+        stream.write(bytes([byte[0] ^ 1]))
+    reports = {r.filename: r for r in verify_files(master, 'output')}
+    assert reports['a.bin'].corrupt == [3]
+    assert reports['b.txt'].corrupt == []
+
+
+def test_verify_finds_missing_chunks(stored, master):
+    location, stores = segment_of('a.bin')
+    os.truncate(str(location), stores[20].segment_offset + 1)
+    reports = {r.filename: r for r in verify_files(master, 'output')}
+    assert reports['a.bin'].missing == [20, 21, 22, 23, 24]
+    assert reports['a.bin'].corrupt == []
+    location.unlink()
+    reports = {r.filename: r for r in verify_files(master, 'output')}
+    assert reports['a.bin'].missing == list(range(25))
+
+
+def test_verify_with_wrong_password(stored):
+    reports = verify_files(master_key('wrong'), 'output')
+    assert len(reports) == len(TREE)
+    assert not any(report.matched for report in reports)
+
+
+def test_verify_store(stored, master, capsys):
+    from app import verify_store
+    assert verify_store(master) is True
+    assert 'Verified 3 files, 29 chunks: 0 missing, 0 corrupt' in \
+        capsys.readouterr().out
+    assert verify_store(master_key('wrong')) is False
+    assert 'Skipped 3 files' in capsys.readouterr().out
+    location, stores = segment_of('a.bin')
+    location.unlink()
+    assert verify_store(master) is False
+    assert 'Missing chunks of a.bin: 0, 1, 2' in capsys.readouterr().out
@@ -0,0 +1,86 @@
+"""
+Copyright 2019 (c) GlibGlob Ltd.
+Author: Laurence Psychic
+Email: vesper.porta@protonmail.com
+
+Worker pools hand results back in the order work was given.
+"""
+
+import os
+import random
+import threading
+import time
+from functools import partial
+
+import pytest
+
+from cryptochunk import FileKey, decrypt_file_chunk, encrypt_windows
+from workers import POOL_PROCESS, POOL_THREAD, POOL_TYPES, WorkerPool, batched
+
+
+def slow_square(value):
+    time.sleep(random.random() / 100)
+    return value * value
+
+
+def worker_pid(_):
+    return os.getpid()
+
+
+@pytest.mark.parametrize('pool', POOL_TYPES)
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_map_keeps_order(pool, jobs):
+    with WorkerPool(jobs=jobs, pool=pool) as workers:
+        assert list(workers.map(slow_square, range(50))) == [
+            value * value for value in range(50)]
+        assert workers.run(slow_square, 7) == 49
+
+
+def test_process_pool_started_from_thread():
+    results = []
+    with WorkerPool(jobs=2, pool=POOL_PROCESS) as workers:
+        thread = threading.Thread(target=lambda: results.extend(
+            workers.map(worker_pid, range(4))))
+        thread.start()
+        thread.join()
+    assert len(results) == 4
+    assert os.getpid() not in results
+
+
+def test_batched():
+    assert list(batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(batched([], 2)) == []
+
+
+def test_map_reads_ahead_boundedly():
+    consumed = []
+
+    def items():
+        for value in range(100):
+            consumed.append(value)
+            yield value
+
+    with WorkerPool(jobs=2, pool=POOL_THREAD) as workers:
+        results = workers.map(slow_square, items())
+        assert next(results) == 0
+        assert len(consumed) <= 2 * 2
+        assert list(results) == [value * value for value in range(1, 100)]
+
+
+def test_encrypt_windows_in_process_pool(master):
+    windows = [os.urandom(1000) for i in range(8)]
+    file_key = FileKey()
+    encrypt = partial(
+        encrypt_windows, iv456=None, master=master, file_key=file_key)
+    with WorkerPool(jobs=2, pool=POOL_PROCESS) as workers:
+        batches = list(workers.map(encrypt, [windows[:4], windows[4:]]))
+    chunks = batches[0] + batches[1]
+    # Each batch starts at sequence 0 as no sequence was given.
+    for sequence, (window, chunk) in enumerate(zip(windows, chunks)):
+        assert decrypt_file_chunk(
+            chunk[2], file_key, sequence % 4, chunk[3]) == window
+
+
+def test_unknown_pool():
+    with pytest.raises(Exception, match='Unknown pool'):
+        WorkerPool(jobs=2, pool='fibre')
@@ -0,0 +1,120 @@
+"""
+Copyright 2019 (c) GlibGlob Ltd.
+Author: Laurence Psychic
+Email: vesper.porta@protonmail.com
+
+Verify a store without restoring it. The cipher text of every chunk is read
+from its segment or file and checked against the MAC recorded when it was
+stored, nothing is decrypted so no plain text is ever produced. Files are
+verified in parallel, the chunks of each file in order so contiguous chunks
+of a segment are read together.
+"""
+
+import hmac
+from collections import namedtuple
+from functools import partial
+
+from cryptochunk import FORMAT_HEX, FORMAT_SEALED
+from instrument import instrument
+from restore import (
+    Chunk, password_matches, query_chunks, read_chunks, unseal_chunks,
+)
+from storage import CryptoFile, Session, file_complete
+from workers import WorkerPool, POOL_THREAD
+
+
+FileReport = namedtuple('FileReport', [
+    'file_id', 'filename', 'matched', 'chunks', 'missing', 'corrupt',
+    'unchecked',
+])
+
+
+def locate_chunks(file, stores, master):
+    """
+    Unseal only the filename of each chunk stored in a file of its own, the
+    passwords of chunks are not needed to verify them. Values sealed before
+    format 3 depend on the value before them so are unsealed in full.
+
+    :return: generator of Chunk
+    """
+    if (file.format_version or FORMAT_HEX) < FORMAT_SEALED:
+        yield from unseal_chunks(file, stores, master)
+        return
+    for store in stores:
+        filename = None
+        if store.filename:
+            filename = master.unseal(store.filename).decode()
+        yield Chunk(store, None, None, filename)
+
+
+def verify_file(file, master, directory, session):
+    """
+    Verify every chunk of a single file. Chunks are named in the report by
+    their sequence, or id for rows stored before sequences were recorded.
+
+    :param file: CryptoFile
+    :param master: MasterKey
+    :param directory: str output directory holding chunks and segments
+    :param session: Session to query chunks with
+    :return: FileReport, not matched when sealed by another master key
+    """
+    if not password_matches(file, master):
+        return FileReport(file.id, file.filename, False, 0, [], [], 0)
+    missing = []
+    corrupt = []
+    unchecked = 0
+    count = 0
+    chunks = locate_chunks(file, query_chunks(session, file), master)
+    with instrument.measure('verify.file', items=1) as measured:
+        for chunk, data in read_chunks(chunks, directory):
+            count += 1
+            store = chunk.store
+            name = store.id if store.sequence is None else store.sequence
+            if data is None:
+                missing.append(name)
+                continue
+            measured.add(len(data))
+            if not store.checksum:
+                unchecked += 1
+                continue
+            if not hmac.compare_digest(
+                    master.chunk_mac(data), store.checksum):
+                corrupt.append(name)
+    return FileReport(
+        file.id, file.filename, True, count, missing, corrupt, unchecked)
+
+
+def verify_file_id(file_id, master, directory):
+    """
+    Verify the file with file_id using a session of its own, so files can be
+    verified in parallel from a WorkerPool of threads.
+    """
+    session = Session()
+    try:
+        file = session.query(CryptoFile).get(file_id)
+        return verify_file(file, master, directory, session)
+    finally:
+        session.close()
+
+
+def verify_files(master, directory, jobs=1):
+    """
+    Verify every complete stored file, retired versions included as their
+    chunks are still kept, jobs files at a time. Files sealed by another
+    master key are reported as not matched.
+
+    :param master: MasterKey
+    :param directory: str output directory holding chunks and segments
+    :param jobs: int number of files verified in parallel
+    :return: list of FileReport
+    """
+    session = Session()
+    file_ids = [
+        f.id for f in session.query(CryptoFile.id).filter(
+            CryptoFile.is_dir.isnot(True),
+            file_complete(),
+        ).order_by(CryptoFile.id)]
+    session.close()
+    verify = partial(verify_file_id, master=master, directory=directory)
+    with WorkerPool(jobs=jobs, pool=POOL_THREAD) as workers:
+        return list(workers.map(verify, file_ids))
@@ -0,0 +1,114 @@
+"""
+Copyright 2019 (c) GlibGlob Ltd.
+Author: Laurence Psychic
+Email: vesper.porta@protonmail.com
+
+Spread work across a pool of processes or threads while handing results back
+in the order the work was given, so callers writing to disk and the database
+see exactly what a serial loop would have produced.
+"""
+
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from instrument import instrument
+
+
+POOL_PROCESS = 'process'
+POOL_THREAD = 'thread'
+POOL_TYPES = [POOL_PROCESS, POOL_THREAD, ]
+DEFAULT_JOBS = os.cpu_count() or 1
+START_METHOD = 'forkserver'
+if START_METHOD not in multiprocessing.get_all_start_methods():
+    START_METHOD = 'spawn'
+
+
+def batched(iterable, length):
+    """
+    Group an iterable into lists of at most length items.
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= length:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class WorkerPool:
+    """
+    A concurrent.futures pool of jobs workers, with a single job no pool is
+    created and work is run in the calling thread. Processes are started
+    lazily from whichever thread first submits work, so are never forked from
+    the caller but started by START_METHOD, inheriting none of its threads,
+    locks or database connections.
+
+    Example use: `with WorkerPool(jobs=4) as pool: pool.map(fn, items)`
+    """
+    jobs = 1
+    pool = POOL_PROCESS
+    executor = None
+
+    def map(self, function, iterable):
+        """
+        Yield function applied to each item of iterable in order, at most twice
+        as many items as there are workers are in flight at any time so a
+        streamed iterable is never read far ahead of its consumer.
+
+        :param function: picklable callable when using a process pool
+        :param iterable: items to pass to function
+        :return: generator of results
+        """
+        if self.executor is None:
+            for item in iterable:
+                yield function(item)
+            return
+        if self.pool == POOL_THREAD:
+            function = instrument.profiled(function)
+        pending = deque()
+        for item in iterable:
+            pending.append(self.executor.submit(function, item))
+            if len(pending) >= self.jobs * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def run(self, function, item):
+        """
+        Apply function to a single item on the pool and wait for its result,
+        for callers which keep their own threads busy feeding the pool.
+        """
+        if self.executor is None:
+            return function(item)
+        if self.pool == POOL_THREAD:
+            function = instrument.profiled(function)
+        return self.executor.submit(function, item).result()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.executor = None
+
+    def __init__(self, jobs=None, pool=POOL_PROCESS):
+        if pool not in POOL_TYPES:
+            raise Exception('Unknown pool type: pool = {}.'.format(pool))
+        self.jobs = max(jobs or DEFAULT_JOBS, 1)
+        self.pool = pool
+        if self.jobs > 1:
+            if pool == POOL_PROCESS:
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.jobs,
+                    mp_context=multiprocessing.get_context(START_METHOD),
+                )
+            else:
+                self.executor = ThreadPoolExecutor(max_workers=self.jobs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()